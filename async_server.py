@@ -0,0 +1,467 @@
+import asyncio
+import os
+import socket
+import framing
+import handoff
+import keepalive
+import message_log
+import metrics
+import protocol
+import ratelimit
+import send_queue
+import server
+import stream_compression
+import tls
+
+# ==============================================================================================
+#                                    Async Server State
+# ==============================================================================================
+
+# Protocol objects of every open client connection, so a draining server can hand each of them over
+open_protocols = set()
+
+# ==============================================================================================
+#                                    Connection Objects
+# ==============================================================================================
+
+# Send queue that writes to an asyncio transport so it can be stored as the socket of a Connection object
+# The message handlers in server.py only call send() and close() on a client socket,
+# so they run unchanged against this object
+# Messages queued while handling a batch of received messages are written to the transport together once
+# the event loop is free, and the slow consumer policy applies while the transport has paused writing
+# The 'block' policy cannot block the event loop, so messages keep waiting in the queue instead
+class TransportSocket(send_queue.OutboundQueue):
+    __slots__ = ('transport', 'encrypted', 'paused', 'flush_scheduled')
+
+    # Takes asyncio transport, String, and Integer as arguments
+    def __init__(self, transport, policy=None, max_bytes=None):
+        super().__init__(policy, max_bytes)
+        self.transport = transport
+        # True if the transport encrypts the connection with TLS
+        self.encrypted = transport.get_extra_info('ssl_object') is not None
+        self.paused = False
+        self.flush_scheduled = False
+
+    # Queue encoded message to be written to the transport without blocking the event loop
+    # Takes bytes or Tuple of bytes-like parts as argument
+    def send(self, data):
+        if self.closed:
+            return 0
+        size = framing.frame_size(data)
+        if self.paused and self.queued_bytes + size > self.max_bytes:
+            if self.policy == 'drop_oldest':
+                self.drop_oldest(size)
+            elif self.policy == 'disconnect':
+                self.record_dropped(len(self.frames) + 1)
+                self.abort()
+                return 0
+        self.append_frame(data, size)
+        if not self.paused and not self.flush_scheduled:
+            self.flush_scheduled = True
+            asyncio.get_running_loop().call_soon(self.flush)
+        return size
+
+    # Write every queued message to the transport in one call
+    def flush(self):
+        self.flush_scheduled = False
+        if self.frames and not self.paused:
+            self.write_batch()
+
+    # Remove every queued message and write it to the transport
+    # An encrypted transport encrypts each buffer it is given as a separate TLS record, so the buffers are joined
+    def write_batch(self):
+        buffers = send_queue.batch_buffers(self.take_batch())
+        if self.encrypted:
+            self.transport.write(b''.join(buffers))
+        else:
+            self.transport.writelines(buffers)
+
+    # Compress every message queued from now on, after the messages already queued and the given message
+    # Takes bytes or None as argument
+    def begin_compression(self, frame=None):
+        if frame is not None:
+            self.send(frame)
+        super().begin_compression()
+
+    # End a compressed connection's stream before it is handed over to a new server process
+    # Any message sent after the stream has ended starts a new stream
+    # Returns False if the end of the stream could not be written to the socket at once
+    def finish_compression(self):
+        if self.compressor is not None:
+            self.transport.write(stream_compression.finish(self.compressor))
+            self.compressor = stream_compression.new_compressor()
+        return self.transport.get_write_buffer_size() == 0
+
+    # Called when the transport's write buffer is full
+    def pause_writing(self):
+        self.paused = True
+
+    # Called when the transport's write buffer has drained
+    def resume_writing(self):
+        self.paused = False
+        self.flush()
+
+    # Write any queued messages and then close the connection once the transport has sent them
+    def close(self):
+        if self.frames:
+            self.write_batch()
+        self.closed = True
+        self.transport.close()
+
+    # Close the connection immediately and discard any queued messages
+    def abort(self):
+        self.frames.clear()
+        self.queued_bytes = 0
+        self.closed = True
+        self.transport.abort()
+
+# One protocol object is created for each client TCP connection
+# All connections are served by the same event loop, so no threads or tasks are started per client
+# The event loop receives bytes directly into the connection's FrameReader buffer
+class IRCProtocol(asyncio.BufferedProtocol):
+    __slots__ = ('connection', 'client', 'reader', 'pending', 'limiter', 'compression')
+
+    def __init__(self):
+        self.connection = None
+        self.client = None
+        # Buffers bytes received from the client until complete messages have arrived
+        self.reader = framing.FrameReader()
+        # Messages received while the user name is being claimed from the other worker processes,
+        # or while the users handed over by the old server are being adopted
+        # None when no claim is in progress
+        self.pending = None
+        # Limits NAME attempts, since the client's own limits only start once it has registered
+        self.limiter = ratelimit.new_limiter()
+        # Compression algorithm the client asked for in its NAME message
+        self.compression = ''
+
+    # An encrypted connection is only made once its TLS handshake has finished
+    def connection_made(self, transport):
+        self.connection = TransportSocket(transport)
+        open_protocols.add(self)
+        print('Connected with {}'.format(str(transport.get_extra_info('peername'))))
+        metrics.connections.inc()
+        if self.connection.encrypted:
+            server.record_handshake(transport.get_extra_info('ssl_object'))
+
+    # Returns the buffer the event loop receives the next bytes from the client into
+    # Takes Integer as argument
+    def get_buffer(self, sizehint):
+        return self.reader.get_buffer()
+
+    # Handles every complete message in the bytes received from the client
+    # Takes Integer as argument
+    def buffer_updated(self, nbytes):
+        try:
+            self.reader.received(nbytes)
+            self.handle_messages(self.reader.drain())
+
+        # End connection if unexpected error occurs
+        except Exception as E:
+            print('Unexpected Error: Connection has closed')
+            print(E)
+            self.close()
+
+    # Handles each message in a list of messages from the client in order
+    # Takes List of bytes as argument
+    def handle_messages(self, frames):
+        for index, frame in enumerate(frames):
+            # Hold later messages until the user name claim has been answered
+            if self.pending is not None:
+                self.pending.extend(frames[index:])
+                return
+            if not self.handle_message(frame):
+                return
+
+    # Parses message from client and passes it to the handler used by the threaded server
+    # Returns False once the client has quit and no more messages should be handled
+    # Takes bytes as argument
+    def handle_message(self, frame):
+        metrics.received_bytes.inc(len(frame) + 1)
+        message = protocol.parse_server_message(frame)
+
+        # Server must receive user name from client as to finish initializing connection
+        if self.client is None:
+            if self.limiter is not None and not self.limiter.allow(type(message)):
+                if server.refuse_message(self.connection, self.limiter):
+                    return True
+                self.connection.close()
+                return False
+            name_check = server.validate_name_message(message)
+            if name_check != True:
+                server.send_message(self.connection, name_check)
+                return True
+            self.compression = tls.allowed_compression(message.compression, self.connection.encrypted)
+            # User names must be unique across every worker process when the server runs as a cluster
+            if server.cluster is not None:
+                self.pending = []
+                server.cluster.claim(message.user_name, self.claim_finished)
+            else:
+                self.register(message.user_name)
+            return True
+        return server.dispatch_message(self.client, message)
+
+    # Add client to the list of connected clients, or tell the client its user name is taken
+    # Returns True if the client was registered
+    # Takes String as argument
+    def register(self, chat_name):
+        self.client = server.register_client(self.connection, chat_name, self.compression)
+        if self.client is None:
+            msg = 'ERROR:105:Username already in use'
+            server.send_message(self.connection, msg)
+            return False
+        return True
+
+    # Called by the cluster bus once the other worker processes have answered a user name claim
+    # Takes String and Boolean as arguments
+    def claim_finished(self, chat_name, granted):
+        pending = self.pending
+        self.pending = None
+        if self.connection.closed:
+            if granted:
+                server.cluster.user_left(chat_name)
+            return
+
+        if not granted:
+            msg = 'ERROR:105:Username already in use'
+            server.send_message(self.connection, msg)
+        elif not self.register(chat_name):
+            server.cluster.user_left(chat_name)
+
+        try:
+            self.handle_messages(pending)
+        # End connection if unexpected error occurs
+        except Exception as E:
+            print('Unexpected Error: Connection has closed')
+            print(E)
+            self.close()
+
+    def connection_lost(self, exc):
+        open_protocols.discard(self)
+        self.close()
+
+    def pause_writing(self):
+        self.connection.pause_writing()
+
+    def resume_writing(self):
+        self.connection.resume_writing()
+
+    # Continue serving a connection handed over by the server this process took over from
+    # Its messages are held until resume() is called
+    # Takes String, List of Strings, and String as arguments
+    def adopt(self, user_name, room_names, compression):
+        if user_name:
+            self.client = server.adopt_client(self.connection, user_name, room_names, compression)
+            if self.client is None:
+                server.send_message(self.connection, 'ERROR:105:Username already in use')
+
+    # Handle the messages held while the users handed over by the old server were adopted, in the order received
+    def resume(self):
+        frames = self.pending + self.reader.drain()
+        self.pending = None
+        try:
+            self.handle_messages(frames)
+        # End connection if unexpected error occurs
+        except Exception as E:
+            print('Unexpected Error: Connection has closed')
+            print(E)
+            self.close()
+
+    # Returns True if messages queued for the client have not all been written to its socket yet
+    def unsent(self):
+        return bool(self.connection.frames) or self.connection.transport.get_write_buffer_size() > 0
+
+    # Hand the connection over to the new server process, with the user's chat rooms and the bytes received from
+    # the client that do not form a complete message yet
+    # This process's copy of the socket is closed without ending the connection, which the new server now holds
+    # An encrypted connection's TLS session is held by this process and cannot be handed over, so the connection
+    # is closed and the client reconnects to the new server
+    # Takes socket object connected to the new server as argument
+    def hand_over(self, link):
+        transport = self.connection.transport
+        if transport.is_closing():
+            return
+        # Messages that could not be written before the drain timed out would be cut off, so the connection is closed
+        if self.connection.encrypted or self.unsent() or not self.connection.finish_compression():
+            self.close()
+            return
+        user_name = ''
+        room_names = []
+        if self.client is not None:
+            user_name = self.client.user_name
+            room_names = server.release_client(self.client)
+            self.client = None
+        compression = stream_compression.ALGORITHM if self.connection.compressor is not None else ''
+        handoff.send_client(link, transport.get_extra_info('socket'), user_name, room_names,
+                            self.reader.unread_bytes(), compression)
+        self.connection.abort()
+
+    # Remove client from server state if it has not already been removed by a QUIT message or keepalive timeout
+    def close(self):
+        if self.client is None:
+            self.connection.close()
+        elif self.client.alive:
+            server.close_connection(self.client)
+
+# ==============================================================================================
+#                               Connection Maintenance Functions
+# ==============================================================================================
+
+# Function runs one pass of the server's keepalive scheduler and schedules the next pass
+# A single timer on the event loop replaces the keepalive thread used by the threaded server
+def keep_alive_tick(loop):
+    try:
+        server.keep_alive.tick()
+    # Keep serving other clients if handling one client's timer fails
+    except Exception as E:
+        print('Unexpected Error: Keepalive check failed')
+        print(E)
+    loop.call_later(keepalive.TICK, keep_alive_tick, loop)
+
+# ==============================================================================================
+#                                       Restart Handoff
+# ==============================================================================================
+
+# Wait for a new server process to connect to the handoff socket, then hand every connection over to it
+# Takes handoff socket object, asyncio Server, metrics endpoint, and Future resolved once done as arguments
+async def wait_for_takeover(handoff_listener, listener, endpoint, handed_over):
+    loop = asyncio.get_running_loop()
+    while True:
+        link, address = await loop.sock_accept(handoff_listener)
+        if handoff.trusted_peer(link) and await loop.sock_recv(link, len(handoff.TAKEOVER)) == handoff.TAKEOVER:
+            break
+        link.close()
+    handoff_listener.close()
+    link.setblocking(True)
+    try:
+        await drain_connections(link, listener, endpoint)
+
+    # Connections that were not handed over are closed when the server stops
+    except Exception as E:
+        print('Unexpected Error: Connections could not be handed over')
+        print(E)
+    handed_over.set_result(True)
+
+# Hand every connection over to the new server process
+# Reading stops on every connection at once, and each connection is handed over once the messages queued for it
+# have been written, so no message is handled by both servers or lost between them
+# The listening socket is handed over last, and connection requests made meanwhile wait in its backlog
+# Takes socket object connected to the new server, asyncio Server, and metrics endpoint as arguments
+async def drain_connections(link, listener, endpoint):
+    loop = asyncio.get_running_loop()
+    print('Handing connections over to a new server process...')
+    started = loop.time()
+    # Stop accepting connections, keeping a copy of the listening socket for the new server
+    listening_socket = socket.socket(fileno = os.dup(listener.sockets[0].fileno()))
+    listener.close()
+
+    protocols = list(open_protocols)
+    for irc_protocol in protocols:
+        irc_protocol.connection.transport.pause_reading()
+    deadline = started + handoff.DRAIN_TIMEOUT
+    while loop.time() < deadline and any(irc_protocol.unsent() for irc_protocol in protocols):
+        await asyncio.sleep(0.01)
+
+    server.send_chat_state(link)
+    for irc_protocol in protocols:
+        irc_protocol.hand_over(link)
+    server.finish_handoff(link, listening_socket, endpoint)
+    listening_socket.close()
+    print('Handed {} connections over in {:.3f} seconds'.format(len(protocols), loop.time() - started))
+
+# ==============================================================================================
+#                                       Server Program
+# ==============================================================================================
+
+# Serve clients until the program is stopped or hands its connections over to a new server process
+# The address and backlog default to the settings in server.py
+# Worker processes of a cluster pass True so they can all listen on the same port,
+# and each passes its own port for the metrics endpoint and its own message log directory
+# The server only takes over from, and hands over to, another server on the handoff socket at the given path,
+# which servers that share their clients with other processes leave out, since their connections cannot be handed over
+# Metrics and the message log are left out when passed None
+# Clients are served over TLS with the given certificate and key files, or over plain TCP when passed None
+# Takes String, Integer, Integer, Boolean, Integer or None, String or None, String or None, String or None,
+# and String or None as arguments
+async def main(host=None, port=None, backlog=None, reuse_port=False, metrics_port=metrics.METRICS_PORT,
+               log_directory=message_log.LOG_DIRECTORY, handoff_path=None,
+               cert_file=tls.CERT_FILE, key_file=tls.KEY_FILE):
+    host = server.HOST if host is None else host
+    port = server.PORT if port is None else port
+    backlog = server.BACKLOG if backlog is None else backlog
+    # The event loop runs the TLS handshake of each new connection before the connection is made
+    encryption = {}
+    if cert_file is not None:
+        encryption = {'ssl': tls.server_context(cert_file, key_file), 'ssl_handshake_timeout': tls.HANDSHAKE_TIMEOUT}
+
+    # Take over the listening socket and connections of a server that is already running, if there is one
+    takeover = None
+    if handoff_path is not None:
+        link = handoff.request_takeover(handoff_path)
+        if link is not None:
+            takeover = server.take_over(link)
+
+    if log_directory is not None:
+        server.open_message_log(log_directory)
+
+    loop = asyncio.get_running_loop()
+    if takeover is None:
+        listener = await loop.create_server(IRCProtocol, host, port, backlog = backlog, reuse_port = reuse_port,
+                                            **encryption)
+    else:
+        listening_socket, connections = takeover
+        listener = await loop.create_server(IRCProtocol, sock = listening_socket, backlog = backlog, **encryption)
+        # Every handed over user is returned to their chat rooms before any of their messages are handled,
+        # so a message sent during the handoff reaches every member of its room
+        adopted = []
+        for connection, user_name, room_names, unread, compression in connections:
+            irc_protocol = IRCProtocol()
+            irc_protocol.pending = []
+            irc_protocol.reader.feed(unread)
+            await loop.connect_accepted_socket(lambda irc_protocol=irc_protocol: irc_protocol, connection)
+            irc_protocol.adopt(user_name, room_names, compression)
+            adopted.append(irc_protocol)
+        for irc_protocol in adopted:
+            irc_protocol.resume()
+    print('IRC Server is listening...')
+    endpoint = None
+    if metrics_port is not None:
+        endpoint = metrics.start_endpoint(port = metrics_port)
+
+    # Resolved once a new server process has taken over from this one
+    handed_over = loop.create_future()
+    # The event loop only keeps a weak reference to a task, so the task waiting for a takeover is held here
+    # until the server stops
+    takeover_task = None
+    if handoff_path is not None:
+        handoff_listener = handoff.open_handoff(handoff_path)
+        handoff_listener.setblocking(False)
+        takeover_task = loop.create_task(wait_for_takeover(handoff_listener, listener, endpoint, handed_over))
+
+    loop.call_later(keepalive.TICK, keep_alive_tick, loop)
+    try:
+        async with listener:
+            await handed_over
+    finally:
+        # A server stopped before any takeover stops waiting for one and closes its handoff socket
+        if takeover_task is not None and not takeover_task.done():
+            takeover_task.cancel()
+            handoff_listener.close()
+        server.close_all_connections()
+        server.close_message_log()
+
+if __name__ == '__main__':
+    parser = server.argument_parser('Run the asyncio IRC server')
+    parser.add_argument('--handoff-path',
+                        help='Unix socket a new server process takes over from, or an empty string for none, '
+                             'defaults to a path for the user and port')
+    args = parser.parse_args()
+    try:
+        asyncio.run(main(args.host, args.port, args.backlog, metrics_port = args.metrics_port,
+                         handoff_path = handoff.command_line_path(args.handoff_path, args.port),
+                         cert_file = args.certfile, key_file = args.keyfile))
+
+    # End program if unexpected error occurs
+    except BaseException as E:
+        print('Unexpected Error: All connections have closed')
+        print(E)
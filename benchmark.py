@@ -0,0 +1,1596 @@
+import collections
+import contextlib
+import gc
+import io
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import os
+import threading
+import time
+import tracemalloc
+import zlib
+import client
+import framing
+import history
+import keepalive
+import loadgen
+import message_log
+import metrics
+import offline
+import protocol
+import ratelimit
+import server
+import stream_compression
+import tls
+import utilities
+
+# ==============================================================================================
+#                                    Benchmark Settings
+# ==============================================================================================
+
+# Number of users connected to the server during each benchmark
+USER_COUNT = 5000
+# Room sizes measured by the broadcast benchmark
+ROOM_SIZES = [1, 10, 100, 500, 1000, 5000]
+# Seconds each measurement runs for
+DURATION = 1.0
+# Numbers of connected clients measured by the keepalive benchmark
+KEEP_ALIVE_CLIENT_COUNTS = [1000, 10000, 100000]
+# Number of handler threads and chat rooms used by the concurrency stress test
+STRESS_THREADS = 32
+STRESS_ROOMS = 64
+# Number of times each parser is measured by the parser benchmark
+PARSE_ROUNDS = 7
+# Messages parsed by the parser benchmark, in the proportions a busy server receives them
+PARSE_FRAMES = [
+    b'STILL_ALIVE',
+    b'MESSAGE:general:The quick brown fox jumps over the lazy dog',
+    b'MESSAGE:general:Meeting moved to 10:30, see you there',
+    b'MESSAGE:random:' + b'x' * 400,
+    b'MESSAGE_USER:user42:Are you free at 12:15?',
+    b'JOIN:general',
+    b'USERS:general',
+    b'LEAVE:random',
+    b'ROOMS'
+]
+# Message body sizes and room size measured by the allocation benchmark
+RELAY_BODY_SIZES = [40, 450]
+RELAY_ROOM_SIZE = 100
+# Number of chat rooms, messages sent to each room, and total history limit used by the history benchmark
+HISTORY_ROOMS = 5000
+HISTORY_MESSAGES = 100
+HISTORY_LIMIT = 8 * 1024 * 1024
+# Members of the chat room measured by the message log benchmark, and the chat rooms its logs are spread over
+LOG_ROOM_SIZE = 10
+LOG_ROOMS = 20
+# Logs recovered by the message log benchmark, as Tuples of (number of messages, number of segments)
+LOG_RECOVERY_CASES = [(25000, 8), (100000, 8), (400000, 8), (100000, 2), (100000, 32)]
+# Disconnected users, messages kept for each, and memory limit used by the offline message benchmark
+OFFLINE_USERS = 2000
+OFFLINE_MESSAGES = 50
+OFFLINE_LIMIT = 1024 * 1024
+# Members of the chat room a client floods in the rate limit benchmark, and messages it tries to send
+SPAM_ROOM_SIZE = 1000
+SPAM_MESSAGES = 100000
+# Chat rooms and members of the largest room listed by the listing benchmark
+LISTING_ROOMS = 100000
+LISTING_ROOM_SIZE = 5000
+# Chat rooms a bot rejoins and users it sends one private message to in the batched command benchmark
+BATCH_ROOMS = 500
+BATCH_RECIPIENTS = 100
+# Client objects measured by the memory benchmark, and the real idle connections opened to each server program
+MEMORY_CONNECTIONS = 100000
+MEMORY_SOCKETS = 2000
+# Chat messages compressed by the compression benchmark, the numbers of messages written to a connection at once,
+# and the compressor settings compared, as Tuples of (level, window bits, memory level)
+COMPRESSION_MESSAGES = 20000
+COMPRESSION_BATCHES = [1, 10]
+COMPRESSION_SETTINGS = [(1, 12, 5), (6, 12, 5), (9, 12, 5), (6, 15, 8)]
+# Servers started and stopped one after another in this process by the startup benchmark,
+# and server processes started for each server program
+STARTUP_SERVERS = 200
+STARTUP_PROCESSES = 10
+STARTUP_PROGRAMS = ['server.py', 'async_server.py']
+# Connections opened one after another for each kind of connection measured by the TLS benchmark,
+# chat messages each client echoes through the server in each round, their body sizes, and the server programs measured
+TLS_CONNECTIONS = 200
+TLS_MESSAGES = 20000
+TLS_BODY_SIZES = [40, 450]
+TLS_PROGRAMS = ['server.py', 'async_server.py']
+# Certificate keys compared by the TLS benchmark, from tls.KEY_OPTIONS
+TLS_KEY_TYPES = ['ec', 'rsa']
+# Clients that lose their connection when the server restarts in the reconnect benchmark, chat rooms each client
+# rejoins, and the server programs measured
+RECONNECT_CLIENTS = 1000
+RECONNECT_ROOMS = 10
+RECONNECT_PROGRAMS = ['server.py', 'async_server.py']
+# Server programs measured by the load benchmark, and the load test settings that differ from loadgen.py's
+LOAD_SERVERS = ['async_server.py', 'server.py']
+LOAD_SETTINGS = {'clients': 500, 'rooms': 25, 'duration': 5.0}
+# Servers linked on this machine by the federation benchmark, and the users connected to each server
+FEDERATION_NODES = 3
+FEDERATION_USERS = 50
+# Numbers of worker processes measured by the cluster benchmark, and the load test settings that differ from
+# loadgen.py's
+CLUSTER_WORKERS = [1, 2, 4]
+CLUSTER_SETTINGS = {'clients': 400, 'rooms': 200, 'message_rate': 20.0, 'duration': 5.0}
+
+# ==============================================================================================
+#                                    Benchmark Helpers
+# ==============================================================================================
+
+# Stands in for a client socket so the message handlers can be measured without network overhead
+# Counts the frames and bytes that would have been written to the connection
+class NullSocket:
+    __slots__ = ('frames', 'bytes', 'queued_bytes')
+
+    def __init__(self):
+        self.frames = 0
+        self.bytes = 0
+        # Frames are counted instead of queued, so nothing ever waits to be written
+        self.queued_bytes = 0
+
+    def send(self, data):
+        size = framing.frame_size(data)
+        self.frames += 1
+        self.bytes += size
+        return size
+
+    def close(self):
+        pass
+
+# Remove all users and chat rooms from the server state
+def reset_server_state():
+    server.clients.clear()
+    server.chat_rooms.clear()
+    server.sorted_room_names.clear()
+    server.rooms_pages = None
+
+# Register the requested number of users with the server
+# Users are not rate limited, so benchmarks measure handling every message they send
+# Returns List of Connection objects
+# Takes Integer as argument
+def register_users(count):
+    users = []
+    for index in range(count):
+        client = server.Connection(NullSocket(), 'user{}'.format(index))
+        client.limiter = None
+        server.add_client(client)
+        users.append(client)
+    return users
+
+# Call a function repeatedly for the benchmark duration
+# Returns the number of calls made per second
+# Takes a function as argument
+def calls_per_second(function):
+    calls = 0
+    start = time.perf_counter()
+    deadline = start + DURATION
+    while True:
+        # Check the clock in batches so timing does not dominate cheap calls
+        for _ in range(10):
+            function()
+        calls += 10
+        now = time.perf_counter()
+        if now >= deadline:
+            return calls / (now - start)
+
+# ==============================================================================================
+#                                       Benchmarks
+# ==============================================================================================
+
+# Measures how many MESSAGE commands per second chat_msg_handler can broadcast for each room size
+def benchmark_broadcast():
+    print('Broadcast fan-out ({} connected users)'.format(USER_COUNT))
+    print('{:>10} {:>15} {:>18}'.format('room size', 'messages/sec', 'deliveries/sec'))
+
+    for room_size in ROOM_SIZES:
+        reset_server_state()
+        users = register_users(max(USER_COUNT, room_size))
+        for user in users[:room_size]:
+            server.join_msg_handler(user, protocol.Join([('bench',)]))
+
+        sender = users[0]
+        message = protocol.ChatMessage(['bench', b'The quick brown fox jumps over the lazy dog'])
+        rate = calls_per_second(lambda: server.chat_msg_handler(sender, message))
+        print('{:>10} {:>15,.0f} {:>18,.0f}'.format(room_size, rate, rate * room_size))
+
+    reset_server_state()
+
+# Measures the time spent in each keepalive scheduler tick as the number of connected clients grows
+# Clients connect at evenly spaced times and keep sending STILL_ALIVE messages, so none of them time out
+def benchmark_keep_alive():
+    print('Keepalive scheduler ticks')
+    print('{:>10} {:>15} {:>15} {:>18}'.format('clients', 'mean tick ms', 'max tick ms', 'heartbeats/tick'))
+
+    for count in KEEP_ALIVE_CLIENT_COUNTS:
+        reset_server_state()
+        start = time.monotonic()
+        scheduler = keepalive.KeepAliveScheduler(server.close_connection)
+        users = register_users(count)
+
+        # Spread client connections across one keepalive interval
+        ticks_per_interval = int(keepalive.KEEP_ALIVE_INTERVAL / keepalive.TICK)
+        for index, user in enumerate(users):
+            connect_tick = index * ticks_per_interval // count
+            user.timestamp = start + connect_tick * keepalive.TICK
+            scheduler.wheel.schedule(user.timestamp + scheduler.interval, (keepalive.SEND_TIMER, user))
+            scheduler.wheel.schedule(user.timestamp + scheduler.window, (keepalive.VERIFY_TIMER, user))
+
+        # Simulate several keepalive windows, refreshing client timestamps as if STILL_ALIVE messages arrived
+        durations = []
+        tick_count = 4 * int(keepalive.KEEP_ALIVE_WINDOW / keepalive.TICK)
+        for tick in range(1, tick_count + 1):
+            now = start + tick * keepalive.TICK
+            for user in users[tick % ticks_per_interval::ticks_per_interval]:
+                user.timestamp = now
+            tick_start = time.perf_counter()
+            scheduler.tick(now)
+            durations.append(time.perf_counter() - tick_start)
+
+        heartbeats = sum(user.socket.frames for user in users) / tick_count
+        print('{:>10,} {:>15.3f} {:>15.3f} {:>18,.0f}'.format(
+            count, 1000 * sum(durations) / len(durations), 1000 * max(durations), heartbeats))
+
+    reset_server_state()
+
+# Handlers as they were before the command tables in protocol.py, with each handler validating its own fields
+# and doing no other work
+# Returns the fields the handler would have used, or String with error message
+# Takes Connection object and List of Strings as arguments
+def split_room_handler(client, message):
+    room_name = message[-1]
+    param_check = utilities.validate_param_semantics(room_name)
+    if param_check != True:
+        return param_check
+    return room_name
+
+def split_body_handler(client, message):
+    target = message[1]
+    param_check = utilities.validate_param_semantics(target)
+    if param_check != True:
+        return param_check
+
+    if len(message) > 3:
+        message_body = ':'.join(message[2:])
+    else:
+        message_body = message[2]
+    payload_check = utilities.validate_payload_semantics(message_body)
+    if payload_check != True:
+        return payload_check
+    return target, message_body
+
+# Dispatches a message the way dispatch_message() did before the command tables in protocol.py
+# Takes Connection object, List of Strings, and String as arguments
+def split_dispatch(client, message, command):
+    command_check = utilities.validate_command_semantics(command)
+    if command_check != True:
+        return command_check
+
+    match command:
+        case 'STILL_ALIVE':
+            return None
+        case 'JOIN':
+            return split_room_handler(client, message)
+        case 'ROOMS':
+            return None
+        case 'USERS':
+            return split_room_handler(client, message)
+        case 'LEAVE':
+            return split_room_handler(client, message)
+        case 'MESSAGE':
+            return split_body_handler(client, message)
+        case 'MESSAGE_USER':
+            return split_body_handler(client, message)
+        case 'QUIT':
+            return None
+        case _:
+            return 'ERROR:100:Command is not included in the list of approved commands'
+
+# Measures how many messages per second can be parsed, validated, and dispatched to a handler
+# by the command tables in protocol.py, compared with splitting every message and matching its command
+def benchmark_parse():
+    print('Message parsing and dispatch ({} message mix)'.format(len(PARSE_FRAMES)))
+    print('{:>18} {:>15}'.format('parser', 'messages/sec'))
+
+    # Handlers do no work so only parsing and dispatch are measured
+    handlers = dict.fromkeys(server.MESSAGE_HANDLERS, lambda client, message: None)
+    frames = PARSE_FRAMES
+    parse_message = protocol.parse_server_message
+
+    def command_table():
+        for frame in frames:
+            message = parse_message(frame)
+            handlers[type(message)](None, message)
+
+    def split_match():
+        for frame in frames:
+            message = frame.decode().split(':')
+            split_dispatch(None, message, message[0])
+
+    # Alternate the parsers and keep the best round of each so load from other programs affects both equally
+    baseline = 0
+    rate = 0
+    for _ in range(PARSE_ROUNDS):
+        baseline = max(baseline, calls_per_second(split_match) * len(frames))
+        rate = max(rate, calls_per_second(command_table) * len(frames))
+    print('{:>18} {:>15,.0f}'.format('split and match', baseline))
+    print('{:>18} {:>15,.0f}'.format('command table', rate))
+    print('{:.2f}x messages/sec'.format(rate / baseline))
+
+# Relays a chat message the way the server did before messages were kept as bytes:
+# the received bytes were buffered, decoded, split on every colon, rejoined, formatted, and encoded again
+# Takes bytes and Connection object as arguments
+def split_relay(data, client):
+    buffer = bytearray()
+    buffer += data
+    message = buffer[:-len(framing.DELIMITER)].decode().split(':')
+    room_name = message[1]
+    if utilities.validate_param_semantics(room_name) != True:
+        return
+    if len(message) > 3:
+        message_body = ':'.join(message[2:])
+    else:
+        message_body = message[2]
+    if utilities.validate_payload_semantics(message_body) != True:
+        return
+
+    room = server.find_chat_room(room_name)
+    with room.lock:
+        recipients = tuple(room.members.values())
+    msg = 'MESSAGE:{}:{}:{}'.format(room_name, client.user_name, message_body)
+    server.broadcast_message(recipients, msg)
+
+# Relays a chat message through the server's receive buffer, parser, and message handler
+# Takes FrameReader object, bytes, and Connection object as arguments
+def bytes_relay(reader, data, client):
+    # Copying into the reader's buffer stands in for the socket receiving directly into it
+    reader.get_buffer()[:len(data)] = data
+    reader.received(len(data))
+    server.dispatch_message(client, protocol.parse_server_message(reader.frames.popleft()))
+
+# Returns the most memory in bytes allocated at once while a function runs, averaged over several calls
+# Takes a function as argument
+def peak_allocation(function):
+    calls = 200
+    total = 0
+    tracemalloc.start()
+    for _ in range(calls):
+        tracemalloc.reset_peak()
+        current = tracemalloc.get_traced_memory()[0]
+        function()
+        total += tracemalloc.get_traced_memory()[1] - current
+    tracemalloc.stop()
+    return total / calls
+
+# Measures the memory allocated while relaying one chat message to a room, with the message kept as bytes
+# compared with decoding and re-encoding it
+def benchmark_allocations():
+    print('Memory allocated per relayed message (room of {})'.format(RELAY_ROOM_SIZE))
+    print('{:>10} {:>18} {:>18}'.format('body size', 'decode and encode', 'bytes pipeline'))
+
+    reset_server_state()
+    users = register_users(RELAY_ROOM_SIZE)
+    for user in users:
+        server.join_msg_handler(user, protocol.Join([('bench',)]))
+    sender = users[0]
+    reader = framing.FrameReader()
+
+    for size in RELAY_BODY_SIZES:
+        # Body contains a colon, as times and links in chat messages do
+        data = 'MESSAGE:bench:at 10:30 {}\n'.format('x' * (size - 9)).encode()
+        baseline = peak_allocation(lambda: split_relay(data, sender))
+        pipeline = peak_allocation(lambda: bytes_relay(reader, data, sender))
+        print('{:>10} {:>16,.0f} B {:>16,.0f} B'.format(size, baseline, pipeline))
+
+    reset_server_state()
+
+# Check that the clients and chat rooms dictionaries agree with each other
+# Returns List of Strings describing each inconsistency found
+def find_state_violations():
+    violations = []
+    for user_name, user in server.clients.items():
+        if user.user_name != user_name:
+            violations.append('{} is registered under the name {}'.format(user.user_name, user_name))
+        if not user.alive:
+            violations.append('{} is registered but its connection has closed'.format(user_name))
+        for room_name in user.rooms:
+            if server.chat_rooms[room_name].members.get(user_name) is not user:
+                violations.append('{} lists {} but is not one of its members'.format(user_name, room_name))
+
+    for room_name, room in server.chat_rooms.items():
+        for user_name, user in room.members.items():
+            if server.clients.get(user_name) is not user:
+                violations.append('{} has member {} who is not connected'.format(room_name, user_name))
+            elif room_name not in user.rooms:
+                violations.append('{} has member {} who does not list the room'.format(room_name, user_name))
+    return violations
+
+# Runs JOIN, LEAVE, MESSAGE, USERS, ROOMS, and QUIT commands from many threads at once while other threads
+# register clashing user names and time out random clients, then checks the server state is still consistent
+def benchmark_concurrency():
+    print('Concurrency stress test ({} threads, {} rooms)'.format(STRESS_THREADS, STRESS_ROOMS))
+    reset_server_state()
+    room_names = ['room{}'.format(index) for index in range(STRESS_ROOMS)]
+    deadline = time.perf_counter() + 2 * DURATION
+    operations = [0] * STRESS_THREADS
+    errors = []
+
+    # Register a user, retrying while another thread holds the same name
+    def connect(user_name):
+        client = None
+        while client is None and time.perf_counter() < deadline:
+            client = server.register_client(NullSocket(), user_name)
+        # Threads send as fast as they can, so they are not rate limited
+        if client is not None:
+            client.limiter = None
+        return client
+
+    def worker(index):
+        rng = random.Random(index)
+        # Pairs of threads share a user name so registrations race with each other
+        user_name = 'user{}'.format(index // 2)
+        try:
+            client = connect(user_name)
+            while client is not None and time.perf_counter() < deadline:
+                room_name = rng.choice(room_names)
+                match rng.randrange(10):
+                    case 0 | 1 | 2:
+                        message = protocol.Join([(room_name,)])
+                    case 3 | 4:
+                        message = protocol.Leave([(room_name,)])
+                    case 5 | 6:
+                        message = protocol.ChatMessage([room_name, b'stress test message'])
+                    case 7:
+                        message = protocol.Users([room_name, ''])
+                    case 8:
+                        message = protocol.Rooms(('', ''))
+                    case _:
+                        message = protocol.Quit(())
+                if not server.dispatch_message(client, message) or not client.alive:
+                    client = connect(user_name)
+                operations[index] += 1
+        except Exception as E:
+            errors.append('{}: {!r}'.format(user_name, E))
+
+    # Closes random connections as the keepalive scheduler does when a client times out
+    def reaper():
+        rng = random.Random(-1)
+        while time.perf_counter() < deadline:
+            with server.registry_lock:
+                connections = list(server.clients.values())
+            if connections:
+                server.close_connection(rng.choice(connections))
+            time.sleep(0.001)
+
+    threads = [threading.Thread(target=worker, args=(index,)) for index in range(STRESS_THREADS)]
+    threads.append(threading.Thread(target=reaper))
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    elapsed = time.perf_counter() - start
+
+    violations = errors + find_state_violations()
+    print('{:,.0f} commands/sec across all threads'.format(sum(operations) / elapsed))
+    if violations:
+        print('{} inconsistencies found:'.format(len(violations)))
+        for violation in violations[:20]:
+            print(violation)
+    else:
+        print('Server state is consistent')
+
+    reset_server_state()
+    return not violations
+
+# Dispatches a message the way dispatch_message() did before it was instrumented with metrics
+# Takes Connection object and the typed message as arguments
+def uninstrumented_dispatch(client, message):
+    handler = server.MESSAGE_HANDLERS.get(type(message))
+    if handler is not None:
+        return handler(client, message) is not False
+    server.send_message(client.socket, message)
+    return True
+
+# Measures the time metrics add to dispatching each message, where handler latency is timed and messages are
+# counted, and the time to render every metric for one scrape of the metrics endpoint
+def benchmark_metrics():
+    print('Metrics overhead ({} connected users)'.format(USER_COUNT))
+    print('{:>12} {:>18} {:>16} {:>12}'.format('message', 'uninstrumented ns', 'instrumented ns', 'overhead ns'))
+
+    reset_server_state()
+    users = register_users(USER_COUNT)
+    for user in users[:10]:
+        server.join_msg_handler(user, protocol.Join([('bench',)]))
+    sender = users[0]
+    messages = [
+        ('STILL_ALIVE', protocol.StillAlive(())),
+        ('JOIN', protocol.Join([('bench',)])),
+        ('MESSAGE', protocol.ChatMessage(['bench', b'The quick brown fox jumps over the lazy dog']))
+    ]
+
+    for name, message in messages:
+        # Alternate the measurements and keep the best round of each so load from other programs affects both equally
+        baseline = 0
+        rate = 0
+        for _ in range(PARSE_ROUNDS):
+            baseline = max(baseline, calls_per_second(lambda: uninstrumented_dispatch(sender, message)))
+            rate = max(rate, calls_per_second(lambda: server.dispatch_message(sender, message)))
+        print('{:>12} {:>18,.0f} {:>16,.0f} {:>12,.0f}'.format(name, 1e9 / baseline, 1e9 / rate,
+                                                               1e9 / rate - 1e9 / baseline))
+
+    start = time.perf_counter()
+    text = metrics.render()
+    print('Rendering {:,} bytes of metrics took {:.2f} ms'.format(len(text), 1000 * (time.perf_counter() - start)))
+    reset_server_state()
+
+# Records chat messages to thousands of rooms with a total history limit smaller than every room's own limit
+# together, then checks the memory allocated for the histories stays within the limit
+def benchmark_history():
+    print('Room history ({:,} rooms, {} messages each, {:,} byte limit)'.format(
+        HISTORY_ROOMS, HISTORY_MESSAGES, HISTORY_LIMIT))
+    room_names = ['room{}'.format(index) for index in range(HISTORY_ROOMS)]
+    frame = server.relay_frame('MESSAGE:room:user42:', b'The quick brown fox jumps over the lazy dog')
+
+    # Time recording without tracing allocations, then trace allocations while recording the same messages again
+    store = history.HistoryStore(max_bytes = HISTORY_LIMIT)
+    start = time.perf_counter()
+    for _ in range(HISTORY_MESSAGES):
+        for room_name in room_names:
+            store.record(room_name, frame)
+    elapsed = time.perf_counter() - start
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    store = history.HistoryStore(max_bytes = HISTORY_LIMIT)
+    for _ in range(HISTORY_MESSAGES):
+        for room_name in room_names:
+            store.record(room_name, frame)
+    allocated = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+
+    replay_start = time.perf_counter()
+    for room_name in room_names:
+        store.recent(room_name, history.REPLAY_LENGTH)
+    replay_time = (time.perf_counter() - replay_start) / len(room_names)
+
+    print('{:,.0f} messages recorded/sec, {:.1f} us to copy {} messages for a replay'.format(
+        HISTORY_ROOMS * HISTORY_MESSAGES / elapsed, 1e6 * replay_time, history.REPLAY_LENGTH))
+    print('{:,} rooms kept, {:,} bytes counted, {:,} bytes allocated'.format(
+        store.room_count(), store.total_bytes, allocated))
+    # Allocations may exceed the counted bytes by the ordered dictionary's spare capacity
+    bounded = store.total_bytes <= HISTORY_LIMIT and allocated <= 1.25 * HISTORY_LIMIT
+    print('History memory is bounded' if bounded else 'History memory exceeded its limit')
+    return bounded
+
+# Keeps messages for thousands of disconnected users with a memory limit far below their total size,
+# then checks memory stayed within the limit and every message was delivered in order from memory or disk
+def benchmark_offline():
+    print('Offline messages ({:,} users, {} messages each, {:,} byte memory limit)'.format(
+        OFFLINE_USERS, OFFLINE_MESSAGES, OFFLINE_LIMIT))
+    user_names = ['user{}'.format(index) for index in range(OFFLINE_USERS)]
+
+    with tempfile.TemporaryDirectory() as directory:
+        store = offline.OfflineStore(max_bytes = OFFLINE_LIMIT, spill_directory = directory)
+        for user_name in user_names:
+            store.user_left(user_name)
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        for index in range(OFFLINE_MESSAGES):
+            for user_name in user_names:
+                store.store(user_name, server.relay_frame('MESSAGE_USER:{}:user42:'.format(user_name),
+                                                          b'message %d' % index))
+        elapsed = time.perf_counter() - start
+        allocated = tracemalloc.get_traced_memory()[0] - before
+        tracemalloc.stop()
+        kept = store.total_bytes
+        spilled = store.spilled_bytes
+
+        start = time.perf_counter()
+        delivered = True
+        for user_name in user_names:
+            frames = store.take(user_name)
+            expected = [b'MESSAGE_USER:%s:user42:message %d\n' % (user_name.encode(), index)
+                        for index in range(OFFLINE_MESSAGES)]
+            delivered = delivered and frames == expected
+        delivery_time = time.perf_counter() - start
+
+    print('{:,.0f} messages kept/sec while spilling, {:.1f} us to deliver each mailbox'.format(
+        OFFLINE_USERS * OFFLINE_MESSAGES / elapsed, 1e6 * delivery_time / OFFLINE_USERS))
+    print('{:,} bytes counted in memory, {:,} bytes allocated, {:,} bytes spilled to disk'.format(
+        kept, allocated, spilled))
+    # Mailboxes themselves are bounded by their number rather than the memory limit
+    bounded = allocated <= 1.25 * OFFLINE_LIMIT + OFFLINE_USERS * offline.MAILBOX_OVERHEAD
+    print('Offline message memory is bounded' if bounded else 'Offline message memory exceeded its limit')
+    print('Every message was delivered in order' if delivered else 'Messages were lost or reordered')
+    return bounded and delivered
+
+# Measures the time a rate limit check adds to each message, then floods a large chat room from one client
+# and checks the limits stopped its fan-out and closed its connection, and that the client's limits were
+# not reset when it reconnected and flooded the room again
+def benchmark_rate_limit():
+    print('Rate limits ({} member room, {:,} messages sent as fast as possible)'.format(
+        SPAM_ROOM_SIZE, SPAM_MESSAGES))
+    limiter = ratelimit.RateLimiter()
+    # Unlimited buckets measure the check itself rather than refusals
+    for bucket in [limiter.connection] + list(limiter.buckets):
+        bucket.rate = bucket.burst = bucket.tokens = float('inf')
+    for name, message_type in [('STILL_ALIVE', protocol.StillAlive), ('MESSAGE', protocol.ChatMessage)]:
+        rate = calls_per_second(lambda: limiter.allow(message_type))
+        print('{:,.0f} ns to check a {} message'.format(1e9 / rate, name))
+
+    reset_server_state()
+    ratelimit.clear()
+    users = register_users(SPAM_ROOM_SIZE)
+    for user in users:
+        server.join_msg_handler(user, protocol.Join([('bench',)]))
+    member = users[1].socket
+    message = protocol.ChatMessage(['bench', b'The quick brown fox jumps over the lazy dog'])
+    chat_rate, chat_burst = ratelimit.CHAT_LIMIT
+
+    # The spammer floods the room, is disconnected, and reconnects with the same user name
+    spammer = users[0]
+    spammer.limiter = ratelimit.RateLimiter(spammer.user_name)
+    results = []
+    for attempt in ('first connection', 'reconnected'):
+        before = member.frames
+        start = time.perf_counter()
+        sent = 0
+        while sent < SPAM_MESSAGES and server.dispatch_message(spammer, message):
+            sent += 1
+        elapsed = time.perf_counter() - start
+        delivered = member.frames - before
+        print('{}: {:,} messages handled or refused in {:.3f} s before the connection closed, '
+              '{:,} delivered to each member'.format(attempt, sent, elapsed, delivered))
+        results.append((spammer.alive, delivered, elapsed))
+        spammer = server.Connection(NullSocket(), spammer.user_name)
+        server.add_client(spammer)
+        server.join_msg_handler(spammer, protocol.Join([('bench',)]))
+    server.close_connection(spammer)
+    reset_server_state()
+    ratelimit.clear()
+
+    (first_alive, first_delivered, first_elapsed), (again_alive, again_delivered, again_elapsed) = results
+    contained = not first_alive and first_delivered <= chat_burst + chat_rate * first_elapsed
+    print('Flood was contained' if contained else 'Flood was not contained')
+    # The reconnected client starts with the tokens its buckets refilled while it was away, rather than a full burst
+    kept = not again_alive and again_delivered <= 1 + chat_rate * (first_elapsed + again_elapsed)
+    print('Limits were kept across the reconnect' if kept else 'Reconnecting reset the limits')
+    return contained and kept
+
+# Measures ROOMS and USERS requests answered from the cached listings against rebuilding the listings for every
+# request, and checks that a huge listing is split into pages that together list every name once
+def benchmark_listings():
+    print('Room and member listings ({:,} rooms, {:,} member room, {} names per page)'.format(
+        LISTING_ROOMS, LISTING_ROOM_SIZE, server.LISTING_PAGE_SIZE))
+    reset_server_state()
+    users = register_users(LISTING_ROOM_SIZE)
+    for user in users:
+        server.join_msg_handler(user, protocol.Join([('bench',)]))
+    for index in range(LISTING_ROOMS - 1):
+        server.create_chat_room('room{:06d}'.format(index))
+    client = users[0]
+    room = server.chat_rooms['bench']
+
+    def uncached_rooms():
+        server.rooms_pages = None
+        server.rooms_msg_handler(client, protocol.Rooms(('', '')))
+
+    def uncached_users():
+        room.users_pages = None
+        server.users_msg_handler(client, protocol.Users(('bench', '')))
+
+    cases = [
+        ('ROOMS, rebuilt', uncached_rooms),
+        ('ROOMS, cached', lambda: server.rooms_msg_handler(client, protocol.Rooms(('', '')))),
+        ('ROOMS with prefix', lambda: server.rooms_msg_handler(client, protocol.Rooms(('room0421', '')))),
+        ('USERS, rebuilt', uncached_users),
+        ('USERS, cached', lambda: server.users_msg_handler(client, protocol.Users(('bench', ''))))
+    ]
+    for name, function in cases:
+        rate = calls_per_second(function)
+        print('{:<20} {:>12,.0f} requests/sec'.format(name, rate))
+
+    # Request every page of the room listing as a client would, following the next page number of each page
+    names = []
+    pages = 0
+    largest = 0
+    page = ''
+    while True:
+        pages += 1
+        before = client.socket.bytes
+        server.rooms_msg_handler(client, protocol.Rooms(('', page)))
+        response = server.rooms_pages[int(page or 1) - 1]
+        largest = max(largest, client.socket.bytes - before)
+        rooms, _, page = protocol.parse_client_message(response[:-1]).rooms.partition(':')
+        names.extend(rooms.split(' '))
+        if not page:
+            break
+    reset_server_state()
+
+    print('{:,} rooms listed on {:,} pages, largest page is {:,} bytes'.format(len(names), pages, largest))
+    complete = len(names) == LISTING_ROOMS and len(set(names)) == LISTING_ROOMS
+    print('Every room was listed once' if complete else 'Rooms were missing from the listing')
+    return complete
+
+# Measures a bot rejoining its chat rooms after reconnecting and sending one private message to many users,
+# with one message for each room or user compared with messages that list up to protocol.MAX_LIST_LENGTH
+# rooms or users, counting the messages sent, the responses received, and the messages a rate limiter refuses
+# when the bot sends them all at once
+def benchmark_batch():
+    print('Batched commands ({} rooms, {} recipients)'.format(BATCH_ROOMS, BATCH_RECIPIENTS))
+    print('{:<22} {:>9} {:>10} {:>8} {:>10}'.format('commands', 'messages', 'responses', 'refused', 'ms'))
+
+    reset_server_state()
+    users = register_users(BATCH_RECIPIENTS + 1)
+    bot = users[0]
+    room_names = ['room{}'.format(index) for index in range(BATCH_ROOMS)]
+    user_names = [user.user_name for user in users[1:]]
+    step = protocol.MAX_LIST_LENGTH
+
+    # Encoded messages naming one room or user each, or listing as many as one message may name
+    def each(command, names, suffix=''):
+        return ['{}:{}{}'.format(command, name, suffix).encode() for name in names]
+
+    def batched(command, names, suffix=''):
+        return ['{}:{}{}'.format(command, ','.join(names[start:start + step]), suffix).encode()
+                for start in range(0, len(names), step)]
+
+    body = ':The quick brown fox jumps over the lazy dog'
+    cases = [
+        ('JOIN each room', each('JOIN', room_names)),
+        ('JOIN batched', batched('JOIN', room_names)),
+        ('MESSAGE_USER each', each('MESSAGE_USER', user_names, body)),
+        ('MESSAGE_USER batched', batched('MESSAGE_USER', user_names, body))
+    ]
+    leave = protocol.Leave([tuple(room_names)])
+    joined = True
+    for name, frames in cases:
+        # Keep the best of several rounds, leaving every room after each round so it is joined again
+        best = float('inf')
+        for _ in range(PARSE_ROUNDS):
+            before = bot.socket.frames
+            start = time.perf_counter()
+            for frame in frames:
+                server.dispatch_message(bot, server.parse_message(frame))
+            best = min(best, time.perf_counter() - start)
+            responses = bot.socket.frames - before
+            joined = joined and (not name.startswith('JOIN') or len(bot.rooms) == BATCH_ROOMS)
+            server.leave_msg_handler(bot, leave)
+
+        limiter = ratelimit.RateLimiter()
+        refused = sum(not limiter.allow(type(protocol.parse_server_message(frame))) for frame in frames)
+        print('{:<22} {:>9,} {:>10,} {:>8,} {:>10.3f}'.format(name, len(frames), responses, refused, 1000 * best))
+    reset_server_state()
+
+    print('Every room was joined' if joined else 'Rooms were missing after rejoining')
+    return joined
+
+# Returns List of encoded chat messages as a busy server relays them, sent by many users to a few chat rooms
+# Message bodies are made of words taken from the comments in server.py, so they compress like English text
+# rather than like random bytes
+# Takes Integer as argument
+def chat_traffic(count):
+    rng = random.Random(0)
+    with open(server.__file__) as file:
+        words = [word for line in file if line.lstrip().startswith('#') for word in line.split()[1:]]
+    frames = []
+    for index in range(count):
+        body = ' '.join(rng.choice(words) for _ in range(rng.randint(3, 25)))
+        frames.append(framing.encode_frame('MESSAGE:room{}:user{}:{}'.format(
+            rng.randrange(10), rng.randrange(1000), body)))
+    return frames
+
+# Measures how much the compression negotiated in the NAME message reduces the bytes written to a connection,
+# and the time and memory it costs, for several compressor settings and numbers of messages written at once
+# Checks that every compressed stream decompresses to the messages that were sent
+def benchmark_compression():
+    frames = chat_traffic(COMPRESSION_MESSAGES)
+    raw_bytes = sum(map(len, frames))
+    print('Connection compression ({:,} chat messages, {:,} bytes uncompressed)'.format(len(frames), raw_bytes))
+    print('{:>6} {:>7} {:>10} {:>6} {:>12} {:>8} {:>12} {:>15}'.format(
+        'level', 'window', 'mem level', 'batch', 'bytes', 'ratio', 'ns/message', 'bytes/compressor'))
+
+    settings = (stream_compression.LEVEL, stream_compression.WINDOW_BITS, stream_compression.MEM_LEVEL)
+    intact = True
+    for level, window_bits, mem_level in COMPRESSION_SETTINGS:
+        stream_compression.LEVEL = level
+        stream_compression.WINDOW_BITS = window_bits
+        stream_compression.MEM_LEVEL = mem_level
+        for batch_size in COMPRESSION_BATCHES:
+            batches = [frames[start:start + batch_size] for start in range(0, len(frames), batch_size)]
+            compressor = stream_compression.new_compressor()
+            start = time.perf_counter()
+            output = [stream_compression.compress(compressor, batch) for batch in batches]
+            elapsed = time.perf_counter() - start
+            # Memory a connection keeps for its compressor once it has sent a few messages
+            tracemalloc.start()
+            kept = stream_compression.new_compressor()
+            for batch in batches[:10]:
+                stream_compression.compress(kept, batch)
+            size = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+
+            compressed_bytes = sum(map(len, output))
+            intact = intact and zlib.decompress(b''.join(output) + stream_compression.finish(compressor)) == b''.join(frames)
+            print('{:>6} {:>7} {:>10} {:>6} {:>12,} {:>8.3f} {:>12,.0f} {:>15,}'.format(
+                level, window_bits, mem_level, batch_size, compressed_bytes, compressed_bytes / raw_bytes,
+                1e9 * elapsed / len(frames), size))
+    stream_compression.LEVEL, stream_compression.WINDOW_BITS, stream_compression.MEM_LEVEL = settings
+
+    print('Every stream decompressed to the messages sent' if intact else 'Compressed streams were corrupted')
+    return intact
+
+# Returns Integer of bytes used by a rate limiter, its user's limits, and their token buckets
+# Takes Rate Limiter object as argument
+def limiter_size(limiter):
+    buckets = (limiter.connection,) + limiter.buckets
+    # Buckets share their creation time until they are first used
+    return (sys.getsizeof(limiter) + sys.getsizeof(limiter.user) + sys.getsizeof(limiter.buckets)
+            + sys.getsizeof(limiter.connection.updated) + sum(sys.getsizeof(bucket) for bucket in buckets))
+
+# Measures the memory the server keeps for each idle connection, with each client stored as a dictionary as it
+# used to be and as a Connection object, and lists what a Connection object's memory is made of
+# Sockets are created before measuring, since their size depends on the server program rather than the client state
+def benchmark_memory():
+    loadgen.raise_file_limit()
+    print('Memory of {:,} idle connections, each registered and in one chat room'.format(MEMORY_SOCKETS))
+    print('{:>22} {:>22}'.format('server', 'KB/connection'))
+    for script in ['server.py', 'async_server.py']:
+        print('{:>22} {:>22.1f}'.format(script, idle_connection_size(script) / 1024))
+    print('Whole server process, including sockets, send queues, message readers, and threads')
+    print('Socket buffers held by the kernel are not counted')
+    print()
+
+    print('Memory of {:,} client objects (Connection object and keepalive timers only, excluding the connection)'.format(
+        MEMORY_CONNECTIONS))
+    print('{:>22} {:>22}'.format('client stored as', 'bytes/connection'))
+
+    def client_dictionary(connection, user_name):
+        return {
+            'user_name': user_name,
+            'socket': connection,
+            'timestamp': time.monotonic(),
+            'alive': True,
+            'rooms': set(),
+            'lock': threading.Lock(),
+            'remote': False,
+            'limiter': ratelimit.new_limiter()
+        }
+
+    results = {}
+    for name, new_client in [('dictionary', client_dictionary), ('Connection object', server.Connection)]:
+        sockets = [NullSocket() for index in range(MEMORY_CONNECTIONS)]
+        user_names = ['user{}'.format(index) for index in range(MEMORY_CONNECTIONS)]
+        clients = {}
+        scheduler = keepalive.KeepAliveScheduler(server.close_connection)
+        gc.collect()
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        for connection, user_name in zip(sockets, user_names):
+            client = new_client(connection, user_name)
+            clients[user_name] = client
+            # Keepalive timers are scheduled by hand, since the scheduler only accepts Connection objects
+            scheduler.wheel.schedule(time.monotonic() + scheduler.interval, (keepalive.SEND_TIMER, client))
+            scheduler.wheel.schedule(time.monotonic() + scheduler.window, (keepalive.VERIFY_TIMER, client))
+        results[name] = (tracemalloc.get_traced_memory()[0] - before) / MEMORY_CONNECTIONS
+        tracemalloc.stop()
+        print('{:>22} {:>22,.0f}'.format(name, results[name]))
+        del sockets, clients, scheduler
+
+    client = server.Connection(NullSocket(), 'user{}'.format(MEMORY_CONNECTIONS))
+    timer = (0, (keepalive.SEND_TIMER, client))
+    parts = [
+        ('Connection object', sys.getsizeof(client)),
+        ('timestamp', sys.getsizeof(client.timestamp)),
+        ('set of rooms', sys.getsizeof(client.rooms)),
+        ('lock', sys.getsizeof(client.lock)),
+        ('rate limiter', limiter_size(client.limiter) if client.limiter is not None else 0),
+        ('keepalive timers', 2 * (sys.getsizeof(timer) + sys.getsizeof(timer[1])))
+    ]
+    print('Connection object parts: {}, user name and dictionary entries not included'.format(
+        ', '.join('{} {:,} bytes'.format(part, size) for part, size in parts)))
+    print('{:.0%} less memory than a dictionary for each client'.format(
+        1 - results['Connection object'] / results['dictionary']))
+
+# Returns Integer of the resident memory of a process in bytes
+# Takes Integer process ID as argument
+def process_memory(pid):
+    with open('/proc/{}/status'.format(pid)) as file:
+        for line in file:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) * 1024
+    return 0
+
+# Open idle connections to a server program started for the test, each registering a user who joins a chat room
+# Rate limits are turned off by spawn_tls_server(), since every connection comes from the same address
+# Returns Float of the bytes the server process grew by for each connection
+# Takes String name of the server program as argument
+def idle_connection_size(script):
+    port = free_port()
+    process = spawn_tls_server(script, port, None, None)
+    sockets = []
+    try:
+        time.sleep(0.5)
+        before = process_memory(process.pid)
+        for index in range(MEMORY_SOCKETS):
+            sock = socket.create_connection(('127.0.0.1', port))
+            sock.sendall(framing.encode_frame('NAME:idle{}'.format(index)) +
+                         framing.encode_frame('JOIN:room{}'.format(index % 50)))
+            sockets.append(sock)
+        # Every user has registered and joined once the server has answered each JOIN
+        for sock in sockets:
+            read_until(framing.FrameReader(sock), b'JOIN_RESPONSE')
+        time.sleep(0.5)
+        return (process_memory(process.pid) - before) / MEMORY_SOCKETS
+    finally:
+        for sock in sockets:
+            sock.close()
+        loadgen.stop_server(process)
+
+# Returns Integer of a local port that no socket is listening on
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+# Returns the median of a List of numbers
+# Takes List as argument
+def median(values):
+    return sorted(values)[len(values) // 2]
+
+# Measures how long a program takes to import the server, how long each server program takes from starting
+# until it accepts connections, and how many servers can be started, serve one client, and stop in one process
+def benchmark_startup():
+    print('Startup (median of {} processes)'.format(STARTUP_PROCESSES))
+    interpreter = []
+    imported = []
+    for index in range(STARTUP_PROCESSES):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', 'pass'], check=True)
+        interpreter.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', 'import server'], check=True)
+        imported.append(time.perf_counter() - start)
+    print('{:>22} {:>10.1f} ms'.format('import server', 1000 * (median(imported) - median(interpreter))))
+
+    for script in STARTUP_PROGRAMS:
+        times = []
+        for index in range(STARTUP_PROCESSES):
+            port = free_port()
+            command = [sys.executable, script, '--host', '127.0.0.1', '--port', str(port),
+                       '--metrics-port', str(free_port()), '--handoff-path', '']
+            start = time.perf_counter()
+            process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            while not loadgen.server_listening('127.0.0.1', port):
+                time.sleep(0.002)
+            times.append(time.perf_counter() - start)
+            loadgen.stop_server(process)
+        print('{:>22} {:>10.1f} ms until accepting connections'.format(script, 1000 * median(times)))
+
+    # Each server listens on a port chosen by the operating system and serves one client before it stops
+    served = 0
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        for index in range(STARTUP_SERVERS):
+            irc_server = server.IRCServer('127.0.0.1', 0, log_directory = None,
+                                          handoff_path = None).start()
+            thread = threading.Thread(target=irc_server.serve_forever)
+            thread.start()
+            with socket.create_connection(irc_server.address(), timeout=5) as connection:
+                connection.sendall(framing.encode_frame('NAME:user{}'.format(index)))
+                if connection.recv(64).startswith(b'STILL_ALIVE'):
+                    served += 1
+            irc_server.stop()
+            thread.join()
+    elapsed = time.perf_counter() - start
+    reset_server_state()
+    print('{:,} IRCServer objects started, served a client, and stopped in one process: {:.1f} ms each'.format(
+        STARTUP_SERVERS, 1000 * elapsed / STARTUP_SERVERS))
+    if served != STARTUP_SERVERS:
+        print('FAILED: {} of {} servers did not serve their client'.format(STARTUP_SERVERS - served, STARTUP_SERVERS))
+        return False
+    return True
+
+# Start a server program in a new process serving clients on a local port, over TLS if given certificate files
+# Rate limits and the message log are turned off so they do not limit the throughput measured
+# Returns subprocess.Popen object
+# Takes String, Integer, and String or None certificate and key files as arguments
+def spawn_tls_server(script, port, cert_file, key_file):
+    arguments = "'127.0.0.1', {}, metrics_port = None, log_directory = None, handoff_path = None, " \
+                "cert_file = {!r}, key_file = {!r}".format(port, cert_file, key_file)
+    if script == 'server.py':
+        run = 'import server; server.IRCServer({}).start().serve_forever()'.format(arguments)
+    else:
+        run = 'import asyncio, async_server; asyncio.run(async_server.main({}))'.format(arguments)
+    command = [sys.executable, '-c', 'import ratelimit; ratelimit.ENABLED = False; ' + run]
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    while not loadgen.server_listening('127.0.0.1', port):
+        time.sleep(0.01)
+    return process
+
+# Returns Float of the seconds of CPU time a process has used
+# Takes Integer process ID as argument
+def process_cpu_seconds(pid):
+    with open('/proc/{}/stat'.format(pid)) as file:
+        fields = file.read().rpartition(')')[2].split()
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+# Returns IRCClient object for a server on a local port that asks for no compression, so only TLS is measured,
+# and ignores every message, which the benchmark reads itself
+# Takes Integer and ssl.SSLContext or None as arguments
+def benchmark_client(port, context):
+    return client.IRCClient('127.0.0.1', port, {}, compression = None, context = context)
+
+# Connect a client one connection after another, registering a new user on each connection
+# Returns Tuple of (median seconds from opening a connection to receiving the server's first message,
+# Integer number of connections that resumed a TLS session)
+# Takes IRCClient object, String prefix of the user names, and Boolean that is True to resume sessions as arguments
+def reconnect_repeatedly(irc_client, prefix, resume):
+    times = []
+    resumed = 0
+    for index in range(TLS_CONNECTIONS):
+        if not resume:
+            irc_client.session = None
+        start = time.perf_counter()
+        irc_client.connect()
+        irc_client.send('NAME:{}{}'.format(prefix, index))
+        irc_client.reader.read_frame()
+        times.append(time.perf_counter() - start)
+        if irc_client.context is not None and irc_client.server.session_reused:
+            resumed += 1
+        irc_client.close()
+    return median(times), resumed
+
+# Echo chat messages through a chat room whose only member is the client sending them
+# Messages are sent in groups by a second thread while every message is read back
+# Returns Float of messages echoed per second
+# Takes IRCClient object, String user name, and Integer body size as arguments
+def echo_messages(irc_client, user_name, body_size):
+    irc_client.connect()
+    irc_client.send('NAME:{}'.format(user_name))
+    irc_client.send('JOIN:tlsbench')
+    while not irc_client.reader.read_frame().startswith(b'JOIN_RESPONSE'):
+        pass
+    frame = framing.encode_frame('MESSAGE:tlsbench:' + 'x' * body_size)
+    groups = [frame * 100] * (TLS_MESSAGES // 100)
+
+    def send_groups():
+        for group in groups:
+            irc_client.server.sendall(group)
+    start = time.perf_counter()
+    sender = threading.Thread(target=send_groups)
+    sender.start()
+    echoed = 0
+    while echoed < len(groups) * 100:
+        if irc_client.reader.read_frame().startswith(b'MESSAGE:'):
+            echoed += 1
+    elapsed = time.perf_counter() - start
+    sender.join()
+    irc_client.close()
+    return echoed / elapsed
+
+# Measures what TLS costs each server program compared with plain TCP, for the connection handshake with each type
+# of certificate key and for throughput, with self-signed certificates on localhost
+# Connections that resume the session of the previous connection show what a reconnect storm after a keepalive
+# timeout costs, and are checked to have resumed their sessions
+def benchmark_tls():
+    with tempfile.TemporaryDirectory() as directory:
+        try:
+            certificates = {key_type: tls.self_signed_certificate(directory, key_type = key_type)
+                            for key_type in TLS_KEY_TYPES}
+        except OSError as E:
+            print('TLS benchmark skipped: {}'.format(E))
+            return True
+        print('TLS (self-signed certificates on localhost, median of {} connections, {:,} echoed messages)'.format(
+            TLS_CONNECTIONS, TLS_MESSAGES))
+        passed = True
+        for script in TLS_PROGRAMS:
+            ports = {}
+            processes = {}
+            for key_type in [None] + TLS_KEY_TYPES:
+                cert_file, key_file = certificates[key_type] if key_type else (None, None)
+                ports[key_type] = free_port()
+                processes[key_type] = spawn_tls_server(script, ports[key_type], cert_file, key_file)
+            try:
+                print(script)
+                print('{:>30} {:>12} {:>16}'.format('connection', 'connect ms', 'server CPU ms'))
+                cases = [('plain TCP', None, False)]
+                for key_type in TLS_KEY_TYPES:
+                    cases.append(('full TLS handshake, {}'.format(key_type), key_type, False))
+                    cases.append(('resumed TLS handshake, {}'.format(key_type), key_type, True))
+                for index, (name, key_type, resume) in enumerate(cases):
+                    context = tls.client_context(certificates[key_type][0]) if key_type else None
+                    pid = processes[key_type].pid
+                    cpu = process_cpu_seconds(pid)
+                    connect_time, resumed = reconnect_repeatedly(benchmark_client(ports[key_type], context),
+                                                                 'tls{}user'.format(index), resume)
+                    cpu = process_cpu_seconds(pid) - cpu
+                    print('{:>30} {:>12.3f} {:>16.3f}'.format(name, 1000 * connect_time, 1000 * cpu / TLS_CONNECTIONS))
+                    # The first connection has no session to resume
+                    if resume and resumed < TLS_CONNECTIONS - 1:
+                        print('FAILED: {} of {} connections resumed their TLS session'.format(
+                            resumed, TLS_CONNECTIONS))
+                        passed = False
+
+                # The cipher, not the certificate, decides the cost of each message, so one certificate is enough
+                key_type = TLS_KEY_TYPES[0]
+                context = tls.client_context(certificates[key_type][0])
+                print('{:>30} {:>12} {:>16} {:>10}'.format('body bytes', 'plain msg/s', 'TLS msg/s', 'TLS cost'))
+                for body_size in TLS_BODY_SIZES:
+                    # Alternate the measurements and keep the best round of each
+                    plain_rate = 0
+                    tls_rate = 0
+                    for round in range(PARSE_ROUNDS):
+                        user_name = 'echo{}round{}'.format(body_size, round)
+                        plain_rate = max(plain_rate, echo_messages(benchmark_client(ports[None], None), user_name,
+                                                                   body_size))
+                        tls_rate = max(tls_rate, echo_messages(benchmark_client(ports[key_type], context), user_name,
+                                                               body_size))
+                    print('{:>30} {:>12,.0f} {:>16,.0f} {:>9.0%}'.format(
+                        body_size, plain_rate, tls_rate, plain_rate / tls_rate - 1))
+            finally:
+                for process in processes.values():
+                    loadgen.stop_server(process)
+        return passed
+
+# Client that records when it tries to connect and when it has rejoined its chat rooms after reconnecting
+class ReconnectingClient(client.IRCClient):
+    __slots__ = ('attempts', 'recovered')
+
+    # Takes Integer port of a local server as argument
+    def __init__(self, port):
+        handlers = collections.defaultdict(lambda: ignore_message)
+        handlers[protocol.JoinResponse] = record_recovery
+        super().__init__('127.0.0.1', port, handlers, compression = None)
+        self.attempts = []
+        # perf_counter() time the client last received a JOIN_RESPONSE message
+        self.recovered = None
+
+    def connect(self):
+        self.attempts.append(time.perf_counter())
+        return super().connect()
+
+# Handler for the messages the reconnect benchmark does not need
+def ignore_message(irc_client, message):
+    pass
+
+# Handler recording when a client's chat rooms were joined
+def record_recovery(irc_client, message):
+    irc_client.recovered = time.perf_counter()
+
+# Returns the largest number of times that fall within any interval of the given length
+# Takes List of Floats and Float seconds as arguments
+def peak_count(times, interval):
+    times = sorted(times)
+    peak = 0
+    first = 0
+    for last, moment in enumerate(times):
+        while moment - times[first] >= interval:
+            first += 1
+        peak = max(peak, last - first + 1)
+    return peak
+
+# Client function choosing a random wait before each attempt to reconnect, restored after each restart
+delay_with_jitter = client.reconnect_delay
+
+# Returns Float of seconds before a client's attempt to reconnect without jitter, so every client that lost the
+# same server tries again at the same moment
+# Takes Integer as argument
+def lockstep_reconnect_delay(failed_attempts):
+    return min(client.RECONNECT_MAX_DELAY, client.RECONNECT_BASE_DELAY * 2 ** failed_attempts)
+
+# Restart a server program under many registered clients that have joined chat rooms
+# Returns Dictionary of results, with times in seconds since the server was stopped
+# Takes String and Function that chooses the clients' wait before each attempt as arguments
+def restart_under_clients(script, delay):
+    port = free_port()
+    process = spawn_tls_server(script, port, None, None)
+    clients = []
+    threads = []
+    try:
+        room_names = ','.join('room{}'.format(index) for index in range(RECONNECT_ROOMS))
+        for index in range(RECONNECT_CLIENTS):
+            irc_client = ReconnectingClient(port).connect()
+            irc_client.send_input('NAME:reconnect{}'.format(index))
+            irc_client.send_input('JOIN:' + room_names)
+            thread = threading.Thread(target=irc_client.listen_for_message)
+            thread.start()
+            clients.append(irc_client)
+            threads.append(thread)
+        while any(len(irc_client.rooms) < RECONNECT_ROOMS for irc_client in clients):
+            time.sleep(0.05)
+        for irc_client in clients:
+            irc_client.attempts.clear()
+            irc_client.recovered = None
+
+        client.reconnect_delay = delay
+        start = time.perf_counter()
+        loadgen.stop_server(process)
+        process = spawn_tls_server(script, port, None, None)
+        restarted = time.perf_counter() - start
+        deadline = time.monotonic() + 60
+        while time.monotonic() < deadline and any(irc_client.recovered is None for irc_client in clients):
+            time.sleep(0.05)
+        recovered = [irc_client.recovered - start for irc_client in clients if irc_client.recovered is not None]
+        attempts = [moment - start for irc_client in clients for moment in irc_client.attempts]
+        return {
+            'restarted': restarted,
+            'recovered': recovered,
+            'attempts': attempts,
+            'rejoined': sum(len(irc_client.rooms) == RECONNECT_ROOMS for irc_client in clients)
+        }
+    finally:
+        client.reconnect_delay = delay_with_jitter
+        for irc_client in clients:
+            irc_client.close()
+        for thread in threads:
+            thread.join()
+        loadgen.stop_server(process)
+
+# Measures how the clients of a server that restarts reconnect, register, and rejoin their chat rooms,
+# with the random waits the client uses and with every client waiting the same time
+# Random waits spread the connection requests arriving at the new server, which is shown by the most attempts
+# to connect within any 100 ms
+def benchmark_reconnect():
+    loadgen.raise_file_limit()
+    print('Reconnect ({:,} clients in {} rooms each, base delay {} s)'.format(
+        RECONNECT_CLIENTS, RECONNECT_ROOMS, client.RECONNECT_BASE_DELAY))
+    passed = True
+    for script in RECONNECT_PROGRAMS:
+        print(script)
+        print('{:>22} {:>10} {:>10} {:>10} {:>10} {:>14}'.format(
+            'backoff', 'rejoined', 'median s', 'last s', 'attempts', 'peak / 100 ms'))
+        for name, delay in [('random', delay_with_jitter), ('lockstep', lockstep_reconnect_delay)]:
+            with contextlib.redirect_stdout(io.StringIO()):
+                results = restart_under_clients(script, delay)
+            recovered = results['recovered'] or [float('nan')]
+            print('{:>22} {:>10,} {:>10.2f} {:>10.2f} {:>10,} {:>14,}'.format(
+                name, results['rejoined'], median(recovered), max(recovered), len(results['attempts']),
+                peak_count(results['attempts'], 0.1)))
+            if name == 'random' and results['rejoined'] < RECONNECT_CLIENTS:
+                print('FAILED: {} of {} clients did not rejoin their chat rooms'.format(
+                    RECONNECT_CLIENTS - results['rejoined'], RECONNECT_CLIENTS))
+                passed = False
+    return passed
+
+# Write a message log of a number of messages spread over a number of segments and chat rooms
+# Returns Integer of bytes written
+# Takes String, Integer, Integer, and bytes as arguments
+def write_log(directory, message_count, segment_count, body):
+    record_size = len(message_log.encode_record(b'MESSAGE:room00:user42:' + body))
+    per_segment = message_count // segment_count
+    log = message_log.MessageLog(directory, segment_bytes = per_segment * record_size, commit_interval = 0)
+    log.recover()
+    log.start()
+    room_names = ['room{:02d}'.format(index) for index in range(LOG_ROOMS)]
+    for room_name in room_names:
+        log.append_room(room_name)
+    for segment in range(segment_count):
+        # Each segment is written as one batch, so it is sealed once it holds its share of the messages
+        for index in range(per_segment):
+            room_name = room_names[index % LOG_ROOMS]
+            log.append_message(room_name, (b'MESSAGE:' + room_name.encode() + b':user42:', body, b'\n'))
+        log.flush()
+    log.close()
+    return per_segment * segment_count * record_size
+
+# Measures the time logging adds to each chat message, how many messages share each fsync, and the time to
+# recover logs of growing size, which should grow with the number of segments rather than the number of messages
+def benchmark_message_log():
+    print('Message log ({} member room, {:.0f} ms group commit interval)'.format(
+        LOG_ROOM_SIZE, 1000 * message_log.COMMIT_INTERVAL))
+    reset_server_state()
+    users = register_users(LOG_ROOM_SIZE)
+    for user in users:
+        server.join_msg_handler(user, protocol.Join([('bench',)]))
+    sender = users[0]
+    message = protocol.ChatMessage(['bench', b'The quick brown fox jumps over the lazy dog'])
+
+    with tempfile.TemporaryDirectory() as directory:
+        log = message_log.MessageLog(directory)
+        log.recover()
+        log.start()
+        # Alternate the measurements and keep the best round of each
+        baseline = 0
+        rate = 0
+        for _ in range(PARSE_ROUNDS):
+            server.persistent_log = None
+            baseline = max(baseline, calls_per_second(lambda: server.chat_msg_handler(sender, message)))
+            server.persistent_log = log
+            rate = max(rate, calls_per_second(lambda: server.chat_msg_handler(sender, message)))
+        server.persistent_log = None
+        start = time.perf_counter()
+        log.close()
+        print('{:,.0f} ns without the log, {:,.0f} ns with the log, {:,.0f} ns overhead per message'.format(
+            1e9 / baseline, 1e9 / rate, 1e9 / rate - 1e9 / baseline))
+        print('{:,} messages written with {:,} fsyncs ({:,.0f} messages each), {:.2f} s to write the rest on close'.format(
+            log.committed, log.commits, log.committed / max(1, log.commits), time.perf_counter() - start))
+    reset_server_state()
+    server.room_history = history.HistoryStore()
+
+    print('{:>10} {:>10} {:>12} {:>14} {:>14}'.format('messages', 'segments', 'log MB', 'recovery ms',
+                                                     'full replay ms'))
+    body = b'The quick brown fox jumps over the lazy dog'
+    for message_count, segment_count in LOG_RECOVERY_CASES:
+        with tempfile.TemporaryDirectory() as directory:
+            size = write_log(directory, message_count, segment_count, body)
+            # Replaying every record of every segment is what recovery would cost without summaries
+            start = time.perf_counter()
+            store = history.HistoryStore()
+            for number in message_log.MessageLog(directory).segment_numbers():
+                path = '{}/{:08d}{}'.format(directory, number, message_log.SEGMENT_SUFFIX)
+                for payload in message_log.read_records(path):
+                    if payload.startswith(b'MESSAGE:'):
+                        store.record(message_log.record_room_name(payload), payload + framing.DELIMITER)
+            full_replay = time.perf_counter() - start
+
+            start = time.perf_counter()
+            log = message_log.MessageLog(directory)
+            room_names, messages = log.recover()
+            store = history.HistoryStore()
+            for room_name, frame in messages:
+                store.record(room_name, frame)
+            recovery = time.perf_counter() - start
+            log.close()
+        print('{:>10,} {:>10} {:>12.1f} {:>14.1f} {:>14.1f}'.format(
+            message_count, segment_count, size / 1e6, 1000 * recovery, 1000 * full_replay))
+
+# Runs the same scripted clients against each server program over real TCP connections
+# and reports connection rate, message throughput, and delivery latency including room fan-out
+# Every run uses the same seed, so results can be compared between versions of the message handlers
+def benchmark_load():
+    settings = loadgen.default_settings()
+    settings.update(LOAD_SETTINGS)
+    print('Load test ({} clients in {} rooms, {} messages/sec each for {} s)'.format(
+        settings['clients'], settings['rooms'], settings['message_rate'], settings['duration']))
+
+    lost = False
+    for script in LOAD_SERVERS:
+        print(script)
+        results = loadgen.load_test(settings, script)
+        loadgen.print_results(results)
+        if results['lost_deliveries'] or results['errors']:
+            lost = True
+    return not lost
+
+# Start one server of a federated network in a new process, linked to every server started before it,
+# and wait until it accepts clients
+# Returns subprocess.Popen object
+# Takes Integer index of the server, List of Integer client ports, List of Integer link ports, and String secret
+# as arguments
+def spawn_federation_node(index, ports, link_ports, secret):
+    command = [sys.executable, 'federation.py', 'node{}'.format(index), '--host', '127.0.0.1',
+               '--port', str(ports[index]), '--link-port', str(link_ports[index]), '--metrics-port', str(free_port()),
+               '--link-secret', secret]
+    for peer in range(index):
+        command += ['--peer', '127.0.0.1:{}'.format(link_ports[peer])]
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    while not loadgen.server_listening('127.0.0.1', ports[index]):
+        time.sleep(0.01)
+    return process
+
+# Open a connection to a local server and register a user name
+# Returns Tuple of (socket object, FrameReader object, bytes of the server's first message after NAME)
+# Takes Integer port and String user name as arguments
+def register_on(port, user_name):
+    sock = socket.create_connection(('127.0.0.1', port), timeout=10)
+    reader = framing.FrameReader(sock)
+    sock.sendall(framing.encode_frame('NAME:{}'.format(user_name)))
+    return sock, reader, reader.read_frame()
+
+# Returns the next message received that starts with a prefix, skipping any other messages
+# Takes FrameReader object and bytes as arguments
+def read_until(reader, prefix):
+    while True:
+        frame = reader.read_frame()
+        if frame.startswith(prefix):
+            return frame
+
+# Links several servers on this machine and checks that user names claimed on one server are refused by the others
+# and that chat messages reach the members of a chat room on every server
+# Reports how long the servers take to link, how long a user name claim takes, and how long one message from
+# every user takes to reach every member of the chat room
+def benchmark_federation():
+    print('Federation ({} servers linked on localhost, {} users each)'.format(FEDERATION_NODES, FEDERATION_USERS))
+    ports = [free_port() for index in range(FEDERATION_NODES)]
+    link_ports = [free_port() for index in range(FEDERATION_NODES)]
+    processes = []
+    sockets = []
+    passed = True
+    try:
+        start = time.perf_counter()
+        for index in range(FEDERATION_NODES):
+            processes.append(spawn_federation_node(index, ports, link_ports, 'benchmark'))
+
+        # Every server is linked to every other server once a name held on each server is refused by the others
+        deadline = time.monotonic() + 30
+        for index in range(FEDERATION_NODES):
+            sock, reader, reply = register_on(ports[index], 'probe{}'.format(index))
+            sockets.append(sock)
+            for other in range(FEDERATION_NODES):
+                while other != index:
+                    sock, reader, reply = register_on(ports[other], 'probe{}'.format(index))
+                    sock.close()
+                    if reply.startswith(b'ERROR:105'):
+                        break
+                    if time.monotonic() > deadline:
+                        print('FAILED: server {} did not refuse a user name held on server {}'.format(other, index))
+                        return False
+                    time.sleep(0.05)
+        print('{} servers linked in {:.0f} ms'.format(FEDERATION_NODES, 1000 * (time.perf_counter() - start)))
+
+        readers = []
+        claims = []
+        for index in range(FEDERATION_NODES * FEDERATION_USERS):
+            start = time.perf_counter()
+            sock, reader, reply = register_on(ports[index % FEDERATION_NODES], 'fed{}'.format(index))
+            claims.append(time.perf_counter() - start)
+            sockets.append(sock)
+            readers.append(reader)
+            if reply.startswith(b'ERROR'):
+                print('FAILED: fed{} could not register: {}'.format(index, reply.decode()))
+                return False
+        print('NAME claimed on every server: median {:.2f} ms, slowest {:.2f} ms'.format(
+            1000 * median(claims), 1000 * max(claims)))
+
+        # Members on every server are added to the chat room before any message is sent
+        for reader in readers:
+            reader.sock.sendall(framing.encode_frame('JOIN:federation'))
+            read_until(reader, b'JOIN_RESPONSE')
+        deadline = time.monotonic() + 30
+        expected = len(readers)
+        probe = readers[-1]
+        while True:
+            probe.sock.sendall(framing.encode_frame('USERS:federation'))
+            members = read_until(probe, b'USERS_RESPONSE').split(b':')[2].split()
+            if len(members) == expected:
+                break
+            if time.monotonic() > deadline:
+                print('FAILED: {} of {} members were seen by one server'.format(len(members), expected))
+                return False
+            time.sleep(0.05)
+
+        start = time.perf_counter()
+        for index, reader in enumerate(readers):
+            reader.sock.sendall(framing.encode_frame('MESSAGE:federation:hello from fed{}'.format(index)))
+        delivered = 0
+        for reader in readers:
+            received = set()
+            try:
+                while len(received) < expected:
+                    received.add(read_until(reader, b'MESSAGE:federation:'))
+            except OSError:
+                pass
+            delivered += len(received)
+        elapsed = time.perf_counter() - start
+        print('{:,} messages delivered to {:,} members across {} servers: {:,} of {:,} deliveries in {:.0f} ms'.format(
+            expected, expected, FEDERATION_NODES, delivered, expected * expected, 1000 * elapsed))
+        if delivered != expected * expected:
+            print('FAILED: {:,} deliveries were lost'.format(expected * expected - delivered))
+            passed = False
+        else:
+            print('Every user name was refused by the other servers and every message reached every server')
+    finally:
+        for sock in sockets:
+            sock.close()
+        for process in processes:
+            loadgen.stop_server(process)
+    return passed
+
+# Returns the number of sockets listening on a local TCP port, which is one for each cluster worker
+# Takes Integer as argument
+def listening_sockets(port):
+    count = 0
+    with open('/proc/net/tcp') as file:
+        for line in file.readlines()[1:]:
+            fields = line.split()
+            if fields[3] == '0A' and int(fields[1].split(':')[1], 16) == port:
+                count += 1
+    return count
+
+# Returns List of the process IDs of a process's children
+# Takes Integer as argument
+def child_processes(pid):
+    with open('/proc/{}/task/{}/children'.format(pid, pid)) as file:
+        return [int(child) for child in file.read().split()]
+
+# Start a cluster with a number of worker processes in a new process and wait until every worker is listening
+# Rate limits and metrics are turned off so they do not limit the throughput measured
+# Returns subprocess.Popen object of the process running the cluster bus
+# Takes Integer, Integer, and String as arguments
+def spawn_cluster(worker_count, port, bus_path):
+    run = "import cluster; cluster.main({}, {!r}, '127.0.0.1', {}, metrics_port = None)".format(
+        worker_count, bus_path, port)
+    command = [sys.executable, '-c', 'import ratelimit; ratelimit.ENABLED = False; ' + run]
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    while listening_sockets(port) < worker_count:
+        time.sleep(0.05)
+    return process
+
+# Runs the same scripted clients against clusters with different numbers of worker processes
+# and reports delivery throughput, latency, and the CPU time spent by the cluster bus and by the workers
+# Clients are spread across the workers by the kernel, so most chat rooms have members on several workers
+# Throughput can only grow with the number of workers on a machine with a CPU core for each worker
+# and for the load generator
+def benchmark_cluster():
+    settings = loadgen.default_settings()
+    settings.update(CLUSTER_SETTINGS)
+    print('Cluster ({} clients in {} rooms, {} messages/sec each for {} s, {} CPU cores)'.format(
+        settings['clients'], settings['rooms'], settings['message_rate'], settings['duration'], os.cpu_count()))
+    print('{:>8} {:>16} {:>8} {:>14} {:>18} {:>18}'.format(
+        'workers', 'deliveries/sec', 'lost', 'room p99 ms', 'bus CPU ms/s', 'worker CPU ms/s'))
+
+    passed = True
+    with tempfile.TemporaryDirectory() as directory:
+        for worker_count in CLUSTER_WORKERS:
+            settings['port'] = free_port()
+            process = spawn_cluster(worker_count, settings['port'], os.path.join(directory, 'bus.sock'))
+            try:
+                workers = child_processes(process.pid)
+                bus_cpu = process_cpu_seconds(process.pid)
+                worker_cpu = sum(map(process_cpu_seconds, workers))
+                start = time.perf_counter()
+                with contextlib.redirect_stdout(io.StringIO()):
+                    results = loadgen.load_test(settings)
+                elapsed = time.perf_counter() - start
+                bus_cpu = process_cpu_seconds(process.pid) - bus_cpu
+                worker_cpu = sum(map(process_cpu_seconds, workers)) - worker_cpu
+            finally:
+                loadgen.stop_server(process)
+            print('{:>8} {:>16,.0f} {:>8,} {:>14.2f} {:>18.0f} {:>18.0f}'.format(
+                worker_count, results['deliveries_per_sec'], results['lost_deliveries'], results['room_p99_ms'],
+                1000 * bus_cpu / elapsed, 1000 * worker_cpu / elapsed))
+            if results['lost_deliveries'] or results['errors'] or results['connect_failures']:
+                print('FAILED: {} deliveries lost, {} errors, {} clients could not connect'.format(
+                    results['lost_deliveries'], len(results['errors']), len(results['connect_failures'])))
+                passed = False
+    return passed
+
+# ==============================================================================================
+#                                     Benchmark Program
+# ==============================================================================================
+
+BENCHMARKS = {
+    'broadcast': benchmark_broadcast,
+    'keepalive': benchmark_keep_alive,
+    'concurrency': benchmark_concurrency,
+    'parse': benchmark_parse,
+    'allocations': benchmark_allocations,
+    'metrics': benchmark_metrics,
+    'history': benchmark_history,
+    'log': benchmark_message_log,
+    'offline': benchmark_offline,
+    'ratelimit': benchmark_rate_limit,
+    'listings': benchmark_listings,
+    'batch': benchmark_batch,
+    'memory': benchmark_memory,
+    'compression': benchmark_compression,
+    'startup': benchmark_startup,
+    'tls': benchmark_tls,
+    'reconnect': benchmark_reconnect,
+    'load': benchmark_load,
+    'cluster': benchmark_cluster,
+    'federation': benchmark_federation,
+}
+
+# Run the benchmarks named on the command line, or every benchmark if none are named
+if __name__ == '__main__':
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            print('Unknown benchmark: {} (choose from {})'.format(name, ', '.join(BENCHMARKS)))
+            sys.exit(1)
+    # Benchmarks that check correctness return False when they fail
+    failed = False
+    for name in names:
+        if BENCHMARKS[name]() is False:
+            failed = True
+        print('')
+    sys.exit(1 if failed else 0)
@@ -1,137 +1,401 @@
+import argparse
+import random
 import socket
+import sys
 import threading
 import time
-import utilities
-from datetime import datetime, timedelta
+import framing
+import protocol
+import stream_compression
+import tls
 
 # ==============================================================================================
-#                                    Global Client State
+#                                    Client Settings
 # ==============================================================================================
 
 # IP address of AWS hosted server
 HOST = '54.188.19.136'
 # Port number specified in protocol
 PORT = 2787
-
-# Dictionary to track information about the status of the client's TCP connection with the server
-connection_status = {
-    # 'alive' key is set to False if connection with server is severed
-    'alive': True,
-    # 'finalized' key is set to True once client and server have finished exchanging connection initialization messages
-    'finalized': False,
-    # 'timestamp' key tracks the last time a STILL_ALIVE message is received from the server
-    'timestamp': datetime.now()
-}
-
-# Create TCP connection with server
-server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-server.connect((HOST, PORT))
+# Attempts made to reconnect once the connection with the server is lost, 0 to end the program instead
+RECONNECT_ATTEMPTS = 10
+# Seconds the client may wait before its first attempt to reconnect, doubled after each failed attempt
+# up to RECONNECT_MAX_DELAY
+# Each wait is chosen at random up to this limit, so clients that lost the same server do not all reconnect at once
+RECONNECT_BASE_DELAY = 1.0
+RECONNECT_MAX_DELAY = 60.0
 
 # ==============================================================================================
-#                               Connection Maintenance Functions
+#                                     Client Connection
 # ==============================================================================================
 
-# Terminate client TCP connection with server
-def close_connection():
-    connection_status['alive'] = False
-    server.close()
-
-# Function waits until connection with server has finished initializing
-# Returns True if the connection is terminated before it finishes initializing
-# Returns False once the connection has successfully finished initializing
-def check_status():
-    while not connection_status['finalized']:
-        if not connection_status['alive']:
-            return True
-    return False
-
-# Function monitors connection status while sleeping for the number of seconds specified by the seconds parameter
-# Returns True if the connection is terminated before wait finishes
-# Returns False once the wait has finished
-# Takes Integer as argument
-def keep_alive_wait(seconds):
-    counter = 0
-    while (counter < seconds):
-        time.sleep(1)
-        counter += 1
-        if not connection_status['alive']:
+# Returns Float of seconds to wait before an attempt to reconnect
+# Each wait is chosen at random up to a limit that doubles after every failed attempt, so the clients of a server
+# that restarts spread their connection requests out instead of all arriving together
+# Takes Integer number of attempts that have already failed as argument
+def reconnect_delay(failed_attempts):
+    limit = min(RECONNECT_MAX_DELAY, RECONNECT_BASE_DELAY * 2 ** failed_attempts)
+    return random.uniform(0, limit)
+
+# Connection from a user to the IRC server that can be opened by another program, such as a test
+# Creating a client opens no connection, so nothing happens until connect() is called
+# Messages from the server are passed to the handler for their type, which are the display functions below
+# unless the program creating the client provides its own
+# The client asks the server to compress the messages it sends unless it is created without a compression algorithm
+# A client created with an ssl.SSLContext encrypts its connection with TLS, and resumes the TLS session of its
+# previous connection when it connects again, which skips most of the handshake
+# A client that loses its connection reconnects, registers its user name again, and rejoins its chat rooms
+class IRCClient:
+    __slots__ = ('host', 'port', 'handlers', 'compression', 'context', 'reconnect_attempts', 'session', 'server',
+                 'reader', 'registration', 'rooms', 'resyncing', 'failed_attempts', 'quitting', 'alive', 'finalized',
+                 'timestamp')
+
+    # Takes String, Integer, Dictionary of message type to handler function, String or None,
+    # ssl.SSLContext or None, and Integer as arguments
+    def __init__(self, host=HOST, port=PORT, handlers=None, compression=stream_compression.ALGORITHM, context=None,
+                 reconnect_attempts=RECONNECT_ATTEMPTS):
+        self.host = host
+        self.port = port
+        self.handlers = MESSAGE_HANDLERS if handlers is None else handlers
+        self.compression = compression
+        self.context = context
+        self.reconnect_attempts = reconnect_attempts
+        # ssl.SSLSession of the last encrypted connection once it has closed, otherwise None
+        self.session = None
+        self.server = None
+        self.reader = None
+        # Last NAME message sent by the user, or None, and the chat rooms the user is a member of,
+        # which are restored after reconnecting
+        self.registration = None
+        self.rooms = {}
+        # True from reconnecting until the server has answered the NAME message sent again
+        self.resyncing = False
+        # Attempts to reconnect that have failed since the client was last registered
+        self.failed_attempts = 0
+        # True once the user has sent QUIT, since the server also sends QUIT to every client when it shuts down
+        self.quitting = False
+        # Set to False once the client has ended its connection and stopped reconnecting
+        self.alive = True
+        # Set to True once client and server have finished exchanging connection initialization messages
+        self.finalized = False
+        # Monotonic time the last STILL_ALIVE message was received from the server
+        self.timestamp = time.monotonic()
+
+    # Create TCP connection with server, encrypted with TLS if the client has an ssl.SSLContext
+    # Returns the client, so it can be created and connected in one expression
+    def connect(self):
+        self.server = socket.create_connection((self.host, self.port))
+        if self.context is not None:
+            self.server = self.context.wrap_socket(self.server, server_hostname = self.host, session = self.session)
+        # Buffers bytes received from the server until complete messages have arrived,
+        # decompressing them once the server has started compressing
+        if self.compression is None:
+            self.reader = framing.FrameReader(self.server)
+        else:
+            self.reader = stream_compression.DecompressingReader(self.server)
+        return self
+
+    # Send encoded message to server over TCP connection
+    # Takes String as argument
+    def send(self, msg):
+        self.server.send(framing.encode_frame(msg))
+
+    # Returns the NAME message typed by the user with the compression the client asks for added,
+    # or any other message unchanged
+    # Takes String as argument
+    def name_message(self, msg):
+        if self.compression is not None and msg.startswith('NAME:') and msg.count(':') == 1:
+            return '{}:{}'.format(msg, self.compression)
+        return msg
+
+    # Send a message typed by the user, remembering a NAME message so it can be sent again after reconnecting
+    # Takes String as argument
+    def send_input(self, msg):
+        msg = self.name_message(msg)
+        if msg.startswith('NAME:'):
+            self.registration = msg
+        elif msg == 'QUIT':
+            self.quitting = True
+        self.send(msg)
+
+    # Terminate client TCP connection with server
+    def close(self):
+        self.alive = False
+        self.close_socket()
+
+    # Keep the TLS session of the connection, so the next connection can resume it
+    # The session is gone once the socket has been shut down, so it is kept before then
+    def keep_session(self):
+        if self.context is not None and self.server.session is not None:
+            self.session = self.server.session
+
+    # Close the socket of the connection without ending the client
+    def close_socket(self):
+        self.keep_session()
+        self.server.close()
+
+    # End a connection to a server that has stopped answering, so the listening thread reconnects
+    # The socket is shut down rather than closed, which wakes the listening thread blocked reading from it
+    def drop_connection(self):
+        self.keep_session()
+        try:
+            self.server.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    # Connect to the server again after the connection has been lost, waiting longer after each failed attempt
+    # Returns True once reconnected, or False if the client was closed or every attempt failed
+    def reconnect(self):
+        self.finalized = False
+        self.close_socket()
+        while self.failed_attempts < self.reconnect_attempts:
+            time.sleep(reconnect_delay(self.failed_attempts))
+            if not self.alive:
+                return False
+            self.failed_attempts += 1
+            try:
+                self.connect()
+            except OSError:
+                continue
+            try:
+                self.resync()
+            except OSError:
+                # Close the new connection before the next attempt replaces it
+                self.close_socket()
+                continue
+            if not self.resyncing:
+                self.failed_attempts = 0
+            self.timestamp = time.monotonic()
+            print('Reconnected to the server\n')
             return True
-    return False
+        return False
 
-# Function sends STILL_ALIVE messages to server to ensure server knows that this client's connection is still alive
-def send_keep_alive():
-    try:
-        # Don't send STILL_ALIVE message if connection does not initialize successfully
-        if check_status():
+    # Register the user name again and rejoin every chat room the user was a member of, in one write
+    # Rooms are joined with as few JOIN messages as the protocol's limit on the length of a list allows
+    def resync(self):
+        if self.registration is None:
             return
+        self.resyncing = True
+        frames = [framing.encode_frame(self.registration)]
+        room_names = list(self.rooms)
+        for start in range(0, len(room_names), protocol.MAX_LIST_LENGTH):
+            frames.append(framing.encode_frame('JOIN:' + ','.join(room_names[start:start + protocol.MAX_LIST_LENGTH])))
+        self.server.sendall(b''.join(frames))
+
+    # Update the state restored after reconnecting from a message received from the server
+    # Returns False if the message only answers the messages sent by resync() and is not shown to the user
+    # Raises ConnectionError if the server refused the user name sent again, since it still holds the lost connection
+    # until its keepalive timeout, so the client reconnects again later
+    # Raises ConnectionError if the server sent QUIT without the user asking to quit, since it is shutting down
+    # Takes message object as argument
+    def track(self, message):
+        message_type = type(message)
+        if message_type is protocol.Quit and not self.quitting:
+            raise ConnectionError('Server has closed the connection')
+        if message_type is protocol.Error:
+            if not self.resyncing:
+                return True
+            if message.code == '105':
+                raise ConnectionError('User name is still held by the lost connection')
+            # JOIN messages sent after a refused NAME message are refused as well
+            return message.code != '106'
+        if message_type is protocol.JoinResponse:
+            self.rooms.update(dict.fromkeys(message.room_names))
+        elif message_type is protocol.LeaveResponse:
+            for room_name in message.room_names:
+                self.rooms.pop(room_name, None)
+        # The server only sends errors to a client that has not registered, so the user has been registered again
+        if self.resyncing:
+            self.resyncing = False
+            self.failed_attempts = 0
+        return True
+
+    # Function waits until connection with server has finished initializing
+    # Returns True if the connection is terminated before it finishes initializing
+    # Returns False once the connection has successfully finished initializing
+    def check_status(self):
+        while not self.finalized:
+            if not self.alive:
+                return True
+        return False
+
+    # Function monitors connection status while sleeping for the number of seconds specified by the seconds parameter
+    # Returns True if the connection is terminated before wait finishes
+    # Returns False once the wait has finished
+    # Takes Integer as argument
+    def keep_alive_wait(self, seconds):
+        counter = 0
+        while (counter < seconds):
+            time.sleep(1)
+            counter += 1
+            if not self.alive:
+                return True
+        return False
+
+    # Function sends STILL_ALIVE messages to server to ensure server knows that this client's connection is still alive
+    def send_keep_alive(self):
+        try:
+            # Don't send STILL_ALIVE message if connection does not initialize successfully
+            if self.check_status():
+                return
 
-        while True:
-            msg = 'STILL_ALIVE'
-            send_message(server, msg)
+            while True:
+                # STILL_ALIVE messages are only sent while registered, and a message that cannot be sent is dropped,
+                # since the listening thread reconnects once the connection is lost
+                if self.finalized:
+                    msg = 'STILL_ALIVE'
+                    try:
+                        self.send(msg)
+                    except OSError:
+                        pass
+
+                # Wait 5 seconds in between each STILL_ALIVE message and stop sending messages if the client closes
+                if self.keep_alive_wait(5):
+                    return
+
+        # End program if unexpected error occurs
+        except Exception as E:
+            print('Unexpected Error: Connection has closed and program is shutting down')
+            self.close()
+
+    # Function verifies that STILL_ALIVE messages are being received from the server within the timeout window
+    def verify_keep_alive(self):
+        try:
+            alive_window = 10
 
-            # Wait 5 seconds in between each STILL_ALIVE message and stop sending messages if connection closes
-            if keep_alive_wait(5):
+            # Don't check for STILL_ALIVE messages if connection does not initialize successfully
+            if self.check_status():
                 return
-    
-    # End program if unexpected error occurs
-    except Exception as E:
-        print('Unexpected Error: Connection has closed and program is shutting down')
-        close_connection()
-
-# Function verifies that STILL_ALIVE messages are being received from the server within the timeout window
-def verify_keep_alive():
-    try:
-        alive_window = timedelta(seconds = 10)
 
-        # Don't check for STILL_ALIVE messages if connection does not initialize successfully
-        if check_status():
-            return
+            while True:
+                # Wait 10 seconds in between checking timestamp from last STILL_ALIVE message
+                # and stop checking messages if connection closes
+                if self.keep_alive_wait(10):
+                    return
+
+                # If STILL_ALIVE message is not received from the server within the last 10 seconds,
+                # then the client assumes the server is down and drops the connection, so the listening thread
+                # reconnects, or ends the program if it cannot
+                window_start = time.monotonic() - alive_window
+                if self.finalized and self.timestamp < window_start:
+                    print('Unexpected Error: Server is no longer online')
+                    self.drop_connection()
+
+        # End program if unexpected error occurs
+        except Exception as E:
+            print('Unexpected Error: Connection has closed and program is shutting down')
+            self.close()
 
+    # Function listens for messages from the server
+    # and calls the message handler that corresponds to the type of the message
+    def listen_for_message(self):
         while True:
-            # Wait 10 seconds in between checking timestamp from last STILL_ALIVE message
-            # and stop checking messages if connection closes
-            if keep_alive_wait(10):
-                return
+            try:
+                # Parses the next encoded message from server
+                message = protocol.parse_client_message(self.reader.read_frame())
 
-            # If STILL_ALIVE message is not received from the server within the last 10 seconds,
-            # then the client assumes the server is down and ends the program
-            window_start = datetime.now() - alive_window
-            if connection_status['timestamp'] < window_start:
-                print('Unexpected Error: Server is no longer online')
-                close_connection()
-                return
+                # Alerts server if message violates a rule of the protocol
+                if isinstance(message, str):
+                    self.send(message)
+                    continue
+
+                # Messages answering the client's own resync are not shown to the user
+                if not self.track(message):
+                    continue
+
+                # Identify corresponding action for the type of server message
+                if self.handlers[type(message)](self, message) is False:
+                    break
+
+            # Reconnect if the connection was lost before the user quit, and end program if the client cannot reconnect
+            except Exception as E:
+                if self.alive and self.reconnect_attempts and not self.quitting:
+                    print('Unexpected Error: Connection has closed, reconnecting to the server\n')
+                    if self.reconnect():
+                        continue
+                print('Unexpected Error: Connection has closed and program is shutting down')
+                self.close()
+                break
+
+    # Collect user input and send to server
+    def input_handler(self):
+        try:
+            while True:
+                message = input('')
+                print('')
+
+                # Stop collecting input if connection with server is severed
+                if not self.alive:
+                    break
+
+                # Another NAME message is sent if the first user name was already in use
+                # Messages typed while the client is reconnecting cannot be sent
+                try:
+                    self.send_input(message)
+                except OSError:
+                    print('Not connected to the server, message was not sent\n')
+
+        # End program if unexpected error occurs
+        except Exception as E:
+            print('Unexpected Error: Connection has closed and program is shutting down')
+            self.close()
+
+    # Run the interactive client on a connected client
+    # Launches threads to listen for messages, collect user input, and keep the connection alive
+    def run(self):
+        try:
+            # Launch thread to listen for messages from the server
+            listening_thread = threading.Thread(target=self.listen_for_message)
+            listening_thread.start()
+
+            # Create unique user name and initiate one-way handshake with server
+            # User must format input as NAME:username
+            print('Welcome to IRC!\n')
+            user_name_message = input('')
+            print('')
+            self.send_input(user_name_message)
 
-    # End program if unexpected error occurs
-    except Exception as E:
-        print('Unexpected Error: Connection has closed and program is shutting down')
-        close_connection()
+            # Launch thread to collect input from the user
+            sending_thread = threading.Thread(target=self.input_handler)
+            sending_thread.start()
+
+            # Launch thread to send STILL_ALIVE messages to server
+            sending_thread = threading.Thread(target=self.send_keep_alive)
+            sending_thread.start()
+
+            # Launch thread to monitor if connection with server is being maintained
+            sending_thread = threading.Thread(target=self.verify_keep_alive)
+            sending_thread.start()
+
+        # End program if unexpected error occurs
+        except Exception as E:
+            print('Unexpected Error: Connection has closed and program is shutting down')
+            self.close()
 
 # ==============================================================================================
 #                                    Message Handlers
 # ==============================================================================================
 
-# Send encoded message to server over TCP connection
-# Takes a socket object and a String as arguments
-def send_message(server_socket, msg):
-    server_socket.send(msg.encode())
+# Every handler takes the IRCClient object that received the message and the message as arguments
+
+# Function records that the connection with the server is still alive
+# Called in response to receiving STILL_ALIVE message from the server
+# Takes IRCClient object and StillAlive message as arguments
+def still_alive_msg_handler(client, message):
+    client.timestamp = time.monotonic()
+    client.finalized = True
 
-# Function displays confirmation that user has successfully created or joined a chat room
+# Function displays confirmation that user has successfully created or joined chat rooms
 # Called in response to receiving JOIN_RESPONSE message from the server
-# Takes List of Strings as argument
-def join_response_msg_handler(message):
-    room_name = message[-1]
-    # Validate that room name is correctly formatted
-    param_check = utilities.validate_param_semantics(room_name)
-    if param_check != True:
-        send_message(server, param_check)
-        return
-    print('You are a member of {}\n'.format(room_name))
+# Takes IRCClient object and JoinResponse message as arguments
+def join_response_msg_handler(client, message):
+    print('You are a member of {}\n'.format(', '.join(message.room_names)))
 
 # Function displays list of chat rooms
 # Called in response to receiving ROOMS_RESPONSE message from the server
-# Takes List of Strings as argument
-def rooms_response_msg_handler(message):
-    rooms = message[-1]
+# Takes IRCClient object and RoomsResponse message as arguments
+def rooms_response_msg_handler(client, message):
+    rooms, _, next_page = message.rooms.partition(':')
     # Displays default text if no chat rooms have been created
     if rooms == ' ':
         print('There are no chat rooms\n')
@@ -141,19 +405,16 @@ def rooms_response_msg_handler(message):
         for room in rooms:
             print(room)
         print('')
+    # Long listings are split into pages, and the server says which page to request next
+    if next_page:
+        print('More chat rooms are listed on page {}\n'.format(next_page))
 
 # Function displays members list of a chat room
 # Called in response to receiving USERS_RESPONSE message from the server
-# Takes List of Strings as argument
-def users_response_msg_handler(message):
-    room_name = message[1]
-    members = message[-1]
-
-    # Validate that room name is correctly formatted
-    param_check = utilities.validate_param_semantics(room_name)
-    if param_check != True:
-        send_message(server, param_check)
-        return
+# Takes IRCClient object and UsersResponse message as arguments
+def users_response_msg_handler(client, message):
+    room_name = message.room_name
+    members, _, next_page = message.members.partition(':')
 
     # Displays default text if no users in chat room
     if members == ' ':
@@ -164,196 +425,113 @@ def users_response_msg_handler(message):
         for member in members:
             print(member)
         print('')
+    # Long listings are split into pages, and the server says which page to request next
+    if next_page:
+        print('More members of {} are listed on page {}\n'.format(room_name, next_page))
 
-# Function displays confirmation that user has successfully exited a chat room
+# Function displays confirmation that user has successfully exited chat rooms
 # Called in response to receiving LEAVE_RESPONSE message from the server
-# Takes List of Strings as argument
-def leave_response_msg_handler(message):
-    room_name = message[-1]
-    # Validate that room name is correctly formatted
-    param_check = utilities.validate_param_semantics(room_name)
-    if param_check != True:
-        send_message(server, param_check)
-        return
-    print('You are no longer a member of {}\n'.format(room_name))
+# Takes IRCClient object and LeaveResponse message as arguments
+def leave_response_msg_handler(client, message):
+    print('You are no longer a member of {}\n'.format(', '.join(message.room_names)))
 
 # Function displays chat messages sent to a chat room where the user is a member
 # Called in response to receiving MESSAGE message from the server
-# Takes List of Strings as argument
-def chat_msg_handler(message):
-    room_name = message[1]
-    # Validate that room name is correctly formatted
-    param_check = utilities.validate_param_semantics(room_name)
-    if param_check != True:
-        send_message(server, param_check)
-        return
-
-    sender = message[2]
-    # Validate that message sender is correctly formatted
-    param_check = utilities.validate_param_semantics(sender)
-    if param_check != True:
-        send_message(server, param_check)
-        return
-
-    # Properly format a message body that contains colons
-    if len(message) > 4:
-        message_body = ':'.join(message[3:])
-    else:
-        message_body = message[3]
-    # Validate that message body is correctly formatted
-    payload_check = utilities.validate_payload_semantics(message_body)
-    if payload_check != True:
-        send_message(server, payload_check)
-        return
-
-    print('Room: {}'.format(room_name))
-    print('User: {}'.format(sender))
-    print(message_body)
+# Takes IRCClient object and RoomMessage message as arguments
+def chat_msg_handler(client, message):
+    print('Room: {}'.format(message.room_name))
+    print('User: {}'.format(message.sender))
+    print(str(message.body, 'utf-8'))
     print('')
 
 # Function displays chat messages sent to a user directly from another user
 # Called in response to receiving MESSAGE_USER message from the server
-# Takes List of Strings as argument
-def private_msg_handler(message):
-    receiving_user = message[1]
-    # Validate that receiving username is correctly formatted
-    param_check = utilities.validate_param_semantics(receiving_user)
-    if param_check != True:
-        send_message(server, param_check)
-        return
-
-    sending_user = message[2]
-    # Validate that sending username is correctly formatted
-    param_check = utilities.validate_param_semantics(sending_user)
-    if param_check != True:
-        send_message(server, param_check)
-        return
-
-    if len(message) > 4:
-        message_body = ':'.join(message[3:])
-    else:
-        message_body = message[3]
-    # Validate that message body is correctly formatted
-    payload_check = utilities.validate_payload_semantics(message_body)
-    if payload_check != True:
-        send_message(server, payload_check)
-        return
-
-    print('Message From: {}'.format(sending_user))
-    print('Message To: {}'.format(receiving_user))
-    print(message_body)
+# Takes IRCClient object and UserMessage message as arguments
+def private_msg_handler(client, message):
+    print('Message From: {}'.format(message.sender))
+    print('Message To: {}'.format(', '.join(message.user_names)))
+    print(str(message.body, 'utf-8'))
     print('')
 
-# Function listens for messages from the server 
-# and calls the message handler that corresponds to the command portion of the message
-def listen_for_message():
-    while True:
-        try:
-            # Parses encoded message from server
-            message = server.recv(1024).decode()
-            message = message.split(':')
-            command = message[0]
-
-            # Validate that command is correctly formatted
-            command_check = utilities.validate_command_semantics(command)
-            if command_check != True:
-                send_message(server, command_check)
-                continue
-
-            # Identify corresponding action for command portion of server message
-            match command:
-                case 'STILL_ALIVE':
-                    connection_status['timestamp'] = datetime.now()
-                    connection_status['finalized'] = True
-                case 'JOIN_RESPONSE':
-                    join_response_msg_handler(message)
-                case 'ROOMS_RESPONSE':
-                    rooms_response_msg_handler(message)
-                case 'USERS_RESPONSE':
-                    users_response_msg_handler(message)
-                case 'LEAVE_RESPONSE':
-                    leave_response_msg_handler(message)
-                case 'MESSAGE':
-                    chat_msg_handler(message)
-                case 'MESSAGE_USER':
-                    private_msg_handler(message)
-                case 'QUIT':
-                    close_connection()
-                    break
-                # Displays error messages received from server
-                case 'ERROR':
-                    error_code = message[1]
-                    match error_code:
-                        case '107':
-                            room_name = message[2]
-                            print("{} Error: '{}' room does not exist\n".format(error_code, room_name))
-                        case '108':
-                            room_name = message[2]
-                            print("{} Error: You cannot post to '{}' when you are not a member\n".format(error_code, room_name))
-                        case '109':
-                            member = message[2]
-                            print("{} Error: User '{}' does not exist\n".format(error_code, member))
-                        case _:
-                            error_msg = message[-1]
-                            print('{} Error: {}\n'.format(error_code, error_msg))
-                # Alerts server if unrecognized command is received
-                case _:
-                    message = 'ERROR:100:Command is not included in the list of approved commands'
-                    send_message(server, message)
-
-        # End program if unexpected error occurs    
-        except Exception as E:
-            print('Unexpected Error: Connection has closed and program is shutting down')
-            close_connection()
-            break
-
-# Collect user input and send to server
-def input_handler():
-    try:
-        while True:
-            message = input('')
-            print('')
-
-            # Stop collecting input if connection with server is severed
-            if not connection_status['alive']:
-                break
-            
-            send_message(server, message)
+# Function is called once the server has started compressing the messages it sends
+# The reader has already started decompressing, so the user is not shown anything
+# Called in response to receiving COMPRESSION message from the server
+# Takes IRCClient object and Compression message as arguments
+def compression_msg_handler(client, message):
+    pass
+
+# Function closes the connection once the server has ended it
+# Called in response to receiving QUIT message from the server
+# Returns False so no more messages are read from the connection
+# Takes IRCClient object and Quit message as arguments
+def quit_msg_handler(client, message):
+    client.close()
+    return False
 
-    # End program if unexpected error occurs
-    except Exception as E:
-        print('Unexpected Error: Connection has closed and program is shutting down')
-        close_connection()
+# Function displays error messages received from server
+# Called in response to receiving ERROR message from the server
+# Takes IRCClient object and Error message as arguments
+def error_msg_handler(client, message):
+    error_code = message.code
+    # Room or user names the error refers to, for errors that name them, separated by commas
+    subject = message.text.partition(':')[0]
+    match error_code:
+        case '107':
+            print("{} Error: '{}' room does not exist\n".format(error_code, subject))
+        case '108':
+            print("{} Error: You cannot post to '{}' when you are not a member\n".format(error_code, subject))
+        case '109':
+            print("{} Error: User '{}' does not exist\n".format(error_code, subject))
+        case '111':
+            print("{} Error: User '{}' cannot receive more messages until they reconnect\n".format(error_code, subject))
+        case _:
+            error_msg = message.text.rpartition(':')[2]
+            print('{} Error: {}\n'.format(error_code, error_msg))
+
+# Message handler for each type of message the server may send
+MESSAGE_HANDLERS = {
+    protocol.StillAlive: still_alive_msg_handler,
+    protocol.JoinResponse: join_response_msg_handler,
+    protocol.RoomsResponse: rooms_response_msg_handler,
+    protocol.UsersResponse: users_response_msg_handler,
+    protocol.LeaveResponse: leave_response_msg_handler,
+    protocol.RoomMessage: chat_msg_handler,
+    protocol.UserMessage: private_msg_handler,
+    protocol.Quit: quit_msg_handler,
+    protocol.Compression: compression_msg_handler,
+    protocol.Error: error_msg_handler
+}
 
 # ==============================================================================================
 #                                       Client Program
 # ==============================================================================================
 
-try:
-    # Launch thread to listen for messages from the server
-    listening_thread = threading.Thread(target=listen_for_message)
-    listening_thread.start()
-
-    # Create unique user name and initiate one-way handshake with server
-    # User must format input as NAME:username
-    print('Welcome to IRC!\n')
-    user_name_message = input('')
-    print('')
-    send_message(server, user_name_message)
-
-    # Launch thread to collect input from the user
-    sending_thread = threading.Thread(target=input_handler)
-    sending_thread.start()
-
-    # Launch thread to send STILL_ALIVE messages to server
-    sending_thread = threading.Thread(target=send_keep_alive)
-    sending_thread.start()
-
-    # Launch thread to monitor if connection with server is being maintained
-    sending_thread = threading.Thread(target=verify_keep_alive)
-    sending_thread.start()
-
-# End program if unexpected error occurs
-except Exception as E:
-    print('Unexpected Error: Connection has closed and program is shutting down')
-    close_connection()
+# Connect to the server given on the command line and run the interactive client
+# Takes List of Strings, or None to read the command line, as argument
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Chat with other users of an IRC server')
+    parser.add_argument('--host', default=HOST, help='address of the server')
+    parser.add_argument('--port', type=int, default=PORT, help='port of the server')
+    parser.add_argument('--no-compression', action='store_true',
+                        help='do not ask the server to compress the messages it sends')
+    parser.add_argument('--tls', action='store_true', help='encrypt the connection with TLS')
+    parser.add_argument('--cafile', default=tls.CA_FILE,
+                        help='PEM certificate authorities to trust, such as a self-signed server certificate')
+    parser.add_argument('--reconnect-attempts', type=int, default=RECONNECT_ATTEMPTS,
+                        help='attempts to reconnect once the connection is lost, 0 to end the program instead')
+    args = parser.parse_args(argv)
+
+    compression = None if args.no_compression else stream_compression.ALGORITHM
+    try:
+        context = tls.client_context(args.cafile) if args.tls else None
+        client = IRCClient(args.host, args.port, compression = compression, context = context,
+                           reconnect_attempts = args.reconnect_attempts).connect()
+    except OSError as E:
+        print('Unexpected Error: Could not connect to {}:{}'.format(args.host, args.port))
+        print(E)
+        return 1
+    client.run()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
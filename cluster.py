@@ -0,0 +1,469 @@
+import asyncio
+import multiprocessing
+import os
+import socket
+import stat
+import tempfile
+import async_server
+import framing
+import handoff
+import message_log
+import metrics
+import server
+import tls
+
+# ==============================================================================================
+#                                    Cluster Settings
+# ==============================================================================================
+
+# Number of worker processes that accept client connections, defaults to one for each CPU core
+WORKER_COUNT = os.cpu_count() or 1
+# Unix socket used by worker processes to reach the cluster bus, or None for a socket in the runtime directory
+# of the user running the cluster, which no other user may enter
+BUS_PATH = None
+# Name of the bus socket in the user's runtime directory
+BUS_NAME = 'irc_server_bus.sock'
+
+# ==============================================================================================
+#                                      Bus Messages
+# ==============================================================================================
+
+# Every worker process connects to the bus hosted by the parent process and exchanges newline delimited
+# messages with the following formats:
+#
+# Worker to bus:
+#     HELLO:worker_index                    Worker has connected, bus replies with the current cluster state
+#     CLAIM:user_name                       Reserve a user name for a client connected to the worker
+#     RELEASE:user_name                     User has disconnected from the worker
+#     ROOM_JOIN:room_name:user_name         User connected to the worker has joined a chat room
+#     ROOM_LEAVE:room_name:user_name        User connected to the worker has left a chat room
+#     ROOM_MESSAGE:room_name:message        Message for the members of a chat room connected to other workers
+#     USER_MESSAGE:user_name:message        Message for a user connected to another worker
+#
+# Bus to worker:
+#     CLAIMED:user_name                     User name has been reserved for the worker
+#     REJECTED:user_name                    User name is already in use
+#     USER_ADD:user_name                    User has connected to another worker
+#     USER_REMOVE:user_name                 User connected to another worker has disconnected
+#     ROOM_JOIN, ROOM_LEAVE, ROOM_MESSAGE, USER_MESSAGE are forwarded unchanged to the workers they concern
+#
+# ROOM_JOIN and ROOM_LEAVE are forwarded to every worker, so every worker knows every room and its members
+# ROOM_MESSAGE is only forwarded to workers with members in the room, so each chat message is written once for
+# every worker that delivers it rather than once for every worker in the cluster
+# A worker keeps the history of a room only while it has members in the room, so a user who joins a room that
+# has no other members on their worker is shown the messages that worker last kept
+
+# ==============================================================================================
+#                                     Worker Process
+# ==============================================================================================
+
+# Stands in for the socket of a user connected to another worker process
+# Messages sent to the user are forwarded to the worker the user is connected to
+# The bus may be any object with a user_message() method, such as a federation link to another server
+class RemoteSocket:
+    __slots__ = ('bus', 'user_name')
+
+    # Takes BusClient object and String as arguments
+    def __init__(self, bus, user_name):
+        self.bus = bus
+        self.user_name = user_name
+
+    # Takes bytes or Tuple of bytes-like parts as argument
+    def send(self, data):
+        data = framing.frame_bytes(data)
+        self.bus.user_message(self.user_name, data[:-len(framing.DELIMITER)].decode())
+        return len(data)
+
+    # The connection is owned by another worker process, so there is nothing to close
+    def close(self):
+        pass
+
+# Connection from a worker process to the cluster bus
+# Publishes changes made by the worker's clients and applies changes published by the other workers
+# Set as server.cluster so the message handlers in server.py publish their changes
+class BusClient(asyncio.Protocol):
+    __slots__ = ('transport', 'reader', 'claims')
+
+    def __init__(self):
+        self.transport = None
+        self.reader = framing.FrameReader()
+        # Functions waiting for the answer to each user name claim, indexed by user name
+        self.claims = {}
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    # Send a message to the bus
+    # Takes String as argument
+    def publish(self, msg):
+        self.transport.write(framing.encode_frame(msg))
+
+    # Ask the bus to reserve a user name, calling callback with the user name and True if the name was reserved
+    # Takes String and function as arguments
+    def claim(self, user_name, callback):
+        # Another connection to this worker is already claiming the same name
+        if user_name in self.claims:
+            callback(user_name, False)
+            return
+        self.claims[user_name] = callback
+        self.publish('CLAIM:{}'.format(user_name))
+
+    def user_left(self, user_name):
+        self.publish('RELEASE:{}'.format(user_name))
+
+    def room_joined(self, room_name, user_name):
+        self.publish('ROOM_JOIN:{}:{}'.format(room_name, user_name))
+
+    def room_left(self, room_name, user_name):
+        self.publish('ROOM_LEAVE:{}:{}'.format(room_name, user_name))
+
+    def room_message(self, room_name, msg):
+        self.publish('ROOM_MESSAGE:{}:{}'.format(room_name, msg))
+
+    def user_message(self, user_name, msg):
+        self.publish('USER_MESSAGE:{}:{}'.format(user_name, msg))
+
+    # Takes bytes as argument
+    def data_received(self, data):
+        self.reader.feed(data)
+        for frame in self.reader.drain():
+            self.handle_message(frame.decode())
+
+    # Apply a message from the bus to this worker's server state
+    # Takes String as argument
+    def handle_message(self, frame):
+        command, _, rest = frame.partition(':')
+        match command:
+            case 'CLAIMED' | 'REJECTED':
+                callback = self.claims.pop(rest, None)
+                if callback is not None:
+                    callback(rest, command == 'CLAIMED')
+            case _:
+                apply_remote_message(self, command, rest)
+
+    # Worker cannot keep its state consistent with the rest of the cluster without the bus
+    def connection_lost(self, exc):
+        print('Unexpected Error: Cluster bus has closed')
+        os._exit(1)
+
+# Apply a change published by another worker process to this worker's server state
+# Only users added through the same bus may be changed by it
+# Takes the bus the message arrived on, String, and String as arguments
+def apply_remote_message(bus, command, rest):
+    match command:
+        case 'USER_ADD':
+            client = server.Connection(RemoteSocket(bus, rest), rest, remote=True)
+            if server.add_client(client):
+                # Forward the messages kept on this worker while the user was disconnected
+                server.deliver_offline_messages(client)
+        case 'USER_REMOVE':
+            client = find_remote_client(bus, rest)
+            if client is not None:
+                server.close_connection(client)
+        case 'ROOM_JOIN':
+            room_name, user_name = rest.split(':', 1)
+            client = find_remote_client(bus, user_name)
+            if client is not None:
+                server.add_room_member(room_name, client)
+        case 'ROOM_LEAVE':
+            room_name, user_name = rest.split(':', 1)
+            client = find_remote_client(bus, user_name)
+            room = server.find_chat_room(room_name)
+            if client is not None and room is not None:
+                server.remove_room_member(room, client)
+        case 'ROOM_MESSAGE':
+            # Deliver to the members of the room connected to this worker and keep it in the room's history
+            room_name, msg = rest.split(':', 1)
+            room = server.find_chat_room(room_name)
+            if room is not None:
+                server.deliver_remote_room_message(room, msg)
+        case 'USER_MESSAGE':
+            user_name, msg = rest.split(':', 1)
+            client = server.find_client(user_name)
+            if client is not None and not client.remote:
+                server.send_message(client.socket, msg)
+
+# Find a user who was added by the bus passed as argument
+# Returns Connection object, or None if the user is not connected through that bus
+# Takes the bus and String as arguments
+def find_remote_client(bus, user_name):
+    client = server.find_client(user_name)
+    if client is not None and client.remote and client.socket.bus is bus:
+        return client
+    return None
+
+# Connect to the cluster bus and serve clients on the shared port
+# Each worker loads the certificate itself, since an ssl.SSLContext cannot be passed to another process
+# Takes Integer, String, Tuple of (String host, Integer port, Integer backlog, String or None certificate file,
+# String or None key file), and Integer or None as arguments
+async def run_worker(index, bus_path, listen_on, metrics_port):
+    loop = asyncio.get_running_loop()
+    transport, bus = await loop.create_unix_connection(BusClient, bus_path)
+    # A bus socket opened by another user is not trusted with the worker's users and messages
+    if not handoff.trusted_peer(transport.get_extra_info('socket')):
+        transport.close()
+        print('Unexpected Error: Cluster bus at {} is run by another user'.format(bus_path))
+        return
+    bus.publish('HELLO:{}'.format(index))
+    server.cluster = bus
+    # Each worker serves the metrics of the clients connected to it on its own port, unless metrics are turned off,
+    # and logs every room and message it sees to its own directory, so each worker recovers the whole cluster's rooms
+    log_directory = None
+    if message_log.LOG_DIRECTORY is not None:
+        log_directory = os.path.join(message_log.LOG_DIRECTORY, 'worker{}'.format(index))
+    if metrics_port is not None:
+        metrics_port += 1 + index
+    host, port, backlog, cert_file, key_file = listen_on
+    await async_server.main(host, port, backlog, reuse_port = True, metrics_port = metrics_port,
+                            log_directory = log_directory, handoff_path = None, cert_file = cert_file,
+                            key_file = key_file)
+
+# Entry point of each worker process
+# Takes Integer, String, Tuple of (String, Integer, Integer, String or None, String or None), and Integer or None
+# as arguments
+def worker_process(index, bus_path, listen_on, metrics_port):
+    try:
+        asyncio.run(run_worker(index, bus_path, listen_on, metrics_port))
+    except KeyboardInterrupt:
+        pass
+
+# ==============================================================================================
+#                                       Cluster Bus
+# ==============================================================================================
+
+# Cluster state kept by the bus so workers can be told about users and rooms that existed before they connected
+# {
+#     'workers': [BusConnection],
+#     'users': {String: BusConnection} (worker each user is connected to),
+#     'rooms': {String: {String: None}} (members of each chat room)
+# }
+bus_state = {
+    'workers': [],
+    'users': {},
+    'rooms': {}
+}
+
+# Connection from the bus to one worker process
+class BusConnection(asyncio.Protocol):
+    __slots__ = ('transport', 'reader', 'index', 'rooms')
+
+    def __init__(self):
+        self.transport = None
+        self.reader = framing.FrameReader()
+        self.index = None
+        # Number of users connected to this worker in each chat room they are members of
+        self.rooms = {}
+
+    # Workers run by another user are disconnected before they can send anything
+    def connection_made(self, transport):
+        self.transport = transport
+        if not handoff.trusted_peer(transport.get_extra_info('socket')):
+            print('Unexpected Error: Refused a cluster bus connection from another user')
+            transport.close()
+
+    # Send a message to this worker
+    # Takes String as argument
+    def send(self, msg):
+        self.transport.write(framing.encode_frame(msg))
+
+    # Send a message to every worker except this one
+    # Takes String as argument
+    def forward(self, msg):
+        data = framing.encode_frame(msg)
+        for worker in bus_state['workers']:
+            if worker is not self:
+                worker.transport.write(data)
+
+    # Send a chat message to every other worker with members in a chat room
+    # Takes String and String as arguments
+    def forward_room_message(self, room_name, msg):
+        data = framing.encode_frame(msg)
+        for worker in bus_state['workers']:
+            if worker is not self and room_name in worker.rooms:
+                worker.transport.write(data)
+
+    # Count a member connected to this worker in a chat room
+    # Takes String as argument
+    def add_member(self, room_name):
+        self.rooms[room_name] = self.rooms.get(room_name, 0) + 1
+
+    # Stop counting a member connected to this worker in a chat room
+    # Takes String as argument
+    def remove_member(self, room_name):
+        count = self.rooms.get(room_name, 0) - 1
+        if count > 0:
+            self.rooms[room_name] = count
+        else:
+            self.rooms.pop(room_name, None)
+
+    # Takes bytes as argument
+    def data_received(self, data):
+        self.reader.feed(data)
+        for frame in self.reader.drain():
+            self.handle_message(frame.decode())
+
+    # Update the cluster state and forward a message from a worker to the workers it concerns
+    # Takes String as argument
+    def handle_message(self, frame):
+        command, _, rest = frame.partition(':')
+        users = bus_state['users']
+        rooms = bus_state['rooms']
+        match command:
+            case 'HELLO':
+                self.index = rest
+                bus_state['workers'].append(self)
+                # Tell the new worker about every user and room membership in the cluster
+                for user_name, worker in users.items():
+                    if worker is not self:
+                        self.send('USER_ADD:{}'.format(user_name))
+                for room_name, members in rooms.items():
+                    for user_name in members:
+                        self.send('ROOM_JOIN:{}:{}'.format(room_name, user_name))
+            case 'CLAIM':
+                if rest in users:
+                    self.send('REJECTED:{}'.format(rest))
+                else:
+                    users[rest] = self
+                    self.send('CLAIMED:{}'.format(rest))
+                    self.forward('USER_ADD:{}'.format(rest))
+            case 'RELEASE':
+                if users.get(rest) is self:
+                    self.remove_user(rest)
+            case 'ROOM_JOIN':
+                room_name, user_name = rest.split(':', 1)
+                members = rooms.setdefault(room_name, {})
+                if user_name not in members and users.get(user_name) is self:
+                    members[user_name] = None
+                    self.add_member(room_name)
+                self.forward(frame)
+            case 'ROOM_LEAVE':
+                room_name, user_name = rest.split(':', 1)
+                members = rooms.get(room_name, {})
+                if user_name in members and users.get(user_name) is self:
+                    del members[user_name]
+                    self.remove_member(room_name)
+                self.forward(frame)
+            case 'ROOM_MESSAGE':
+                self.forward_room_message(rest.split(':', 1)[0], frame)
+            case 'USER_MESSAGE':
+                user_name = rest.split(':', 1)[0]
+                worker = users.get(user_name)
+                if worker is not None and worker is not self:
+                    worker.send(frame)
+
+    # Remove a user connected to this worker from the cluster state and tell the other workers
+    # Takes String as argument
+    def remove_user(self, user_name):
+        del bus_state['users'][user_name]
+        for room_name, members in bus_state['rooms'].items():
+            if user_name in members:
+                del members[user_name]
+                self.remove_member(room_name)
+        self.forward('USER_REMOVE:{}'.format(user_name))
+
+    # Remove every user of a worker that has stopped
+    def connection_lost(self, exc):
+        if self in bus_state['workers']:
+            bus_state['workers'].remove(self)
+        for user_name, worker in list(bus_state['users'].items()):
+            if worker is self:
+                self.remove_user(user_name)
+        if self.index is not None:
+            print('Worker {} has stopped'.format(self.index))
+
+# Returns String path of the bus socket in the runtime directory of the user running the cluster
+# The runtime directory is $XDG_RUNTIME_DIR if it is set, otherwise a directory for the user in the temporary
+# directory, which is created so only the user may enter it and refused if another user owns it or may enter it
+def default_bus_path():
+    directory = os.environ.get('XDG_RUNTIME_DIR')
+    if not directory:
+        directory = os.path.join(tempfile.gettempdir(), 'irc_server.{}'.format(os.getuid()))
+        try:
+            os.mkdir(directory, 0o700)
+        except FileExistsError:
+            pass
+        # lstat() so a symbolic link to a directory another user controls is refused rather than followed
+        status = os.lstat(directory)
+        if (not stat.S_ISDIR(status.st_mode) or status.st_uid != os.getuid()
+                or stat.S_IMODE(status.st_mode) & 0o077):
+            raise PermissionError('{} is not a directory only this user may enter'.format(directory))
+    return os.path.join(directory, BUS_NAME)
+
+# Open the bus socket the worker processes connect to
+# A socket file left by a cluster that has stopped is replaced, but any other file at the path is kept,
+# and only the user running the cluster may connect to the new socket
+# Returns socket object
+# Takes String and Integer as arguments
+def open_bus(path, backlog):
+    try:
+        if not stat.S_ISSOCK(os.lstat(path).st_mode):
+            raise FileExistsError('{} exists and is not a socket'.format(path))
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+    bus_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        bus_socket.bind(path)
+        os.chmod(path, 0o600)
+        bus_socket.listen(backlog)
+    except OSError:
+        bus_socket.close()
+        raise
+    return bus_socket
+
+# Run the cluster bus on a Unix socket that is already listening
+# Takes socket object as argument
+async def run_bus(bus_socket):
+    loop = asyncio.get_running_loop()
+    bus = await loop.create_unix_server(BusConnection, sock = bus_socket)
+    async with bus:
+        await bus.serve_forever()
+
+# ==============================================================================================
+#                                     Cluster Program
+# ==============================================================================================
+
+# Start the cluster bus and the worker processes that serve clients
+# The address and backlog the workers listen with default to the settings in server.py,
+# and each worker serves its metrics on the port after the previous worker's, starting after metrics_port
+# Workers serve clients over TLS with the given certificate and key files, or over plain TCP when passed None
+# The bus socket is kept in the user's runtime directory when bus_path is None
+# Takes Integer, String or None, String, Integer, Integer, Integer, String or None, and String or None as arguments
+def main(worker_count=WORKER_COUNT, bus_path=BUS_PATH, host=None, port=None, backlog=None,
+         metrics_port=metrics.METRICS_PORT, cert_file=tls.CERT_FILE, key_file=tls.KEY_FILE):
+    if bus_path is None:
+        bus_path = default_bus_path()
+    # Bus socket is listening before workers start, so workers can connect as soon as they are running
+    bus_socket = open_bus(bus_path, worker_count)
+
+    context = multiprocessing.get_context('fork')
+    listen_on = (host, port, backlog, cert_file, key_file)
+    workers = [context.Process(target=worker_process, args=(index, bus_path, listen_on, metrics_port))
+               for index in range(worker_count)]
+    for worker in workers:
+        worker.start()
+    print('IRC Server cluster started {} workers'.format(worker_count))
+
+    try:
+        asyncio.run(run_bus(bus_socket))
+
+    # End program if unexpected error occurs
+    except BaseException as E:
+        print('Unexpected Error: All connections have closed')
+        print(E)
+    finally:
+        for worker in workers:
+            worker.terminate()
+        for worker in workers:
+            worker.join()
+        os.unlink(bus_path)
+
+if __name__ == '__main__':
+    parser = server.argument_parser('Run a cluster of IRC server worker processes sharing one port')
+    parser.add_argument('--workers', type=int, default=WORKER_COUNT, help='number of worker processes')
+    parser.add_argument('--bus-path', default=BUS_PATH,
+                        help='Unix socket the workers reach the cluster bus on (default: in the user\'s runtime '
+                             'directory)')
+    args = parser.parse_args()
+    main(args.workers, args.bus_path, args.host, args.port, args.backlog, args.metrics_port, args.certfile,
+         args.keyfile)
@@ -0,0 +1,358 @@
+import asyncio
+import hashlib
+import hmac
+import secrets
+import async_server
+import cluster
+import framing
+import metrics
+import server
+import tls
+
+# ==============================================================================================
+#                                   Federation Settings
+# ==============================================================================================
+
+# Address and port each server listens on for links from other servers in the network
+# Links are only accepted from this machine unless the address is changed, since a linked server can act for
+# any user, so servers on other machines should also share a LINK_SECRET
+LINK_HOST = '127.0.0.1'
+LINK_PORT = 2788
+# Secret every server in the network is started with, which each end of a link proves it knows before the link
+# is used, or None to accept links without proof
+# The secret itself is never sent, but links are plain TCP, so messages sent over them can still be read
+LINK_SECRET = None
+# Seconds to wait before reconnecting to a server whose link has closed
+RELINK_INTERVAL = 5
+
+# ==============================================================================================
+#                                      Link Messages
+# ==============================================================================================
+
+# Servers in a network are linked to each other in a full mesh, and each server only sends changes made by its
+# own clients, so messages are never forwarded between links
+# Linked servers exchange newline delimited messages with the following formats:
+#
+#     LINK:node_name:challenge              First message sent by both ends of a new link, with random hex digits
+#     AUTH:proof                            Sent by both ends after LINK when the servers share a secret, proving
+#                                           the sender knows the secret without sending it
+#     CLAIM:user_name                       Ask to reserve a user name for a new client
+#     CLAIMED:user_name                     User name is free on the answering server and is reserved
+#     REJECTED:user_name                    User name is in use or reserved on the answering server
+#     USER_ADD:user_name                    User has connected to the sending server
+#     RELEASE:user_name                     User has disconnected, or a reserved user name is no longer needed
+#     ROOM_JOIN:room_name:user_name         User has joined a chat room
+#     ROOM_LEAVE:room_name:user_name        User has left a chat room
+#     ROOM_MESSAGE:room_name:message        Message for the members of a chat room connected to the receiving server
+#     USER_MESSAGE:user_name:message        Message for a user connected to the receiving server
+#
+# After both LINK messages, and both AUTH messages when the servers share a secret, each server sends USER_ADD
+# and ROOM_JOIN messages for all of its own clients
+
+# ==============================================================================================
+#                                       Federation
+# ==============================================================================================
+
+# Connects this server to the other servers of a network
+# Set as server.cluster so the message handlers in server.py share their changes with the linked servers
+class Federation:
+    __slots__ = ('node_name', 'secret', 'links', 'claims', 'reserved')
+
+    # Takes String and String or None as arguments
+    def __init__(self, node_name, secret=LINK_SECRET):
+        self.node_name = node_name
+        self.secret = secret
+        # Links to other servers, indexed by the name of the linked server
+        self.links = {}
+        # User name claims waiting for answers from linked servers, indexed by user name
+        # {
+        #     'callback': function called with the user name and True if the claim succeeded,
+        #     'waiting': {PeerLink} (links that have not answered yet)
+        # }
+        self.claims = {}
+        # User names reserved for clients of linked servers, mapped to the link that reserved them
+        self.reserved = {}
+
+    # Send a message to every linked server
+    # Takes String as argument
+    def publish(self, msg):
+        data = framing.encode_frame(msg)
+        for link in self.links.values():
+            link.transport.write(data)
+
+    # Reserve a user name on every linked server, calling callback with the user name and True if it was reserved
+    # Takes String and function as arguments
+    def claim(self, user_name, callback):
+        if user_name in self.claims or user_name in self.reserved:
+            callback(user_name, False)
+            return
+        if not self.links:
+            callback(user_name, True)
+            return
+        self.claims[user_name] = {
+            'callback': callback,
+            'waiting': set(self.links.values())
+        }
+        self.publish('CLAIM:{}'.format(user_name))
+
+    # Record a linked server's answer to a user name claim
+    # Takes PeerLink object, String, and Boolean as arguments
+    def claim_answered(self, link, user_name, granted):
+        claim = self.claims.get(user_name)
+        if claim is None or link not in claim['waiting']:
+            return
+        claim['waiting'].discard(link)
+
+        if not granted:
+            del self.claims[user_name]
+            # Free the reservation on servers that had already accepted the claim
+            self.publish('RELEASE:{}'.format(user_name))
+            claim['callback'](user_name, False)
+        elif not claim['waiting']:
+            del self.claims[user_name]
+            self.publish('USER_ADD:{}'.format(user_name))
+            claim['callback'](user_name, True)
+
+    def user_left(self, user_name):
+        self.publish('RELEASE:{}'.format(user_name))
+
+    def room_joined(self, room_name, user_name):
+        self.publish('ROOM_JOIN:{}:{}'.format(room_name, user_name))
+
+    def room_left(self, room_name, user_name):
+        self.publish('ROOM_LEAVE:{}:{}'.format(room_name, user_name))
+
+    # Send a chat message once to each linked server that has members in the chat room
+    # Takes String and String as arguments
+    def room_message(self, room_name, msg):
+        room = server.find_chat_room(room_name)
+        if room is None:
+            return
+        links = {member.socket.bus for member in server.room_members(room) if member.remote}
+        if links:
+            data = framing.encode_frame('ROOM_MESSAGE:{}:{}'.format(room_name, msg))
+            for link in links:
+                link.transport.write(data)
+
+    # Returns String proof that a server knows the network's secret, answering a challenge sent by a linked server
+    # The proof includes the name of the server answering, so a proof cannot be sent back to the server it came from
+    # Takes String challenge and String name of the server answering as arguments
+    def proof(self, challenge, node_name):
+        message = '{}:{}'.format(challenge, node_name).encode()
+        return hmac.new(self.secret.encode(), message, hashlib.sha256).hexdigest()
+
+    # Add a link once the linked server has sent its name, and proved it knows the secret if the network has one
+    # Returns False if this server is already linked to the named server
+    # Takes PeerLink object as argument
+    def link_added(self, link):
+        if link.node_name == self.node_name or link.node_name in self.links:
+            return False
+        self.links[link.node_name] = link
+        print('Linked with server {}'.format(link.node_name))
+
+        # Tell the linked server about this server's own clients
+        with server.registry_lock:
+            local_clients = [client for client in server.clients.values() if not client.remote]
+        for client in local_clients:
+            link.send('USER_ADD:{}'.format(client.user_name))
+            for room_name in list(client.rooms):
+                link.send('ROOM_JOIN:{}:{}'.format(room_name, client.user_name))
+        return True
+
+    # Remove a closed link along with every user, reservation, and pending claim answer that depended on it
+    # Takes PeerLink object as argument
+    def link_lost(self, link):
+        if self.links.get(link.node_name) is not link:
+            return
+        del self.links[link.node_name]
+        print('Link with server {} has closed'.format(link.node_name))
+
+        with server.registry_lock:
+            remote_clients = [client for client in server.clients.values()
+                              if client.remote and client.socket.bus is link]
+        for client in remote_clients:
+            server.close_connection(client)
+
+        for user_name, owner in list(self.reserved.items()):
+            if owner is link:
+                del self.reserved[user_name]
+
+        # Claims no longer need an answer from the closed link
+        for user_name in list(self.claims):
+            self.claim_answered(link, user_name, True)
+
+# Link between this server and one other server in the network
+class PeerLink(asyncio.Protocol):
+    __slots__ = ('federation', 'transport', 'reader', 'challenge', 'node_name', 'authenticated', 'closed')
+
+    # Takes Federation object as argument
+    def __init__(self, federation):
+        self.federation = federation
+        self.transport = None
+        self.reader = framing.FrameReader()
+        # Random hex digits the linked server answers with its proof of the secret
+        self.challenge = secrets.token_hex(16)
+        # Name of the linked server, set once it has sent its LINK message
+        self.node_name = None
+        # Set to True once the linked server has proved it knows the secret, or sent its name if there is no secret
+        self.authenticated = False
+        self.closed = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.closed = asyncio.get_running_loop().create_future()
+        self.send('LINK:{}:{}'.format(self.federation.node_name, self.challenge))
+
+    # Send a message to the linked server
+    # Takes String as argument
+    def send(self, msg):
+        self.transport.write(framing.encode_frame(msg))
+
+    # Forward a message to a user connected to the linked server
+    # Takes String and String as arguments
+    def user_message(self, user_name, msg):
+        self.send('USER_MESSAGE:{}:{}'.format(user_name, msg))
+
+    # Takes bytes as argument
+    def data_received(self, data):
+        try:
+            self.reader.feed(data)
+            for frame in self.reader.drain():
+                self.handle_message(frame.decode())
+
+        # End link if unexpected error occurs
+        except Exception as E:
+            print('Unexpected Error: Link has closed')
+            print(E)
+            self.transport.close()
+
+    # Apply a message from the linked server to this server's state
+    # Takes String as argument
+    def handle_message(self, frame):
+        command, _, rest = frame.partition(':')
+        federation = self.federation
+
+        # Linked server must send its name, and then its proof of the secret, before any other message
+        if self.node_name is None:
+            if command != 'LINK':
+                raise ValueError('Linked server did not send its name')
+            self.node_name, _, challenge = rest.partition(':')
+            if federation.secret is None:
+                self.link_authenticated()
+            else:
+                self.send('AUTH:{}'.format(federation.proof(challenge, federation.node_name)))
+            return
+        if not self.authenticated:
+            if command != 'AUTH' or not hmac.compare_digest(rest, federation.proof(self.challenge, self.node_name)):
+                raise ValueError('Linked server did not prove it knows the secret')
+            self.link_authenticated()
+            return
+
+        match command:
+            case 'CLAIM':
+                self.send('{}:{}'.format('CLAIMED' if self.grant_claim(rest) else 'REJECTED', rest))
+            case 'CLAIMED' | 'REJECTED':
+                federation.claim_answered(self, rest, command == 'CLAIMED')
+            case 'USER_ADD':
+                if federation.reserved.get(rest) is self:
+                    del federation.reserved[rest]
+                if server.find_client(rest) is not None:
+                    print('Unexpected Error: {} is connected to this server and to server {}'.format(rest, self.node_name))
+                cluster.apply_remote_message(self, 'USER_ADD', rest)
+            case 'RELEASE':
+                if federation.reserved.get(rest) is self:
+                    del federation.reserved[rest]
+                cluster.apply_remote_message(self, 'USER_REMOVE', rest)
+            case _:
+                cluster.apply_remote_message(self, command, rest)
+
+    # Start using the link once the linked server is trusted
+    def link_authenticated(self):
+        self.authenticated = True
+        if not self.federation.link_added(self):
+            self.transport.close()
+
+    # Decide whether a user name claimed by the linked server can be reserved for it
+    # When both servers claim the same name at once, the server whose name sorts first keeps it
+    # Returns True if the user name was reserved
+    # Takes String as argument
+    def grant_claim(self, user_name):
+        federation = self.federation
+        if server.find_client(user_name) is not None:
+            return False
+        owner = federation.reserved.get(user_name)
+        if owner is not None and owner is not self:
+            return False
+        if user_name in federation.claims and federation.node_name < self.node_name:
+            return False
+        federation.reserved[user_name] = self
+        return True
+
+    def connection_lost(self, exc):
+        if self.authenticated:
+            self.federation.link_lost(self)
+        if not self.closed.done():
+            self.closed.set_result(None)
+
+# ==============================================================================================
+#                                    Federation Program
+# ==============================================================================================
+
+# Keep a link open to another server, reconnecting whenever the link closes
+# Takes Federation object, String, and Integer as arguments
+async def maintain_link(federation, host, port):
+    loop = asyncio.get_running_loop()
+    while True:
+        try:
+            _, link = await loop.create_connection(lambda: PeerLink(federation), host, port)
+            await link.closed
+        except OSError as E:
+            print('Unexpected Error: Could not link with {}:{}'.format(host, port))
+            print(E)
+        await asyncio.sleep(RELINK_INTERVAL)
+
+# Serve clients while linked with the other servers in the network
+# Clients connect to the host, which defaults to the setting in server.py, and other servers link to the link host
+# Clients are served over TLS with the given certificate and key files, or over plain TCP when passed None,
+# while links between servers stay plain TCP
+# Takes Federation object, Integer, List of (String, Integer) tuples, Integer, String, Integer, Integer,
+# String or None, String or None, and String as arguments
+async def run_node(federation, link_port, peers, metrics_port=metrics.METRICS_PORT, host=None, port=None,
+                   backlog=None, cert_file=tls.CERT_FILE, key_file=tls.KEY_FILE, link_host=LINK_HOST):
+    loop = asyncio.get_running_loop()
+    host = server.HOST if host is None else host
+    await loop.create_server(lambda: PeerLink(federation), link_host, link_port)
+    print('Server {} is accepting links on {}:{}'.format(federation.node_name, link_host, link_port))
+
+    # The event loop only keeps weak references to tasks, so the tasks are kept until the server stops
+    link_tasks = [loop.create_task(maintain_link(federation, peer_host, peer_port)) for peer_host, peer_port in peers]
+    try:
+        await async_server.main(host, port, backlog, metrics_port = metrics_port, handoff_path = None,
+                                cert_file = cert_file, key_file = key_file)
+    finally:
+        for task in link_tasks:
+            task.cancel()
+
+if __name__ == '__main__':
+    parser = server.argument_parser('Run an IRC server linked with other servers')
+    parser.add_argument('node_name', help='name of this server, unique within the network')
+    parser.add_argument('--link-host', default=LINK_HOST, help='address to listen on for links from other servers')
+    parser.add_argument('--link-port', type=int, default=LINK_PORT, help='port other servers link to')
+    parser.add_argument('--link-secret', default=LINK_SECRET,
+                        help='secret shared by every server in the network, so links from other machines can be trusted')
+    parser.add_argument('--peer', action='append', default=[], metavar='HOST:PORT',
+                        help='link port of another server to connect to, may be repeated')
+    args = parser.parse_args()
+
+    federation = Federation(args.node_name, args.link_secret)
+    server.cluster = federation
+    peers = [(peer.rpartition(':')[0], int(peer.rpartition(':')[2])) for peer in args.peer]
+
+    try:
+        asyncio.run(run_node(federation, args.link_port, peers, args.metrics_port, args.host, args.port,
+                             args.backlog, args.certfile, args.keyfile, args.link_host))
+
+    # End program if unexpected error occurs
+    except BaseException as E:
+        print('Unexpected Error: All connections have closed')
+        print(E)
@@ -0,0 +1,212 @@
+import os
+from collections import deque
+import tls
+
+# ==============================================================================================
+#                                    Framing Settings
+# ==============================================================================================
+
+# Every message sent over a TCP connection ends with this delimiter so the receiver can find message boundaries
+# TCP may merge several messages into one read or split one message across reads
+DELIMITER = b'\n'
+# Largest message accepted by a receiver, not counting the delimiter
+# Leaves room for a 500 character payload, two 50 character parameters, the command, and multi-byte characters
+MAX_FRAME_LENGTH = 4096
+# Size of the buffer a connection receives bytes into while it is idle or sends a few messages at a time,
+# and the largest size it grows to while the client sends faster than the server reads
+# Every connection keeps its buffer while it waits for the next read, so idle connections keep the small size
+INITIAL_RECV_SIZE = 512
+RECV_SIZE = 65536
+# Byte value of the carriage return that may come before the delimiter
+CARRIAGE_RETURN = ord('\r')
+# Largest number of buffers written by one sendmsg() call
+IOV_MAX = os.sysconf('SC_IOV_MAX') if hasattr(os, 'sysconf') else 1024
+
+# ==============================================================================================
+#                                    Framing Functions
+# ==============================================================================================
+
+# Encode a message and append the delimiter that marks the end of the message
+# Returns bytes
+# Takes String as argument
+def encode_frame(msg):
+    return msg.encode() + DELIMITER
+
+# An encoded message waiting to be sent is either bytes or a Tuple of bytes-like parts
+# Relayed messages are built from parts, so the body received from the sender is sent without being copied
+
+# Returns the number of bytes in an encoded message
+# Takes bytes or Tuple of bytes-like objects as argument
+def frame_size(frame):
+    if type(frame) is tuple:
+        return sum(map(len, frame))
+    return len(frame)
+
+# Returns an encoded message as a single bytes object
+# Takes bytes or Tuple of bytes-like objects as argument
+def frame_bytes(frame):
+    if type(frame) is tuple:
+        return b''.join(frame)
+    return frame
+
+# Returns List of the buffers holding a group of encoded messages, in order
+# Takes iterable of encoded messages as argument
+def frame_buffers(frames):
+    buffers = []
+    for frame in frames:
+        if type(frame) is tuple:
+            buffers.extend(frame)
+        else:
+            buffers.append(frame)
+    return buffers
+
+# Write a List of buffers to a socket with as few system calls as possible
+# Buffers are gathered by the kernel with sendmsg(), so they are never joined into one bytes object
+# A TLS socket encrypts the bytes itself and cannot gather buffers, so they are joined and encrypted together
+# Takes socket object and List of bytes-like objects as arguments
+def send_buffers(sock, buffers):
+    if not hasattr(sock, 'sendmsg') or tls.encrypted(sock):
+        sock.sendall(b''.join(buffers))
+        return
+
+    while buffers:
+        sent = sock.sendmsg(buffers[:IOV_MAX])
+        # Skip the buffers that were sent completely and keep the unsent part of a partially sent buffer
+        index = 0
+        while index < len(buffers) and sent >= len(buffers[index]):
+            sent -= len(buffers[index])
+            index += 1
+        buffers = buffers[index:]
+        if sent:
+            buffers[0] = memoryview(buffers[0])[sent:]
+
+# Collects bytes received from a TCP connection and splits them into complete messages
+# One reader is kept for each connection so partial messages are held until the rest of the message arrives
+# Bytes are received directly into a buffer kept for the connection, and each complete message
+# is copied out of it once as bytes, which later stages slice without copying
+# The buffer doubles while reads fill it, up to RECV_SIZE, and returns to INITIAL_RECV_SIZE after a small read,
+# so only connections that are receiving many messages at once keep a large buffer
+class FrameReader:
+    __slots__ = ('sock', 'buffer', 'view', 'start', 'end', 'next_size', 'frames')
+
+    # Takes socket object as argument
+    # The socket may be None if received bytes are passed to feed() or received() by the caller
+    def __init__(self, sock=None):
+        self.sock = sock
+        self.buffer = bytearray(INITIAL_RECV_SIZE)
+        self.view = memoryview(self.buffer)
+        # Received bytes that have not been split into messages yet are buffer[start:end]
+        self.start = 0
+        self.end = 0
+        # Size of the buffer for the next read, chosen from how much the last read received
+        self.next_size = INITIAL_RECV_SIZE
+        self.frames = deque()
+
+    # Returns memoryview of the free space at the end of the buffer for the next read
+    # The buffer is replaced when the next read needs a different size, and a partial message is moved to the
+    # front of the buffer once less than a quarter of the buffer is free after it
+    # The buffer always has room for twice the partial message, which is at most MAX_FRAME_LENGTH bytes
+    def get_buffer(self):
+        length = self.end - self.start
+        size = self.next_size
+        while size < 2 * length:
+            size *= 2
+        if size != len(self.buffer):
+            buffer = bytearray(size)
+            buffer[:length] = self.view[self.start:self.end]
+            self.buffer = buffer
+            self.view = memoryview(buffer)
+            self.start = 0
+            self.end = length
+        elif size - self.end < size // 4:
+            self.view[:length] = self.view[self.start:self.end]
+            self.start = 0
+            self.end = length
+        return self.view[self.end:]
+
+    # Queue every message completed by bytes that were written into the buffer returned by get_buffer()
+    # Returns the number of messages that are ready to be read
+    # Raises ValueError if a message exceeds the maximum message length
+    # Takes Integer as argument
+    def received(self, nbytes):
+        buffer = self.buffer
+        # Only search the newly received bytes, since older buffered bytes are known not to contain a delimiter
+        search_start = self.end
+        self.end += nbytes
+
+        start = self.start
+        end = buffer.find(DELIMITER, search_start, self.end)
+        while end != -1:
+            if end - start > MAX_FRAME_LENGTH:
+                raise ValueError('Message has exceeded allowed length of {} bytes'.format(MAX_FRAME_LENGTH))
+            # Accept CRLF line endings from clients such as telnet
+            frame_end = end - 1 if end > start and buffer[end - 1] == CARRIAGE_RETURN else end
+            # Ignore empty lines between messages
+            if frame_end > start:
+                self.frames.append(bytes(self.view[start:frame_end]))
+            start = end + len(DELIMITER)
+            end = buffer.find(DELIMITER, start, self.end)
+
+        # A read that filled the buffer suggests more bytes are waiting, so the next read gets a larger buffer
+        size = len(buffer)
+        if self.end == size:
+            self.next_size = min(2 * size, RECV_SIZE)
+        elif nbytes <= INITIAL_RECV_SIZE // 2:
+            self.next_size = INITIAL_RECV_SIZE
+
+        # Reuse the whole buffer once every received byte belongs to a complete message
+        if start == self.end:
+            start = self.end = 0
+        self.start = start
+        if self.end - start > MAX_FRAME_LENGTH:
+            raise ValueError('Message has exceeded allowed length of {} bytes'.format(MAX_FRAME_LENGTH))
+        return len(self.frames)
+
+    # Add bytes received by the caller to the buffer and queue every message completed by them
+    # Returns the number of messages that are ready to be read
+    # Raises ValueError if a message exceeds the maximum message length
+    # Takes bytes as argument
+    def feed(self, data):
+        data = memoryview(data)
+        while data:
+            free = self.get_buffer()
+            nbytes = min(len(free), len(data))
+            free[:nbytes] = data[:nbytes]
+            self.received(nbytes)
+            data = data[nbytes:]
+        return len(self.frames)
+
+    # Read once from the socket and queue every message completed by the bytes received
+    # Returns the number of messages that are ready to be read
+    # Raises ConnectionError if the connection is closed
+    def receive(self):
+        nbytes = self.sock.recv_into(self.get_buffer())
+        if not nbytes:
+            raise ConnectionError('Connection closed by peer')
+        return self.received(nbytes)
+
+    # Returns the next complete message as bytes, reading from the socket until one is available
+    # Raises ConnectionError if the connection is closed before a complete message is received
+    def read_frame(self):
+        while not self.frames:
+            self.receive()
+        return self.frames.popleft()
+
+    # Remove every received byte that has not been read as a message, so another reader can continue from
+    # where this reader stopped, with any messages that were already split off encoded again in front of them
+    # Returns bytes
+    # Takes bytes of a message that was read but not handled, which is put back first, as argument
+    def unread_bytes(self, frame=None):
+        frames = list(self.frames)
+        if frame is not None:
+            frames.insert(0, frame)
+        data = b''.join(frame + DELIMITER for frame in frames) + bytes(self.view[self.start:self.end])
+        self.frames.clear()
+        self.start = self.end = 0
+        return data
+
+    # Returns every complete message that has been received so far as a List of bytes
+    def drain(self):
+        frames = list(self.frames)
+        self.frames.clear()
+        return frames
@@ -0,0 +1,183 @@
+import os
+import socket
+import struct
+import framing
+import keepalive
+
+# ==============================================================================================
+#                                    Handoff Settings
+# ==============================================================================================
+
+# Unix socket a server started from the command line listens on for a new server process that takes over its
+# connections, with the user ID and port filled in so only a server run by the same user for the same port takes
+# over, or None to stop the old server and start the new one instead
+# Servers started by another program, such as a test, only listen for a new server when given a path
+HANDOFF_PATH = '/tmp/irc_server_handoff.{uid}.{port}.sock'
+# Seconds a draining server waits for its connections to be handed over before closing the rest
+# Each connection of the threaded server is handed over once it sends another message, which a live client
+# does within every keepalive window
+DRAIN_TIMEOUT = keepalive.KEEP_ALIVE_WINDOW
+# Largest record received from the old server, which is at most one client's unread bytes and its user name
+MAX_RECORD_SIZE = framing.RECV_SIZE + 1024
+
+# ==============================================================================================
+#                                     Handoff Records
+# ==============================================================================================
+
+# A new server process connects to the old server's handoff socket, and the servers exchange one record
+# in each packet with the following formats:
+#
+# New server to old server:
+#     TAKEOVER                              Hand every connection and the listening socket over
+#
+# Old server to new server:
+#     ROOM:room_name                        Chat room, in the order the rooms were created
+#     HISTORY:room_name:message             Recent message of a chat room, oldest first, only sent when the old
+#                                           server has no message log for the new server to recover
+#     CLIENT:user_name:unread               Client connection, with the connection's socket attached
+#                                           The user name is empty if the client has not registered, and unread
+#                                           holds the bytes received from the client that were not handled yet
+#     JOINED:room_name                      Chat room the client in the last CLIENT record is a member of
+#     COMPRESSED:algorithm                  Messages to the client in the last CLIENT record are compressed,
+#                                           and the old server has ended its compressed stream so the new server
+#                                           starts a new one
+#     LISTENER                              Listening socket, with the socket attached, always the last record
+#
+# Connection requests wait in the listening socket's backlog until the new server receives it,
+# so no connection is refused while the servers hand over
+
+TAKEOVER = b'TAKEOVER'
+
+# ==============================================================================================
+#                                    Handoff Functions
+# ==============================================================================================
+
+# Returns the handoff socket path of a server started from the command line
+# Takes String path given on the command line, None if no path was given, or an empty String for no handoff socket,
+# and Integer port the server listens on as arguments
+def command_line_path(path, port):
+    if path is None:
+        return None if HANDOFF_PATH is None else HANDOFF_PATH.format(uid = os.getuid(), port = port)
+    return path or None
+
+# Returns True if the process at the other end of a handoff socket connection is run by the same user as this one
+# Systems without SO_PEERCRED rely on the handoff socket file only being writable by its owner
+# Takes socket object as argument
+def trusted_peer(link):
+    if not hasattr(socket, 'SO_PEERCRED'):
+        return True
+    credentials = link.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, struct.calcsize('3i'))
+    pid, uid, gid = struct.unpack('3i', credentials)
+    return uid == os.getuid()
+
+# Open the handoff socket a new server process connects to when it takes over from this server
+# A socket file left by a server that has stopped is replaced, and only the user running the server
+# may connect to the new file
+# Returns socket object
+# Takes String as argument
+def open_handoff(path):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    try:
+        listener.bind(path)
+        os.chmod(path, 0o600)
+        listener.listen(1)
+    except OSError:
+        listener.close()
+        raise
+    return listener
+
+# Ask the server listening on a handoff socket to hand its connections over to this process
+# A socket opened by another user is not trusted to hand over connections
+# Returns socket object connected to the old server, or None if no server run by the same user is listening
+# Takes String as argument
+def request_takeover(path):
+    link = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+    try:
+        link.connect(path)
+        if not trusted_peer(link):
+            print('Unexpected Error: Handoff socket {} belongs to another user'.format(path))
+            link.close()
+            return None
+        link.send(TAKEOVER)
+    except OSError:
+        link.close()
+        return None
+    return link
+
+# Send one record, with a socket attached if one is given
+# Takes socket object, bytes, and socket object as arguments
+def send_record(link, record, sock=None):
+    if sock is None:
+        link.send(record)
+    else:
+        socket.send_fds(link, [record], [sock.fileno()])
+
+# Send a chat room, or one of its recent messages
+# Takes socket object, String, and bytes as arguments
+def send_room(link, room_name):
+    send_record(link, b'ROOM:' + room_name.encode())
+
+def send_history(link, room_name, frame):
+    send_record(link, b'HISTORY:%s:%s' % (room_name.encode(), frame[:-len(framing.DELIMITER)]))
+
+# Send a client connection with the chat rooms the client is a member of
+# Takes socket object, socket object, String, List of Strings, bytes, and String as arguments
+def send_client(link, sock, user_name, room_names, unread, compression=''):
+    send_record(link, b'CLIENT:%s:%s' % (user_name.encode(), unread), sock)
+    for room_name in room_names:
+        send_record(link, b'JOINED:' + room_name.encode())
+    if compression:
+        send_record(link, b'COMPRESSED:' + compression.encode())
+
+# Send the listening socket, which ends the handoff
+# Takes socket object and socket object as arguments
+def send_listener(link, sock):
+    send_record(link, b'LISTENER', sock)
+
+# Receive the old server's chat rooms and connections, waiting until it has handed over its listening socket
+# Returns Tuple of (
+#     listening socket object,
+#     List of room names,
+#     List of Tuples of (String room name, bytes encoded message),
+#     List of Tuples of (socket object, String user name, List of room names, bytes unread,
+#                        String compression algorithm, which is empty if the connection is not compressed)
+# )
+# Raises ConnectionError if the old server stops before handing over its listening socket
+# Takes socket object as argument
+def receive_state(link):
+    room_names = []
+    messages = []
+    connections = []
+    try:
+        while True:
+            record, fds, flags, address = socket.recv_fds(link, MAX_RECORD_SIZE, 1)
+            if not record:
+                raise ConnectionError('Old server stopped before handing over its listening socket')
+            sock = socket.socket(fileno = fds[0]) if fds else None
+            command, _, fields = record.partition(b':')
+            match command:
+                case b'ROOM':
+                    room_names.append(fields.decode())
+                case b'HISTORY':
+                    room_name, _, message = fields.partition(b':')
+                    messages.append((room_name.decode(), message + framing.DELIMITER))
+                case b'CLIENT':
+                    user_name, _, unread = fields.partition(b':')
+                    connections.append((sock, user_name.decode(), [], unread, ''))
+                case b'JOINED':
+                    connections[-1][2].append(fields.decode())
+                case b'COMPRESSED':
+                    connections[-1] = connections[-1][:4] + (fields.decode(),)
+                case b'LISTENER':
+                    return sock, room_names, messages, connections
+    # Connections received before the handoff failed are closed, since the old server no longer serves them
+    except BaseException:
+        for sock, user_name, joined, unread, compression in connections:
+            sock.close()
+        raise
+    finally:
+        link.close()
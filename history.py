@@ -0,0 +1,119 @@
+import itertools
+import sys
+import threading
+from collections import OrderedDict, deque
+import framing
+
+# ==============================================================================================
+#                                     History Settings
+# ==============================================================================================
+
+# Most messages kept for each chat room, 0 to keep no history
+HISTORY_LENGTH = 100
+# Most bytes of messages kept for each chat room
+ROOM_HISTORY_BYTES = 32 * 1024
+# Most bytes of messages kept for every chat room together
+# Once reached, the history of the chat room that has gone longest without a message is discarded
+TOTAL_HISTORY_BYTES = 64 * 1024 * 1024
+# Number of recent messages sent to a user who joins a chat room, 0 to send none
+REPLAY_LENGTH = 20
+
+# Memory used by each kept message beyond its own bytes: the bytes object header and its slot in the deque
+# Counted so the byte limits bound the memory actually used rather than only the message text
+MESSAGE_OVERHEAD = sys.getsizeof(b'') + 8
+# Memory used by each room with a history before any message is kept: its deque, its RoomHistory object
+# (48 bytes), and its entry in the store's ordered dictionary (about 64 bytes)
+ROOM_OVERHEAD = sys.getsizeof(deque()) + 48 + 64
+
+# ==============================================================================================
+#                                      Room History
+# ==============================================================================================
+
+# Most recent messages sent to one chat room, oldest first
+# Each message is kept as the encoded bytes that were sent, so replaying it needs no formatting
+class RoomHistory:
+    __slots__ = ('frames', 'bytes')
+
+    def __init__(self):
+        self.frames = deque()
+        # Memory used by the room's history, including ROOM_OVERHEAD and MESSAGE_OVERHEAD for each message
+        self.bytes = ROOM_OVERHEAD
+
+    # Remove the oldest message
+    # Returns Integer of bytes freed
+    def pop_oldest(self):
+        size = len(self.frames.popleft()) + MESSAGE_OVERHEAD
+        self.bytes -= size
+        return size
+
+# Keeps a bounded history for every chat room
+# Histories are kept in the order their rooms last received a message, so the rooms that have gone longest
+# without a message are the first to lose their history when every room together reaches the byte limit
+# One lock guards every history, since recording a message only appends to a deque and is much shorter
+# than delivering the message
+class HistoryStore:
+    __slots__ = ('rooms', 'total_bytes', 'length', 'room_bytes', 'max_bytes', 'lock')
+
+    # Takes Integer, Integer, and Integer as arguments
+    def __init__(self, length=HISTORY_LENGTH, room_bytes=ROOM_HISTORY_BYTES, max_bytes=TOTAL_HISTORY_BYTES):
+        # Room histories, indexed by room name, from least to most recently used
+        self.rooms = OrderedDict()
+        self.total_bytes = 0
+        self.length = length
+        self.room_bytes = room_bytes
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+
+    # Add a message sent to a chat room to the room's history
+    # Takes String and bytes or Tuple of bytes-like parts as arguments
+    def record(self, room_name, frame):
+        if self.length <= 0:
+            return
+        data = framing.frame_bytes(frame)
+        size = len(data) + MESSAGE_OVERHEAD
+        # Messages larger than the room's whole history are not kept
+        if size + ROOM_OVERHEAD > self.room_bytes:
+            return
+
+        with self.lock:
+            history = self.rooms.get(room_name)
+            if history is None:
+                history = RoomHistory()
+                self.rooms[room_name] = history
+                self.total_bytes += history.bytes
+            else:
+                self.rooms.move_to_end(room_name)
+
+            # Make room by discarding the room's oldest messages
+            while len(history.frames) >= self.length or history.bytes + size > self.room_bytes:
+                self.total_bytes -= history.pop_oldest()
+            history.frames.append(data)
+            history.bytes += size
+            self.total_bytes += size
+
+            # Discard the histories of the rooms that have gone longest without a message
+            while self.total_bytes > self.max_bytes:
+                _, oldest = self.rooms.popitem(last = False)
+                self.total_bytes -= oldest.bytes
+
+    # Returns List of the most recent messages sent to a chat room as encoded bytes, oldest first
+    # Takes String and Integer as arguments
+    def recent(self, room_name, count):
+        if count <= 0:
+            return []
+        with self.lock:
+            history = self.rooms.get(room_name)
+            if history is None:
+                return []
+            frames = history.frames
+            return list(itertools.islice(frames, max(0, len(frames) - count), None))
+
+    # Remove the history of every room
+    def clear(self):
+        with self.lock:
+            self.rooms.clear()
+            self.total_bytes = 0
+
+    # Returns Integer of rooms with a history
+    def room_count(self):
+        return len(self.rooms)
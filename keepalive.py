@@ -0,0 +1,157 @@
+import math
+import threading
+import time
+import framing
+import metrics
+
+# ==============================================================================================
+#                                    Keepalive Settings
+# ==============================================================================================
+
+# Seconds between each STILL_ALIVE message sent to a client
+KEEP_ALIVE_INTERVAL = 5
+# Seconds a client has to send a STILL_ALIVE message before the server assumes the client is down
+KEEP_ALIVE_WINDOW = 10
+# Seconds between each pass of the keepalive scheduler
+# Keepalive work for a client is spread over the ticks following the moment it connected,
+# so each tick only handles the clients whose timers fall within it
+TICK = 0.5
+
+# Kinds of timers kept for each client
+SEND_TIMER = 0
+VERIFY_TIMER = 1
+
+# ==============================================================================================
+#                                       Timer Wheel
+# ==============================================================================================
+
+# Hashed timing wheel holding timers that expire at most max_delay seconds in the future
+# Each slot holds the timers that expire during one tick, so advancing the wheel only visits timers that are due
+# Timers are never removed early; owners of expired timers decide whether they are still needed
+class TimerWheel:
+    __slots__ = ('tick', 'slots', 'current_tick', 'lock')
+
+    # Takes Float, Float, and Float as arguments
+    def __init__(self, tick, max_delay, now):
+        self.tick = tick
+        self.slots = [[] for _ in range(math.ceil(max_delay / tick) + 1)]
+        self.current_tick = int(now / tick)
+        self.lock = threading.Lock()
+
+    # Add a timer that expires at the monotonic time passed as deadline
+    # Takes Float and any object as arguments
+    def schedule(self, deadline, entry):
+        with self.lock:
+            deadline_tick = max(math.ceil(deadline / self.tick), self.current_tick + 1)
+            self.slots[deadline_tick % len(self.slots)].append((deadline_tick, entry))
+
+    # Remove every timer
+    def clear(self):
+        with self.lock:
+            self.slots = [[] for _ in self.slots]
+
+    # Move the wheel forward to the monotonic time passed as argument
+    # Returns List of the entries whose timers have expired
+    # Takes Float as argument
+    def advance(self, now):
+        target_tick = int(now / self.tick)
+        expired = []
+        with self.lock:
+            slot_count = len(self.slots)
+            while self.current_tick < target_tick:
+                self.current_tick += 1
+                index = self.current_tick % slot_count
+                slot = self.slots[index]
+                if not slot:
+                    continue
+                # Timers scheduled a full rotation or more ahead stay in the slot until their tick arrives
+                remaining = []
+                for deadline_tick, entry in slot:
+                    if deadline_tick <= self.current_tick:
+                        expired.append(entry)
+                    else:
+                        remaining.append((deadline_tick, entry))
+                self.slots[index] = remaining
+        return expired
+
+# ==============================================================================================
+#                                   Keepalive Scheduler
+# ==============================================================================================
+
+# Sends STILL_ALIVE messages to every client and closes connections that stop sending STILL_ALIVE messages
+# One scheduler serves every client, replacing the two keepalive threads previously started for each client
+# Client timestamps are monotonic times recorded with time.monotonic()
+class KeepAliveScheduler:
+    __slots__ = ('wheel', 'on_timeout', 'interval', 'window', 'heartbeat')
+
+    # Takes function called with a Connection object when the client times out as argument
+    def __init__(self, on_timeout, interval=KEEP_ALIVE_INTERVAL, window=KEEP_ALIVE_WINDOW):
+        self.wheel = TimerWheel(TICK, max(interval, window), time.monotonic())
+        self.on_timeout = on_timeout
+        self.interval = interval
+        self.window = window
+        # STILL_ALIVE message is encoded once and the same bytes are sent to every client
+        self.heartbeat = framing.encode_frame('STILL_ALIVE')
+
+    # Start sending STILL_ALIVE messages to a newly registered client and monitoring its connection
+    # The first STILL_ALIVE message is sent immediately so the client knows its connection has finished initializing
+    # Takes Connection object as argument
+    def add(self, client):
+        client.socket.send(self.heartbeat)
+        now = time.monotonic()
+        self.wheel.schedule(now + self.interval, (SEND_TIMER, client))
+        self.wheel.schedule(client.timestamp + self.window, (VERIFY_TIMER, client))
+
+    # Handle every keepalive timer that has expired since the last tick
+    # Returns the number of clients that timed out
+    # Takes Float as argument
+    def tick(self, now=None):
+        if now is None:
+            now = time.monotonic()
+
+        recipients = []
+        timed_out = []
+        for kind, client in self.wheel.advance(now):
+            # Stop sending and checking messages if connection closes
+            if not client.alive:
+                continue
+            if kind == SEND_TIMER:
+                recipients.append(client)
+                self.wheel.schedule(now + self.interval, (SEND_TIMER, client))
+            else:
+                # If STILL_ALIVE message is not received from client within the timeout window,
+                # then the server assumes client is down, otherwise check again when the window next closes
+                deadline = client.timestamp + self.window
+                if deadline <= now:
+                    timed_out.append(client)
+                else:
+                    self.wheel.schedule(deadline, (VERIFY_TIMER, client))
+
+        for client in recipients:
+            client.socket.send(self.heartbeat)
+
+        metrics.keepalive_timeouts.inc(len(timed_out))
+        for client in timed_out:
+            print('Unexpected Error: Client is no longer online')
+            self.on_timeout(client)
+        return len(timed_out)
+
+    # Stop monitoring every client
+    def clear(self):
+        self.wheel.clear()
+
+    # Run the scheduler on a background thread for the threaded server
+    def start(self):
+        thread = threading.Thread(target=self.run, daemon=True)
+        thread.start()
+        return thread
+
+    def run(self):
+        while True:
+            time.sleep(TICK)
+            try:
+                self.tick()
+            # Keep serving other clients if handling one client's timer fails
+            except Exception as E:
+                print('Unexpected Error: Keepalive check failed')
+                print(E)
@@ -0,0 +1,428 @@
+import argparse
+import asyncio
+import random
+import resource
+import socket
+import subprocess
+import sys
+import time
+import framing
+import protocol
+
+# ==============================================================================================
+#                                  Load Generator Settings
+# ==============================================================================================
+
+# Address of the server under load
+HOST = '127.0.0.1'
+# Port number specified in protocol
+PORT = 2787
+# Number of simulated clients
+CLIENT_COUNT = 1000
+# Number of chat rooms the clients are spread across, so each room has CLIENT_COUNT / ROOM_COUNT members
+ROOM_COUNT = 50
+# Number of clients connecting at the same time
+CONNECT_CONCURRENCY = 100
+# Messages each client sends per second
+MESSAGE_RATE = 1.0
+# Fraction of messages sent to a single user with MESSAGE_USER instead of to the client's chat room
+PRIVATE_RATIO = 0.1
+# Length of each message body in bytes
+BODY_SIZE = 64
+# Seconds clients send messages for
+DURATION = 10.0
+# Seconds to wait for messages still being delivered once clients stop sending
+DRAIN_TIMEOUT = 5.0
+# Seconds to wait for a client to connect and join its chat room, or for a spawned server to start listening
+CONNECT_TIMEOUT = 30.0
+# Seed for the random choices of every client, so the same settings always produce the same traffic
+SEED = 2787
+
+# ==============================================================================================
+#                                    Load Statistics
+# ==============================================================================================
+
+# Totals and latencies collected from every simulated client during a load test
+class LoadStats:
+    __slots__ = ('connect_latencies', 'connect_failures', 'room_latencies', 'private_latencies', 'room_messages',
+                 'private_messages', 'expected_deliveries', 'deliveries', 'errors', 'send_lag', 'start')
+
+    def __init__(self):
+        # Nanoseconds from opening each connection to receiving its JOIN_RESPONSE
+        self.connect_latencies = []
+        # Clients that could not connect or join their chat room
+        self.connect_failures = []
+        # Nanoseconds from when each message was scheduled to be sent to when each recipient received it
+        self.room_latencies = []
+        self.private_latencies = []
+        self.room_messages = 0
+        self.private_messages = 0
+        # Deliveries the server should make for the messages sent, counting one for every recipient
+        self.expected_deliveries = 0
+        self.deliveries = 0
+        # ERROR messages and malformed messages received from the server
+        self.errors = []
+        # Most nanoseconds any message was sent after it was scheduled, which grows if the load generator
+        # itself cannot keep up with the requested message rate
+        self.send_lag = 0
+        # Monotonic time in nanoseconds clients start sending messages
+        # Messages scheduled before it were sent by an earlier test and replayed from a chat room's history
+        self.start = None
+
+# Returns the value below which a fraction of the sorted values fall
+# Takes sorted List of numbers and Float as arguments
+def percentile(values, fraction):
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(fraction * len(values)))]
+
+# ==============================================================================================
+#                                     Simulated Clients
+# ==============================================================================================
+
+# One simulated client connected to the server
+# Replies to STILL_ALIVE messages and records the latency of every chat message it receives
+# Message bodies start with the monotonic time in nanoseconds the message was scheduled to be sent,
+# which every process on the host shares, so latency is measured without synchronizing clocks
+class LoadClient(asyncio.BufferedProtocol):
+    __slots__ = ('user_name', 'room_name', 'stats', 'transport', 'reader', 'joined', 'closed')
+
+    # Takes String, String, and LoadStats object as arguments
+    def __init__(self, user_name, room_name, stats):
+        self.user_name = user_name
+        self.room_name = room_name
+        self.stats = stats
+        self.transport = None
+        # Buffers bytes received from the server until complete messages have arrived
+        self.reader = framing.FrameReader()
+        # Completed once the server confirms the client has joined its chat room
+        self.joined = asyncio.get_running_loop().create_future()
+        self.closed = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.send('NAME:{}'.format(self.user_name))
+        self.send('JOIN:{}'.format(self.room_name))
+
+    # Write a message to the server
+    # Takes String or bytes as argument
+    def send(self, msg):
+        if self.closed:
+            return
+        if isinstance(msg, str):
+            msg = msg.encode()
+        self.transport.write(msg + framing.DELIMITER)
+
+    # Returns the buffer the event loop receives the next bytes from the server into
+    # Takes Integer as argument
+    def get_buffer(self, sizehint):
+        return self.reader.get_buffer()
+
+    # Handles every complete message in the bytes received from the server
+    # Takes Integer as argument
+    def buffer_updated(self, nbytes):
+        self.reader.received(nbytes)
+        now = time.monotonic_ns()
+        for frame in self.reader.drain():
+            self.handle_message(protocol.parse_client_message(frame), now)
+
+    # Takes the typed message, or String with error message, and Integer as arguments
+    def handle_message(self, message, now):
+        match message:
+            case protocol.RoomMessage():
+                sent = int(message.body.partition(b' ')[0])
+                if self.stats.start is not None and sent >= self.stats.start:
+                    self.stats.deliveries += 1
+                    self.stats.room_latencies.append(now - sent)
+            case protocol.UserMessage():
+                self.stats.deliveries += 1
+                self.stats.private_latencies.append(now - int(message.body.partition(b' ')[0]))
+            case protocol.StillAlive():
+                self.send('STILL_ALIVE')
+            case protocol.JoinResponse():
+                if not self.joined.done():
+                    self.joined.set_result(now)
+            case protocol.Error():
+                self.stats.errors.append('{}: ERROR:{}:{}'.format(self.user_name, message.code, message.text))
+                if not self.joined.done():
+                    self.joined.set_exception(ConnectionError('ERROR:{}:{}'.format(message.code, message.text)))
+            case protocol.Quit():
+                pass
+            case _:
+                self.stats.errors.append('{}: {}'.format(self.user_name, message))
+
+    def connection_lost(self, exc):
+        self.closed = True
+        if not self.joined.done():
+            self.joined.set_exception(ConnectionError('Connection closed before joining {}'.format(self.room_name)))
+
+    # Send QUIT message and close the connection
+    def quit(self):
+        self.send('QUIT')
+        self.closed = True
+        self.transport.close()
+
+# Connect one simulated client and wait until it has joined its chat room
+# Returns LoadClient object
+# Returns None if the client could not connect or join its chat room
+# Takes String, Integer, String, String, LoadStats object, and asyncio.Semaphore as arguments
+async def connect_client(host, port, user_name, room_name, stats, limit):
+    loop = asyncio.get_running_loop()
+    async with limit:
+        start = time.monotonic_ns()
+        try:
+            transport, client = await asyncio.wait_for(loop.create_connection(
+                lambda: LoadClient(user_name, room_name, stats), host, port), CONNECT_TIMEOUT)
+            joined = await asyncio.wait_for(client.joined, CONNECT_TIMEOUT)
+        except (OSError, asyncio.TimeoutError) as E:
+            stats.connect_failures.append('{}: {!r}'.format(user_name, E))
+            return None
+        stats.connect_latencies.append(joined - start)
+    return client
+
+# Send messages from one client at a fixed rate until the end of the test
+# Messages are scheduled ahead of time rather than after the previous message is answered,
+# so a slow server shows up as higher latency instead of as fewer messages sent
+# Takes LoadClient object, List of LoadClient objects, Dictionary of room sizes, random.Random object,
+# Float, Float, and Dictionary of settings as arguments
+async def send_messages(client, clients, room_sizes, rng, start, end, settings):
+    loop = asyncio.get_running_loop()
+    stats = client.stats
+    interval = 1 / settings['message_rate']
+    padding = b'x' * settings['body_size']
+    # Spread clients evenly over one interval so they do not all send at once
+    scheduled = start + rng.random() * interval
+
+    while scheduled < end and not client.closed:
+        delay = scheduled - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        stats.send_lag = max(stats.send_lag, int((loop.time() - scheduled) * 1e9))
+
+        # asyncio's event loop clock is time.monotonic(), so scheduled times are on the same clock as monotonic_ns()
+        body = (b'%d ' % int(scheduled * 1e9) + padding)[:settings['body_size']]
+        if len(clients) > 1 and rng.random() < settings['private_ratio']:
+            target = clients[rng.randrange(len(clients))]
+            while target is client:
+                target = clients[rng.randrange(len(clients))]
+            client.send(b'MESSAGE_USER:%s:%s' % (target.user_name.encode(), body))
+            stats.private_messages += 1
+            # The recipient and the sender, as confirmation, both receive the message
+            stats.expected_deliveries += 2
+        else:
+            client.send(b'MESSAGE:%s:%s' % (client.room_name.encode(), body))
+            stats.room_messages += 1
+            stats.expected_deliveries += room_sizes[client.room_name]
+        scheduled += interval
+
+# ==============================================================================================
+#                                        Load Test
+# ==============================================================================================
+
+# Returns Dictionary of the default load test settings
+def default_settings():
+    return {
+        'host': HOST,
+        'port': PORT,
+        'clients': CLIENT_COUNT,
+        'rooms': ROOM_COUNT,
+        'concurrency': CONNECT_CONCURRENCY,
+        'message_rate': MESSAGE_RATE,
+        'private_ratio': PRIVATE_RATIO,
+        'body_size': BODY_SIZE,
+        'duration': DURATION,
+        'seed': SEED
+    }
+
+# Connect the simulated clients, send messages for the test duration, and wait for them to be delivered
+# Returns Dictionary of results
+# Takes Dictionary of settings as argument
+async def run_load(settings):
+    loop = asyncio.get_running_loop()
+    stats = LoadStats()
+    rng = random.Random(settings['seed'])
+
+    # Assign clients to chat rooms in a fixed order so every room has the same number of members
+    room_names = ['load{}'.format(index % settings['rooms']) for index in range(settings['clients'])]
+    rng.shuffle(room_names)
+
+    # Open every connection, with a limited number of handshakes in progress at once
+    limit = asyncio.Semaphore(settings['concurrency'])
+    connect_start = time.perf_counter()
+    connected = await asyncio.gather(*[
+        connect_client(settings['host'], settings['port'], 'user{}'.format(index), room_name, stats, limit)
+        for index, room_name in enumerate(room_names)])
+    connect_time = time.perf_counter() - connect_start
+
+    # Only clients that joined their chat room send messages or are sent private messages
+    clients = [client for client in connected if client is not None]
+    room_sizes = {}
+    for client in clients:
+        room_sizes[client.room_name] = room_sizes.get(client.room_name, 0) + 1
+
+    # Every client sends messages on its own schedule, chosen by a random generator seeded for that client
+    start = loop.time() + 0.1
+    end = start + settings['duration']
+    stats.start = int(start * 1e9)
+    await asyncio.gather(*[
+        send_messages(client, clients, room_sizes, random.Random(settings['seed'] * 1000003 + index), start, end,
+                      settings)
+        for index, client in enumerate(connected) if client is not None])
+    send_time = loop.time() - start
+
+    # Wait for messages still being delivered
+    drain_deadline = loop.time() + DRAIN_TIMEOUT
+    while stats.deliveries < stats.expected_deliveries and loop.time() < drain_deadline:
+        await asyncio.sleep(0.05)
+    delivery_time = loop.time() - start
+
+    for client in clients:
+        client.quit()
+
+    stats.connect_latencies.sort()
+    stats.room_latencies.sort()
+    stats.private_latencies.sort()
+    messages = stats.room_messages + stats.private_messages
+    return {
+        'clients': len(clients),
+        'connect_failures': stats.connect_failures,
+        'connect_time': connect_time,
+        'connections_per_sec': len(clients) / connect_time,
+        'connect_p50_ms': percentile(stats.connect_latencies, 0.50) / 1e6,
+        'connect_p99_ms': percentile(stats.connect_latencies, 0.99) / 1e6,
+        'messages': messages,
+        'room_messages': stats.room_messages,
+        'private_messages': stats.private_messages,
+        'messages_per_sec': messages / send_time,
+        'expected_deliveries': stats.expected_deliveries,
+        'deliveries': stats.deliveries,
+        'deliveries_per_sec': stats.deliveries / delivery_time,
+        'lost_deliveries': max(0, stats.expected_deliveries - stats.deliveries),
+        'room_p50_ms': percentile(stats.room_latencies, 0.50) / 1e6,
+        'room_p99_ms': percentile(stats.room_latencies, 0.99) / 1e6,
+        'private_p50_ms': percentile(stats.private_latencies, 0.50) / 1e6,
+        'private_p99_ms': percentile(stats.private_latencies, 0.99) / 1e6,
+        'send_lag_ms': stats.send_lag / 1e6,
+        'errors': stats.errors
+    }
+
+# Print the results of a load test
+# Takes Dictionary of results as argument
+def print_results(results):
+    print('Connections:    {:,} in {:.2f} s, {:,.0f} connections/sec, handshake p50 {:.2f} ms, p99 {:.2f} ms'.format(
+        results['clients'], results['connect_time'], results['connections_per_sec'],
+        results['connect_p50_ms'], results['connect_p99_ms']))
+    if results['connect_failures']:
+        print('{} clients could not connect:'.format(len(results['connect_failures'])))
+        for failure in results['connect_failures'][:20]:
+            print(failure)
+    print('Messages sent:  {:,} ({:,} room, {:,} private), {:,.0f} messages/sec'.format(
+        results['messages'], results['room_messages'], results['private_messages'], results['messages_per_sec']))
+    print('Deliveries:     {:,} of {:,} ({:,} lost), {:,.0f} deliveries/sec'.format(
+        results['deliveries'], results['expected_deliveries'], results['lost_deliveries'],
+        results['deliveries_per_sec']))
+    print('Room latency:    p50 {:.2f} ms, p99 {:.2f} ms'.format(results['room_p50_ms'], results['room_p99_ms']))
+    print('Private latency: p50 {:.2f} ms, p99 {:.2f} ms'.format(results['private_p50_ms'],
+                                                                 results['private_p99_ms']))
+    # Latency includes time the load generator spent behind schedule, so large lag means the results
+    # measure the load generator rather than the server
+    print('Load generator lag: up to {:.2f} ms behind schedule'.format(results['send_lag_ms']))
+    if results['errors']:
+        print('{} errors received:'.format(len(results['errors'])))
+        for error in results['errors'][:20]:
+            print(error)
+
+# ==============================================================================================
+#                                      Server Process
+# ==============================================================================================
+
+# Raise this process's limit on open files as far as allowed, since every simulated client holds a socket
+# Servers started by spawn_server() inherit the raised limit
+def raise_file_limit():
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+# Returns True if a server accepts connections at the address
+# Takes String and Integer as arguments
+def server_listening(host, port):
+    try:
+        socket.create_connection((host, port), timeout=1).close()
+        return True
+    except OSError:
+        return False
+
+# Start a server program in a new process and wait until it accepts connections
+# The server's output is discarded so printing every connection does not slow the load generator's terminal
+# Returns subprocess.Popen object
+# Takes String, String, and Integer as arguments
+def spawn_server(script, host, port):
+    # Refuse to start if another server is already listening, since the test would measure that server instead
+    if server_listening(host, port):
+        raise RuntimeError('Another server is already listening on port {}'.format(port))
+
+    # The server does not take over from a server that is already running on another port
+    command = [sys.executable, script, '--host', host, '--port', str(port), '--handoff-path', '']
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.monotonic() + CONNECT_TIMEOUT
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError('{} exited before accepting connections'.format(script))
+        if server_listening(host, port):
+            return process
+        time.sleep(0.1)
+    process.kill()
+    raise RuntimeError('{} did not accept connections within {} seconds'.format(script, CONNECT_TIMEOUT))
+
+# Stop a server started by spawn_server()
+# Takes subprocess.Popen object as argument
+def stop_server(process):
+    process.terminate()
+    try:
+        process.wait(5)
+    except subprocess.TimeoutExpired:
+        process.kill()
+        process.wait()
+
+# Run one load test, against a server started for the test if a server program is given
+# Returns Dictionary of results
+# Takes Dictionary of settings and String as arguments
+def load_test(settings, script=None):
+    raise_file_limit()
+    process = spawn_server(script, settings['host'], settings['port']) if script else None
+    try:
+        return asyncio.run(run_load(settings))
+    finally:
+        if process is not None:
+            stop_server(process)
+
+# ==============================================================================================
+#                                  Load Generator Program
+# ==============================================================================================
+
+if __name__ == '__main__':
+    defaults = default_settings()
+    parser = argparse.ArgumentParser(description='Simulate many scripted clients against an IRC server')
+    parser.add_argument('--host', default=defaults['host'], help='address of the server')
+    parser.add_argument('--port', type=int, default=defaults['port'], help='port of the server')
+    parser.add_argument('--clients', type=int, default=defaults['clients'], help='number of simulated clients')
+    parser.add_argument('--rooms', type=int, default=defaults['rooms'],
+                        help='number of chat rooms to spread clients across')
+    parser.add_argument('--concurrency', type=int, default=defaults['concurrency'],
+                        help='number of clients connecting at the same time')
+    parser.add_argument('--message-rate', type=float, default=defaults['message_rate'],
+                        help='messages each client sends per second')
+    parser.add_argument('--private-ratio', type=float, default=defaults['private_ratio'],
+                        help='fraction of messages sent with MESSAGE_USER')
+    parser.add_argument('--body-size', type=int, default=defaults['body_size'], help='message body length in bytes')
+    parser.add_argument('--duration', type=float, default=defaults['duration'], help='seconds to send messages for')
+    parser.add_argument('--seed', type=int, default=defaults['seed'], help='seed for the clients\' random choices')
+    parser.add_argument('--spawn', metavar='SERVER', help='server program to start for the test, such as server.py')
+    args = parser.parse_args()
+
+    settings = {name: getattr(args, name) for name in defaults}
+    # Message bodies must hold the nanosecond timestamp used to measure latency
+    settings['body_size'] = max(settings['body_size'], 24)
+    results = load_test(settings, args.spawn)
+    print_results(results)
+    sys.exit(1 if results['lost_deliveries'] or results['errors'] or results['connect_failures'] else 0)
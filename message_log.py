@@ -0,0 +1,327 @@
+import os
+import threading
+import time
+import zlib
+from collections import OrderedDict, deque
+import framing
+import history
+
+# ==============================================================================================
+#                                   Message Log Settings
+# ==============================================================================================
+
+# Directory chat rooms and messages are logged to so they survive a restart, None to keep nothing on disk
+LOG_DIRECTORY = None
+# Size in bytes at which the segment being written is sealed and a new segment is started
+SEGMENT_BYTES = 16 * 1024 * 1024
+# Seconds the writer waits after each write, so messages logged meanwhile are written and synced together
+# A crash loses at most the messages logged during the last interval
+COMMIT_INTERVAL = 0.01
+# Most sealed segments kept on disk, older segments are deleted
+MAX_SEGMENTS = 64
+
+# ==============================================================================================
+#                                      Log Records
+# ==============================================================================================
+
+# Segments are append-only files of newline delimited records, each the encoded message it logs
+# preceded by a checksum of the message:
+#     crc32_in_hex ROOM:room_name                                   Chat room was created
+#     crc32_in_hex MESSAGE:room_name:user_name:message              Message was sent to a chat room
+#     crc32_in_hex MESSAGE_USER:user_name:user_name:message         Message was sent to a user
+# Messages cannot contain newlines, so a record torn by a crash is a line that fails its checksum
+#
+# When a segment is sealed, it is read back and a summary is written next to it holding a ROOM record for every
+# chat room created so far and the last HISTORY_LENGTH MESSAGE records of each room that received messages in
+# the segment, so no records are kept in memory while the segment is written
+# Recovery reads the summary of each sealed segment and every record of the unsealed segments only,
+# so its time grows with the number of segments rather than the number of messages logged
+
+SEGMENT_SUFFIX = '.log'
+SUMMARY_SUFFIX = '.summary'
+
+# Returns bytes of one log record
+# Takes bytes of an encoded message without its delimiter as argument
+def encode_record(payload):
+    return b'%08x %s\n' % (zlib.crc32(payload), payload)
+
+# Returns bytes of one log record
+# Takes bytes of an encoded message ending with its delimiter as argument
+def encode_frame_record(data):
+    return b'%08x %s' % (zlib.crc32(data[:-1]), data)
+
+# Returns List of the encoded messages in a segment or summary file, skipping records that fail their checksum
+# Takes String as argument
+def read_records(path):
+    payloads = []
+    with open(path, 'rb') as log_file:
+        for line in log_file:
+            checksum, _, payload = line.rstrip(framing.DELIMITER).partition(b' ')
+            try:
+                if int(checksum, 16) == zlib.crc32(payload):
+                    payloads.append(payload)
+            except ValueError:
+                pass
+    return payloads
+
+# Returns Dictionary of the last HISTORY_LENGTH MESSAGE records of each chat room, oldest first
+# Takes List of bytes of encoded messages as argument
+def room_tails(payloads):
+    tails = {}
+    for payload in payloads:
+        if payload.startswith(b'MESSAGE:'):
+            room_name = record_room_name(payload)
+            tail = tails.get(room_name)
+            if tail is None:
+                tail = tails[room_name] = deque(maxlen = history.HISTORY_LENGTH)
+            tail.append(payload)
+    return tails
+
+# Returns String with the room name of a ROOM or MESSAGE record
+# Takes bytes as argument
+def record_room_name(payload):
+    return payload.split(b':', 2)[1].decode()
+
+# ==============================================================================================
+#                                       Message Log
+# ==============================================================================================
+
+# Append-only log of chat rooms and messages, split into segments
+# Server threads add records to a pending list, and a writer thread writes everything pending with one write
+# followed by one fsync, so the cost of syncing is shared by every message logged in the same interval
+class MessageLog:
+    __slots__ = ('directory', 'segment_bytes', 'commit_interval', 'max_segments', 'lock', 'condition',
+                 'committed_condition', 'pending', 'pending_bytes', 'appended', 'committed', 'commits', 'rooms',
+                 'segment', 'segment_number', 'segment_size', 'closed', 'thread')
+
+    # Takes String, Integer, Float, and Integer as arguments
+    def __init__(self, directory, segment_bytes=SEGMENT_BYTES, commit_interval=COMMIT_INTERVAL,
+                 max_segments=MAX_SEGMENTS):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.commit_interval = commit_interval
+        self.max_segments = max_segments
+        # Writer thread waits on condition for records to be logged, and flush() waits on committed_condition
+        # for records to be written, both under the same lock
+        # Records are added while holding the lock itself, which is faster than entering the condition
+        self.lock = threading.Lock()
+        self.condition = threading.Condition(self.lock)
+        self.committed_condition = threading.Condition(self.lock)
+        # Records waiting to be written
+        self.pending = []
+        self.pending_bytes = 0
+        # Number of records logged, number of them written and synced, and number of syncs
+        self.appended = 0
+        self.committed = 0
+        self.commits = 0
+        # Names of every chat room logged, written to each summary, as the keys of a dictionary
+        # so they keep the order the rooms were created in, which ROOMS listings are sent in
+        self.rooms = {}
+        self.segment = None
+        self.segment_number = 0
+        self.segment_size = 0
+        self.closed = False
+        self.thread = threading.Thread(target=self.write_loop, daemon=True)
+
+    # Returns String path of a segment or its summary
+    # Takes Integer and String as arguments
+    def path(self, number, suffix):
+        return os.path.join(self.directory, '{:08d}{}'.format(number, suffix))
+
+    # Returns List of the numbers of the segments in the log directory, oldest first
+    def segment_numbers(self):
+        return sorted(int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(self.directory)
+                      if name.endswith(SEGMENT_SUFFIX))
+
+    # Read the chat rooms and recent messages kept in the log directory and start a new segment
+    # Segments left unsealed by a crash are sealed, so the next recovery reads only their summaries
+    # Returns Tuple of (List of room names, List of Tuples (String room name, bytes encoded message)),
+    # with rooms in the order they were created and messages oldest first
+    def recover(self):
+        os.makedirs(self.directory, exist_ok = True)
+        # Recent messages of each room across every segment read, with the most recently used room last
+        recent = OrderedDict()
+        numbers = self.segment_numbers()
+        # An empty segment left by the last run is reused rather than sealed, so restarts do not add segments
+        if (numbers and not os.path.getsize(self.path(numbers[-1], SEGMENT_SUFFIX))
+                and not os.path.exists(self.path(numbers[-1], SUMMARY_SUFFIX))):
+            self.segment_number = numbers.pop()
+        elif numbers:
+            self.segment_number = numbers[-1] + 1
+
+        for number in numbers:
+            summary_path = self.path(number, SUMMARY_SUFFIX)
+            if os.path.exists(summary_path):
+                payloads = read_records(summary_path)
+            else:
+                payloads = read_records(self.path(number, SEGMENT_SUFFIX))
+
+            for payload in payloads:
+                if payload.startswith(b'ROOM:'):
+                    self.rooms[record_room_name(payload)] = None
+                elif payload.startswith(b'MESSAGE:'):
+                    room_name = record_room_name(payload)
+                    self.rooms[room_name] = None
+                    tail = recent.get(room_name)
+                    if tail is None:
+                        tail = recent[room_name] = deque(maxlen = history.HISTORY_LENGTH)
+                    else:
+                        recent.move_to_end(room_name)
+                    tail.append(payload)
+
+            if not os.path.exists(summary_path):
+                self.write_summary(number, self.rooms, room_tails(payloads))
+
+        self.open_segment()
+        self.delete_old_segments()
+        messages = [(room_name, payload + framing.DELIMITER) for room_name, tail in recent.items() for payload in tail]
+        return list(self.rooms), messages
+
+    # Start the writer thread
+    def start(self):
+        self.thread.start()
+        return self
+
+    # Log a chat room being created
+    # Takes String as argument
+    def append_room(self, room_name):
+        with self.lock:
+            self.rooms[room_name] = None
+        self.append(encode_record('ROOM:{}'.format(room_name).encode()))
+
+    # Log a message sent to a chat room
+    # Chat room messages are the most frequent records, so they are added without calling append()
+    # Takes String and bytes or Tuple of bytes-like parts as arguments
+    def append_message(self, room_name, frame):
+        record = encode_frame_record(framing.frame_bytes(frame))
+        with self.lock:
+            if self.closed:
+                return
+            pending = self.pending
+            pending.append(record)
+            self.pending_bytes += len(record)
+            self.appended += 1
+            self.rooms[room_name] = None
+            # Writer thread only waits when no records are pending
+            if len(pending) == 1:
+                self.condition.notify()
+
+    # Log a message sent to a user
+    # Takes bytes or Tuple of bytes-like parts as argument
+    def append_private(self, frame):
+        self.append(encode_frame_record(framing.frame_bytes(frame)))
+
+    # Add a record to the records waiting to be written
+    # Takes bytes as argument
+    def append(self, record):
+        with self.lock:
+            if self.closed:
+                return
+            self.pending.append(record)
+            self.pending_bytes += len(record)
+            self.appended += 1
+            if len(self.pending) == 1:
+                self.condition.notify()
+
+    # Writer thread writes and syncs every pending record, then waits for more records to collect
+    def write_loop(self):
+        while True:
+            with self.condition:
+                while not self.pending and not self.closed:
+                    self.condition.wait()
+                if not self.pending:
+                    break
+                batch = self.pending
+                self.pending = []
+                self.segment_size += self.pending_bytes
+                self.pending_bytes = 0
+                # Seal the segment once this batch fills it, summarizing the chat rooms logged so far
+                if self.segment_size >= self.segment_bytes:
+                    rooms = dict(self.rooms)
+                else:
+                    rooms = None
+
+            try:
+                self.segment.write(b''.join(batch))
+                self.segment.flush()
+                os.fsync(self.segment.fileno())
+                if rooms is not None:
+                    self.rotate(rooms)
+            # Keep serving clients if the disk fails, and report each failed write
+            except OSError as E:
+                print('Unexpected Error: Messages could not be logged')
+                print(E)
+
+            with self.condition:
+                self.committed += len(batch)
+                self.commits += 1
+                self.committed_condition.notify_all()
+            time.sleep(self.commit_interval)
+
+    # Wait until every record logged so far has been written and synced
+    def flush(self):
+        with self.condition:
+            target = self.appended
+            while self.committed < target:
+                self.committed_condition.wait()
+
+    # Open a new segment file to append records to
+    def open_segment(self):
+        self.segment = open(self.path(self.segment_number, SEGMENT_SUFFIX), 'ab')
+        self.segment_size = self.segment.tell()
+        # Sync the directory so the new segment's file name survives a crash
+        directory = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(directory)
+        finally:
+            os.close(directory)
+
+    # Seal the current segment and start the next one, deleting the oldest segments beyond the limit
+    # The sealed segment is read back to find the last messages of each room for its summary
+    # Takes Dictionary with room names as keys as argument
+    def rotate(self, rooms):
+        self.segment.close()
+        payloads = read_records(self.path(self.segment_number, SEGMENT_SUFFIX))
+        self.write_summary(self.segment_number, rooms, room_tails(payloads))
+        self.segment_number += 1
+        self.open_segment()
+        self.delete_old_segments()
+
+    # Delete the oldest sealed segments beyond the most segments kept
+    # Every summary names all the chat rooms created before it, so deleting a segment only loses old messages
+    def delete_old_segments(self):
+        numbers = self.segment_numbers()[:-1]
+        for number in numbers[:max(0, len(numbers) - self.max_segments)]:
+            # A file that is already gone, such as one removed by hand, is skipped
+            for path in (self.path(number, SUMMARY_SUFFIX), self.path(number, SEGMENT_SUFFIX)):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+    # Write the summary of a sealed segment
+    # The summary is written to a temporary file and renamed, so a crash never leaves a partial summary
+    # Rooms are written in the order they were created, so recovery creates them in the same order
+    # Takes Integer, Dictionary with room names as keys, and Dictionary of room tails holding encoded messages
+    # as arguments
+    def write_summary(self, number, rooms, tails):
+        records = [encode_record('ROOM:{}'.format(room_name).encode()) for room_name in rooms]
+        for tail in tails.values():
+            records.extend(encode_record(payload) for payload in tail)
+
+        summary_path = self.path(number, SUMMARY_SUFFIX)
+        temporary_path = summary_path + '.tmp'
+        with open(temporary_path, 'wb') as summary:
+            summary.write(b''.join(records))
+            summary.flush()
+            os.fsync(summary.fileno())
+        os.replace(temporary_path, summary_path)
+
+    # Write every pending record and stop the writer thread
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        if self.thread.ident is not None:
+            self.thread.join()
+        self.segment.close()
@@ -0,0 +1,212 @@
+import threading
+import protocol
+
+# ==============================================================================================
+#                                     Metrics Settings
+# ==============================================================================================
+
+# Address of the local endpoint that serves metrics in the Prometheus text format
+# Only reachable from the server's own host, where a Prometheus agent or an operator can read it
+METRICS_HOST = '127.0.0.1'
+METRICS_PORT = 9787
+# Histogram buckets are numbers of bits: a bucket of n bits holds values up to 2 ** n - 1
+# Each tuple is the (smallest, largest) bucket reported for a histogram
+# Handler latency in nanoseconds, from about 1 microsecond to about 1 second
+LATENCY_BUCKETS = (10, 30)
+# Number of recipients of a broadcast, up to 16,383
+FAN_OUT_BUCKETS = (0, 14)
+# Number of messages written to a connection at once, up to 2,047
+BATCH_BUCKETS = (0, 11)
+
+# ==============================================================================================
+#                                      Metric Types
+# ==============================================================================================
+
+# Metrics are updated on every message, so updates take no lock
+# Each update is a single increment that the GIL does not interrupt in practice, and a lost increment
+# between two threads would only make a count slightly low, which is preferable to a lock on every message
+
+# Count of events that only increases
+class Counter:
+    __slots__ = ('name', 'help', 'value')
+
+    # Takes String and String as arguments
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.value = 0
+
+    # Takes Integer as argument
+    def inc(self, amount=1):
+        self.value += amount
+
+    # Returns List of Strings in the Prometheus text format
+    def render(self):
+        return [
+            '# HELP {} {}'.format(self.name, self.help),
+            '# TYPE {} counter'.format(self.name),
+            '{} {}'.format(self.name, self.value)
+        ]
+
+# Distribution of observed integers, counted in buckets whose upper bounds are a power of two minus one
+# A value's bucket is its number of bits, so observing a value does not search the bucket bounds
+class Histogram:
+    __slots__ = ('buckets', 'counts', 'sum')
+
+    # Takes Tuple of (Integer, Integer) as argument
+    def __init__(self, buckets):
+        self.buckets = buckets
+        # One count for each possible number of bits of a 64-bit value
+        self.counts = [0] * 65
+        self.sum = 0
+
+    # Takes non-negative Integer as argument
+    def observe(self, value):
+        self.counts[value.bit_length()] += 1
+        self.sum += value
+
+    # Returns the number of values observed
+    def count(self):
+        return sum(self.counts)
+
+    # Returns List of Strings with the histogram's samples in the Prometheus text format
+    # Bounds and the sum are divided by the scale, so nanoseconds can be reported as seconds
+    # Takes String, String with labels such as 'command="JOIN",' or '', and number as arguments
+    def samples(self, name, labels='', scale=1):
+        lines = []
+        first, last = self.buckets
+        total = sum(self.counts[:first])
+        for bits in range(first, last + 1):
+            total += self.counts[bits]
+            lines.append('{}_bucket{{{}le="{}"}} {}'.format(name, labels, ((1 << bits) - 1) / scale, total))
+        total = self.count()
+        lines.append('{}_bucket{{{}le="+Inf"}} {}'.format(name, labels, total))
+        selector = '{{{}}}'.format(labels.rstrip(',')) if labels else ''
+        lines.append('{}_sum{} {}'.format(name, selector, self.sum / scale))
+        lines.append('{}_count{} {}'.format(name, selector, total))
+        return lines
+
+# ==============================================================================================
+#                                     Server Metrics
+# ==============================================================================================
+
+connections = Counter('irc_connections_total', 'TCP connections accepted')
+registrations = Counter('irc_registrations_total', 'Users registered with a NAME message')
+disconnections = Counter('irc_disconnections_total', 'Registered users whose connection has closed')
+keepalive_timeouts = Counter('irc_keepalive_timeouts_total', 'Connections closed for not sending STILL_ALIVE')
+invalid_messages = Counter('irc_invalid_messages_total', 'Messages rejected for violating the protocol')
+received_bytes = Counter('irc_received_bytes_total', 'Bytes of messages received from clients')
+sent_bytes = Counter('irc_sent_bytes_total', 'Bytes of messages written to client connections')
+sent_messages = Counter('irc_sent_messages_total', 'Messages written to client connections')
+dropped_messages = Counter('irc_dropped_messages_total', 'Messages discarded by the slow consumer policy')
+compression_input_bytes = Counter('irc_compression_input_bytes_total',
+                                  'Bytes of messages written to compressed connections, before compression')
+compression_output_bytes = Counter('irc_compression_output_bytes_total',
+                                   'Bytes written to compressed connections after compression')
+tls_handshakes = Counter('irc_tls_handshakes_total', 'TLS handshakes completed with clients')
+tls_resumed_handshakes = Counter('irc_tls_resumed_handshakes_total',
+                                 'TLS handshakes that resumed a session from an earlier connection')
+rate_limited = Counter('irc_rate_limited_total', 'Messages refused for exceeding a rate limit')
+rate_limit_disconnects = Counter('irc_rate_limit_disconnects_total',
+                                 'Connections closed for repeatedly exceeding rate limits')
+offline_stored = Counter('irc_offline_stored_total', 'Messages kept for users who were disconnected')
+offline_delivered = Counter('irc_offline_delivered_total', 'Kept messages delivered when their user reconnected')
+offline_discarded = Counter('irc_offline_discarded_total',
+                            'Kept messages discarded because they expired or no space was left')
+
+# Time spent in each message handler, indexed by message type and labelled with the message's command
+# The number of messages of each command is the count of its histogram
+# NAME messages are only handled before registering, and are counted as registrations
+handler_latency = {message_class: Histogram(LATENCY_BUCKETS)
+                   for message_class in protocol.SERVER_MESSAGE_TYPES if message_class is not protocol.Name}
+# Number of members each chat room message is broadcast to
+broadcast_recipients = Histogram(FAN_OUT_BUCKETS)
+# Number of messages written to a connection at once, which is the depth of its send queue when it is written
+send_batch_messages = Histogram(BATCH_BUCKETS)
+
+# Values read from the server state when metrics are requested, so they cost nothing while handling messages
+# Each gauge is a Tuple of (String name, String help, function returning a number)
+gauges = []
+
+# Add a gauge that is read when metrics are requested
+# Takes String, String, and function that returns a number as arguments
+def add_gauge(name, help, function):
+    gauges.append((name, help, function))
+
+# Returns String of every metric in the Prometheus text format
+def render():
+    lines = []
+    for counter in (connections, registrations, disconnections, keepalive_timeouts, invalid_messages,
+                    received_bytes, sent_bytes, sent_messages, dropped_messages, compression_input_bytes,
+                    compression_output_bytes, tls_handshakes, tls_resumed_handshakes, rate_limited,
+                    rate_limit_disconnects, offline_stored, offline_delivered, offline_discarded):
+        lines.extend(counter.render())
+
+    lines.append('# HELP irc_messages_total Messages received from registered users, by command')
+    lines.append('# TYPE irc_messages_total counter')
+    for message_class, histogram in handler_latency.items():
+        lines.append('irc_messages_total{{command="{}"}} {}'.format(message_class.command, histogram.count()))
+
+    lines.append('# HELP irc_handler_seconds Time spent handling each message, by command')
+    lines.append('# TYPE irc_handler_seconds histogram')
+    for message_class, histogram in handler_latency.items():
+        labels = 'command="{}",'.format(message_class.command)
+        lines.extend(histogram.samples('irc_handler_seconds', labels, 1e9))
+
+    lines.append('# HELP irc_broadcast_recipients Members each chat room message is broadcast to')
+    lines.append('# TYPE irc_broadcast_recipients histogram')
+    lines.extend(broadcast_recipients.samples('irc_broadcast_recipients'))
+    lines.append('# HELP irc_send_batch_messages Messages waiting in a send queue when it is written')
+    lines.append('# TYPE irc_send_batch_messages histogram')
+    lines.extend(send_batch_messages.samples('irc_send_batch_messages'))
+
+    for name, help, function in gauges:
+        lines.append('# HELP {} {}'.format(name, help))
+        lines.append('# TYPE {} gauge'.format(name))
+        lines.append('{} {}'.format(name, function()))
+    return '\n'.join(lines) + '\n'
+
+# ==============================================================================================
+#                                     Metrics Endpoint
+# ==============================================================================================
+
+# Returns the class that answers HTTP GET requests for /metrics with every metric in the Prometheus text format
+# http.server is imported when an endpoint starts rather than with this module, since importing it takes longer
+# than the rest of the server's startup, and servers started by tests and benchmarks rarely serve metrics
+def request_handler_class():
+    import http.server
+
+    class MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != '/metrics':
+                self.send_error(404)
+                return
+            body = render().encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        # Requests are not printed, so scrapes do not fill the server's output
+        def log_message(self, format, *args):
+            pass
+
+    return MetricsRequestHandler
+
+# Serve metrics on a background thread, so the endpoint answers even while the server is busy
+# Returns the HTTP server, or None if the endpoint could not start
+# Takes String and Integer as arguments
+def start_endpoint(host=METRICS_HOST, port=METRICS_PORT):
+    import http.server
+    try:
+        endpoint = http.server.ThreadingHTTPServer((host, port), request_handler_class())
+    # Server keeps serving clients without metrics if the port is in use
+    except OSError as E:
+        print('Unexpected Error: Metrics endpoint could not start')
+        print(E)
+        return None
+    endpoint.daemon_threads = True
+    threading.Thread(target=endpoint.serve_forever, daemon=True).start()
+    print('Metrics are served at http://{}:{}/metrics'.format(host, port))
+    return endpoint
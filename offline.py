@@ -0,0 +1,242 @@
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+import framing
+import metrics
+
+# ==============================================================================================
+#                                  Offline Message Settings
+# ==============================================================================================
+
+# Seconds a user's mailbox is kept after they disconnect, and seconds each message waits in it for them
+OFFLINE_TTL = 24 * 60 * 60
+# Most messages and bytes of messages kept for each user, including messages spilled to disk
+MAILBOX_LENGTH = 100
+MAILBOX_BYTES = 64 * 1024
+# Most bytes of messages kept in memory for every user together
+# Once reached, the messages of the mailbox that has gone longest without a message are spilled to disk
+TOTAL_OFFLINE_BYTES = 16 * 1024 * 1024
+# Most mailboxes kept, the mailboxes of the users who left longest ago are discarded first
+MAX_MAILBOXES = 100000
+# Directory that messages are spilled to when memory is full, None to discard them instead
+SPILL_DIRECTORY = None
+# Most bytes of messages spilled to disk for every user together
+SPILL_BYTES = 256 * 1024 * 1024
+
+# Fraction of TOTAL_OFFLINE_BYTES left in memory after spilling, so each spill writes several messages to each file
+SPILL_WATERMARK = 0.75
+
+# Memory used by each kept message beyond its own bytes: the bytes object header, its expiry time,
+# the tuple holding both, and its slot in the list
+MESSAGE_OVERHEAD = sys.getsizeof(b'') + sys.getsizeof(0.0) + sys.getsizeof((0, 0)) + 8
+# Memory used by each mailbox, which is bounded by MAX_MAILBOXES rather than TOTAL_OFFLINE_BYTES:
+# its empty list, its Mailbox object (about 100 bytes), and its entries in the store's ordered dictionaries
+# (about 64 bytes each)
+MAILBOX_OVERHEAD = sys.getsizeof([]) + 100 + 2 * 64
+
+SPILL_SUFFIX = '.mailbox'
+
+MAILBOX_FULL_ERROR = 'ERROR:111:{}:This user has too many messages waiting until they reconnect'
+
+# ==============================================================================================
+#                                         Mailboxes
+# ==============================================================================================
+
+# Messages waiting for one disconnected user, oldest first
+# Messages are kept in memory until memory is full, then appended to the user's spill file, so the spilled
+# messages are always older than the messages in memory
+class Mailbox:
+    __slots__ = ('user_name', 'frames', 'bytes', 'spilled_count', 'spilled_bytes', 'expires')
+
+    # Takes String and Float as arguments
+    def __init__(self, user_name, expires):
+        self.user_name = user_name
+        # Tuples of (Float monotonic time the message expires, bytes encoded message)
+        self.frames = []
+        self.bytes = 0
+        self.spilled_count = 0
+        self.spilled_bytes = 0
+        # Monotonic time after which the user is no longer waited for
+        self.expires = expires
+
+# Keeps the messages sent to users who have disconnected until they reconnect with the same user name
+# Only users who have been connected get a mailbox, when their connection closes, so messages to user names
+# that were never connected are still refused
+# One lock guards every mailbox, since storing a message only appends to a deque
+class OfflineStore:
+    __slots__ = ('mailboxes', 'resident', 'total_bytes', 'spilled_bytes', 'ttl', 'length', 'mailbox_bytes',
+                 'max_bytes', 'max_mailboxes', 'spill_directory', 'spill_limit', 'lock')
+
+    # Takes Float, Integer, Integer, Integer, Integer, String or None, and Integer as arguments
+    def __init__(self, ttl=OFFLINE_TTL, length=MAILBOX_LENGTH, mailbox_bytes=MAILBOX_BYTES,
+                 max_bytes=TOTAL_OFFLINE_BYTES, max_mailboxes=MAX_MAILBOXES, spill_directory=SPILL_DIRECTORY,
+                 spill_limit=SPILL_BYTES):
+        # Mailboxes, indexed by user name, from the one that expires first to the one that expires last
+        self.mailboxes = OrderedDict()
+        # Mailboxes with messages in memory, from least to most recently used, so the first is spilled first
+        self.resident = OrderedDict()
+        self.total_bytes = 0
+        self.spilled_bytes = 0
+        self.ttl = ttl
+        self.length = length
+        self.mailbox_bytes = mailbox_bytes
+        self.max_bytes = max_bytes
+        self.max_mailboxes = max_mailboxes
+        self.spill_directory = spill_directory
+        self.spill_limit = spill_limit
+        self.lock = threading.Lock()
+
+        # Spilled messages are only kept while the server runs, so files left by a previous run are removed
+        if spill_directory is not None:
+            os.makedirs(spill_directory, exist_ok = True)
+            for name in os.listdir(spill_directory):
+                if name.endswith(SPILL_SUFFIX):
+                    os.remove(os.path.join(spill_directory, name))
+
+    # Returns String path of a user's spill file, named by the hex digits of the user name so any name is safe
+    # Takes String as argument
+    def spill_path(self, user_name):
+        return os.path.join(self.spill_directory, user_name.encode().hex() + SPILL_SUFFIX)
+
+    # Open a mailbox for a user whose connection has closed, or extend it if the user has left before
+    # Takes String as argument
+    def user_left(self, user_name):
+        now = time.monotonic()
+        with self.lock:
+            self.remove_expired(now)
+            mailbox = self.mailboxes.get(user_name)
+            if mailbox is None:
+                self.mailboxes[user_name] = Mailbox(user_name, now + self.ttl)
+                while len(self.mailboxes) > self.max_mailboxes:
+                    self.discard(next(iter(self.mailboxes.values())))
+            else:
+                mailbox.expires = now + self.ttl
+                self.mailboxes.move_to_end(user_name)
+
+    # Keep a message for a disconnected user
+    # Returns True if the message was kept
+    # Returns String with error message if the user has no mailbox or their mailbox is full
+    # Takes String and bytes or Tuple of bytes-like parts as arguments
+    def store(self, user_name, frame):
+        data = framing.frame_bytes(frame)
+        size = len(data) + MESSAGE_OVERHEAD
+        now = time.monotonic()
+        with self.lock:
+            self.remove_expired(now)
+            mailbox = self.mailboxes.get(user_name)
+            if mailbox is None:
+                return 'ERROR:109:{}:This user does not exist'.format(user_name)
+            if (len(mailbox.frames) + mailbox.spilled_count >= self.length
+                    or mailbox.bytes + mailbox.spilled_bytes + size > self.mailbox_bytes):
+                return MAILBOX_FULL_ERROR.format(user_name)
+
+            mailbox.frames.append((now + self.ttl, data))
+            mailbox.bytes += size
+            self.total_bytes += size
+            # The mailbox lives as long as its newest message, so mailboxes stay ordered by expiry time
+            mailbox.expires = now + self.ttl
+            self.mailboxes.move_to_end(user_name)
+            self.resident[user_name] = mailbox
+            self.resident.move_to_end(user_name)
+
+            # Make room in memory by spilling or discarding the messages of the least recently used mailboxes
+            if self.total_bytes > self.max_bytes:
+                while self.total_bytes > self.max_bytes * SPILL_WATERMARK:
+                    self.evict(next(iter(self.resident.values())))
+        metrics.offline_stored.inc()
+        return True
+
+    # Remove a reconnected user's mailbox
+    # Returns List of the user's unexpired messages as encoded bytes, oldest first
+    # Takes String as argument
+    def take(self, user_name):
+        with self.lock:
+            mailbox = self.mailboxes.pop(user_name, None)
+            if mailbox is None:
+                return []
+            self.resident.pop(user_name, None)
+            self.total_bytes -= mailbox.bytes
+            self.spilled_bytes -= mailbox.spilled_bytes
+
+        now = time.monotonic()
+        frames = []
+        # Spilled messages are read outside the lock, since the mailbox can no longer be reached by other threads
+        if mailbox.spilled_count:
+            path = self.spill_path(user_name)
+            try:
+                with open(path, 'rb') as spill_file:
+                    for line in spill_file:
+                        expires, _, frame = line.partition(b' ')
+                        if float(expires) > now:
+                            frames.append(frame)
+                os.remove(path)
+            except (OSError, ValueError) as E:
+                print('Unexpected Error: Spilled messages could not be read')
+                print(E)
+        frames.extend(frame for expires, frame in mailbox.frames if expires > now)
+
+        metrics.offline_delivered.inc(len(frames))
+        metrics.offline_discarded.inc(len(mailbox.frames) + mailbox.spilled_count - len(frames))
+        return frames
+
+    # Remove every mailbox and the messages kept in it, including spilled messages
+    def clear(self):
+        with self.lock:
+            while self.mailboxes:
+                self.discard(next(iter(self.mailboxes.values())))
+
+    # Returns Integer of mailboxes kept
+    def mailbox_count(self):
+        return len(self.mailboxes)
+
+    # Remove the mailboxes that have expired, which are always the first mailboxes
+    # Called while holding the lock
+    # Takes Float of the current monotonic time as argument
+    def remove_expired(self, now):
+        while self.mailboxes:
+            mailbox = next(iter(self.mailboxes.values()))
+            if mailbox.expires > now:
+                break
+            self.discard(mailbox)
+
+    # Remove a mailbox and every message in it
+    # Called while holding the lock
+    # Takes Mailbox object as argument
+    def discard(self, mailbox):
+        del self.mailboxes[mailbox.user_name]
+        self.resident.pop(mailbox.user_name, None)
+        self.total_bytes -= mailbox.bytes
+        self.spilled_bytes -= mailbox.spilled_bytes
+        if mailbox.spilled_count:
+            try:
+                os.remove(self.spill_path(mailbox.user_name))
+            except OSError:
+                pass
+        metrics.offline_discarded.inc(len(mailbox.frames) + mailbox.spilled_count)
+
+    # Free the memory used by a mailbox's messages, appending them to its spill file if there is space on disk
+    # Called while holding the lock, and writes at most MAILBOX_BYTES
+    # Takes Mailbox object as argument
+    def evict(self, mailbox):
+        del self.resident[mailbox.user_name]
+        self.total_bytes -= mailbox.bytes
+        frames = mailbox.frames
+        mailbox.frames = []
+        size = mailbox.bytes
+        mailbox.bytes = 0
+
+        if self.spill_directory is not None and self.spilled_bytes + size <= self.spill_limit:
+            try:
+                with open(self.spill_path(mailbox.user_name), 'ab') as spill_file:
+                    spill_file.write(b''.join(b'%.3f %s' % (expires, frame) for expires, frame in frames))
+                mailbox.spilled_count += len(frames)
+                mailbox.spilled_bytes += size
+                self.spilled_bytes += size
+                return
+            # Messages are discarded if the disk fails, and each failed spill is reported
+            except OSError as E:
+                print('Unexpected Error: Messages could not be spilled to disk')
+                print(E)
+        metrics.offline_discarded.inc(len(frames))
@@ -0,0 +1,418 @@
+import operator
+import utilities
+
+# ==============================================================================================
+#                                      Message Types
+# ==============================================================================================
+
+# Error sent when a message has fewer fields than its command requires
+MISSING_FIELDS_ERROR = 'ERROR:110:Message is missing required parameters'
+# Error sent when a field of a message is not valid UTF-8
+ENCODING_ERROR = 'ERROR:116:Message is not valid UTF-8'
+
+# Create a message type: a tuple of the message's fields that can also be read by name
+# Messages are created from an iterable of their fields, such as Leave([('general',)]), which runs tuple's own
+# constructor rather than the Python-level constructor of a collections.namedtuple
+# Returns class
+# Takes String, String of the message's command, and List of Strings as arguments
+def message_type(type_name, command, field_names):
+    namespace = {
+        '__slots__': (),
+        'command': command,
+        '_fields': tuple(field_names),
+        '__repr__': message_repr
+    }
+    for index, field_name in enumerate(field_names):
+        namespace[field_name] = property(operator.itemgetter(index))
+    return type(type_name, (tuple,), namespace)
+
+# Returns String showing the type and named fields of a message
+# Takes message as argument
+def message_repr(message):
+    fields = ', '.join('{}={!r}'.format(name, value) for name, value in zip(message._fields, message))
+    return '{}({})'.format(type(message).__name__, fields)
+
+# Messages sent from a client to the server
+Name = message_type('Name', 'NAME', ['user_name', 'compression'])
+StillAlive = message_type('StillAlive', 'STILL_ALIVE', [])
+Join = message_type('Join', 'JOIN', ['room_names'])
+Rooms = message_type('Rooms', 'ROOMS', ['prefix', 'page'])
+Users = message_type('Users', 'USERS', ['room_name', 'page'])
+Leave = message_type('Leave', 'LEAVE', ['room_names'])
+ChatMessage = message_type('ChatMessage', 'MESSAGE', ['room_name', 'body'])
+PrivateMessage = message_type('PrivateMessage', 'MESSAGE_USER', ['user_names', 'body'])
+Quit = message_type('Quit', 'QUIT', [])
+Error = message_type('Error', 'ERROR', ['code', 'text'])
+SERVER_MESSAGE_TYPES = (Name, StillAlive, Join, Rooms, Users, Leave, ChatMessage, PrivateMessage, Quit, Error)
+
+# Messages sent from the server to a client
+JoinResponse = message_type('JoinResponse', 'JOIN_RESPONSE', ['room_names'])
+RoomsResponse = message_type('RoomsResponse', 'ROOMS_RESPONSE', ['rooms'])
+UsersResponse = message_type('UsersResponse', 'USERS_RESPONSE', ['room_name', 'members'])
+LeaveResponse = message_type('LeaveResponse', 'LEAVE_RESPONSE', ['room_names'])
+RoomMessage = message_type('RoomMessage', 'MESSAGE', ['room_name', 'sender', 'body'])
+UserMessage = message_type('UserMessage', 'MESSAGE_USER', ['user_names', 'sender', 'body'])
+Compression = message_type('Compression', 'COMPRESSION', ['algorithm'])
+
+# ==============================================================================================
+#                                     Parser Functions
+# ==============================================================================================
+
+# Longest parameter, payload, and parameter list messages may hold
+# Parameters are validated by utilities.validate_param_semantics(), payloads by validate_payload_semantics(),
+# and parameter lists by validate_list_semantics()
+MAX_PARAM_LENGTH = utilities.MAX_PARAM_LENGTH
+MAX_PAYLOAD_LENGTH = utilities.MAX_PAYLOAD_LENGTH
+MAX_LIST_LENGTH = utilities.MAX_LIST_LENGTH
+# Most parameters and parameter lists remembered as valid
+PARAM_CACHE_SIZE = 4096
+
+# Messages are immutable, so one message is shared by every message of a command without fields,
+# and by every ROOMS message that leaves out both of its optional fields
+STILL_ALIVE_MESSAGE = StillAlive(())
+QUIT_MESSAGE = Quit(())
+ALL_ROOMS_MESSAGE = Rooms(('', ''))
+
+# Valid parameters and parameter lists, keyed by the bytes they were received as, so the room and user names
+# repeated in most messages are decoded and validated once
+# Messages of commands that only take parameters are kept whole, keyed by the message's bytes
+# Each is cleared once it holds PARAM_CACHE_SIZE entries, so messages naming new rooms and users cannot grow it
+# without bound
+valid_params = {}
+valid_lists = {}
+parsed_messages = {}
+
+# Parsers are called with a message and its fields split at its first two colons: the command, the first field,
+# and the rest of the message, which is all that any command needs since every command has at most one
+# parameter before a parameter that may contain colons or its last field
+# Parameters are decoded to Strings since they are validated and used to find users and rooms,
+# while payloads stay as the bytes they were received in so a relayed message body is never decoded
+# Extra fields after a parameter list or a command's only parameter are ignored, while the last field of
+# any other command is the rest of the message, so payloads and text may contain colons
+# Messages are created from a Tuple of their fields, which is faster than from a List
+
+# Returns String decoded from a field, or None if the field is not valid UTF-8
+# Takes bytes as argument
+def decode_field(field):
+    try:
+        return field.decode()
+    except UnicodeDecodeError:
+        return None
+
+# Decode and validate a parameter that is not in valid_params, and remember it if it is valid
+# Returns Tuple of (String parameter, None), or (None, String with error message) if the parameter violates a rule
+# Takes bytes as argument
+def check_param(field):
+    param = decode_field(field)
+    if param is None:
+        return None, ENCODING_ERROR
+    if ' ' in param or len(param) > MAX_PARAM_LENGTH:
+        return None, utilities.validate_param_semantics(param)
+    if len(valid_params) >= PARAM_CACHE_SIZE:
+        valid_params.clear()
+    valid_params[field] = param
+    return param, None
+
+# Decode and validate a parameter list that is not in valid_lists, and remember it if it is valid
+# A list longer than one parameter is valid if it holds few enough names and every name is short enough
+# Returns Tuple of (Tuple of String names, None), or (None, String with error message) if the list violates a rule
+# Takes bytes as argument
+def check_list(field):
+    names = decode_field(field)
+    if names is None:
+        return None, ENCODING_ERROR
+    if ' ' in names or len(names) > MAX_PARAM_LENGTH:
+        list_check = utilities.validate_list_semantics(names.split(','))
+        if list_check != True:
+            return None, list_check
+    if ',' in names:
+        names = tuple(names.split(','))
+    else:
+        names = (names,)
+    if len(valid_lists) >= PARAM_CACHE_SIZE:
+        valid_lists.clear()
+    valid_lists[field] = names
+    return names, None
+
+# Remember the message parsed from a message of a command that only takes parameters
+# Returns the message
+# Takes bytes and message as arguments
+def remember_message(frame, message):
+    if len(parsed_messages) >= PARAM_CACHE_SIZE:
+        parsed_messages.clear()
+    parsed_messages[frame] = message
+    return message
+
+# Check a payload that may be too long or that holds multi-byte characters
+# The payload is decoded to count its characters and to check it is valid UTF-8
+# Returns True if the payload is valid, or String with error message if it violates a rule
+# Takes bytes as argument
+def check_payload(payload):
+    text = decode_field(payload)
+    if text is None:
+        return ENCODING_ERROR
+    return utilities.validate_payload_semantics(text)
+
+# Parsers of the messages a server accepts
+# Each returns the typed message, or String with error message if the message violates a rule
+# Takes bytes and List of the fields of the message as arguments
+
+def parse_chat_message(frame, fields):
+    if len(fields) < 3:
+        return MISSING_FIELDS_ERROR
+    room_name = valid_params.get(fields[1])
+    if room_name is None:
+        room_name, error = check_param(fields[1])
+        if error:
+            return error
+    body = fields[2]
+    if len(body) > MAX_PAYLOAD_LENGTH or not body.isascii():
+        payload_check = check_payload(body)
+        if payload_check != True:
+            return payload_check
+    return ChatMessage((room_name, body))
+
+def parse_private_message(frame, fields):
+    if len(fields) < 3:
+        return MISSING_FIELDS_ERROR
+    user_names = valid_lists.get(fields[1])
+    if user_names is None:
+        user_names, error = check_list(fields[1])
+        if error:
+            return error
+    body = fields[2]
+    if len(body) > MAX_PAYLOAD_LENGTH or not body.isascii():
+        payload_check = check_payload(body)
+        if payload_check != True:
+            return payload_check
+    return PrivateMessage((user_names, body))
+
+def parse_still_alive(frame, fields):
+    return STILL_ALIVE_MESSAGE
+
+def parse_quit(frame, fields):
+    return QUIT_MESSAGE
+
+def parse_join(frame, fields):
+    message = parsed_messages.get(frame)
+    if message is not None:
+        return message
+    if len(fields) < 2:
+        return MISSING_FIELDS_ERROR
+    room_names, error = check_list(fields[1])
+    if error:
+        return error
+    return remember_message(frame, Join((room_names,)))
+
+def parse_leave(frame, fields):
+    message = parsed_messages.get(frame)
+    if message is not None:
+        return message
+    if len(fields) < 2:
+        return MISSING_FIELDS_ERROR
+    room_names, error = check_list(fields[1])
+    if error:
+        return error
+    return remember_message(frame, Leave((room_names,)))
+
+def parse_rooms(frame, fields):
+    if len(fields) < 2:
+        return ALL_ROOMS_MESSAGE
+    message = parsed_messages.get(frame)
+    if message is None:
+        message = parse_two_params(Rooms, fields)
+        if not isinstance(message, str):
+            remember_message(frame, message)
+    return message
+
+def parse_users(frame, fields):
+    message = parsed_messages.get(frame)
+    if message is None:
+        message = parse_two_params(Users, fields)
+        if not isinstance(message, str):
+            remember_message(frame, message)
+    return message
+
+def parse_name(frame, fields):
+    return parse_two_params(Name, fields)
+
+# Parse a message of a required parameter followed by an optional parameter
+# Returns message of the given type, or String with error message if the message violates a rule
+# Takes message type and List of the fields of a message as arguments
+def parse_two_params(message_type, fields):
+    if len(fields) < 2:
+        return MISSING_FIELDS_ERROR
+    first = valid_params.get(fields[1])
+    if first is None:
+        first, error = check_param(fields[1])
+        if error:
+            return error
+    second = ''
+    if len(fields) > 2:
+        second = valid_params.get(fields[2])
+        if second is None:
+            second, error = check_param(fields[2])
+            if error:
+                return error
+    return message_type((first, second))
+
+# ERROR messages are accepted by servers and clients alike
+def parse_error(frame, fields):
+    if len(fields) < 3:
+        return MISSING_FIELDS_ERROR
+    code = valid_params.get(fields[1])
+    if code is None:
+        code, error = check_param(fields[1])
+        if error:
+            return error
+    text = decode_field(fields[2])
+    if text is None:
+        return ENCODING_ERROR
+    return Error((code, text))
+
+# Parsers of the messages a client accepts
+# Each returns the typed message, or String with error message if the message violates a rule
+# Takes bytes and List of the fields of the message as arguments
+
+def parse_room_message(frame, fields):
+    return parse_relayed_message(RoomMessage, valid_params, check_param, fields)
+
+def parse_user_message(frame, fields):
+    return parse_relayed_message(UserMessage, valid_lists, check_list, fields)
+
+# Parse a chat room or user message relayed from another user, whose sender comes before the payload
+# Returns message of the given type, or String with error message if the message violates a rule
+# Takes message type, Dictionary of valid first fields, function that checks the first field,
+# and List of the fields of a message as arguments
+def parse_relayed_message(message_type, valid_names, check_names, fields):
+    if len(fields) < 3:
+        return MISSING_FIELDS_ERROR
+    sender, separator, body = fields[2].partition(b':')
+    if not separator:
+        return MISSING_FIELDS_ERROR
+    names = valid_names.get(fields[1])
+    if names is None:
+        names, error = check_names(fields[1])
+        if error:
+            return error
+    sender_name = valid_params.get(sender)
+    if sender_name is None:
+        sender_name, error = check_param(sender)
+        if error:
+            return error
+    if len(body) > MAX_PAYLOAD_LENGTH or not body.isascii():
+        payload_check = check_payload(body)
+        if payload_check != True:
+            return payload_check
+    return message_type((names, sender_name, body))
+
+def parse_join_response(frame, fields):
+    if len(fields) < 2:
+        return MISSING_FIELDS_ERROR
+    room_names, error = check_list(fields[1])
+    return error or JoinResponse((room_names,))
+
+def parse_leave_response(frame, fields):
+    if len(fields) < 2:
+        return MISSING_FIELDS_ERROR
+    room_names, error = check_list(fields[1])
+    return error or LeaveResponse((room_names,))
+
+def parse_rooms_response(frame, fields):
+    if len(fields) < 2:
+        return MISSING_FIELDS_ERROR
+    rooms = decode_field(frame[len(fields[0]) + 1:])
+    if rooms is None:
+        return ENCODING_ERROR
+    return RoomsResponse((rooms,))
+
+def parse_users_response(frame, fields):
+    if len(fields) < 3:
+        return MISSING_FIELDS_ERROR
+    room_name, error = check_param(fields[1])
+    members = decode_field(fields[2])
+    if members is None:
+        return error or ENCODING_ERROR
+    return error or UsersResponse((room_name, members))
+
+def parse_compression(frame, fields):
+    if len(fields) < 2:
+        return MISSING_FIELDS_ERROR
+    algorithm, error = check_param(fields[1])
+    return error or Compression((algorithm,))
+
+# Returns String with error message for a message whose command is not in the command table
+# Takes bytes as argument
+def unknown_command(command):
+    command = decode_field(command)
+    if command is None:
+        return ENCODING_ERROR
+    # Validate that command portion of message is correctly formatted
+    command_check = utilities.validate_command_semantics(command)
+    if command_check != True:
+        return command_check
+    return 'ERROR:100:Command is not included in the list of approved commands'
+
+# ==============================================================================================
+#                                      Command Tables
+# ==============================================================================================
+
+# Commands a server accepts from its clients, with the parser of each command
+# NAME takes an optional compression algorithm, such as NAME:alice:zlib, which the server compresses the messages
+# it sends to the client with if it supports the algorithm
+# JOIN, LEAVE, and MESSAGE_USER take a list of rooms or users, so a client joins or leaves many rooms or
+# messages many users with one message, such as JOIN:room1,room2 or MESSAGE_USER:user1,user2:body
+# ROOMS takes an optional prefix that listed room names must start with and an optional page number,
+# and USERS takes an optional page number, for listings too long to send in one message
+SERVER_COMMANDS = {
+    b'NAME': parse_name,
+    b'STILL_ALIVE': parse_still_alive,
+    b'JOIN': parse_join,
+    b'ROOMS': parse_rooms,
+    b'USERS': parse_users,
+    b'LEAVE': parse_leave,
+    b'MESSAGE': parse_chat_message,
+    b'MESSAGE_USER': parse_private_message,
+    b'QUIT': parse_quit,
+    b'ERROR': parse_error
+}
+
+# Commands a client accepts from the server, with the parser of each command
+# A ROOMS_RESPONSE or USERS_RESPONSE listing that continues on another page ends with a colon
+# and the number of the next page, which names cannot contain
+# Responses to a list of rooms or users list every room or user the command succeeded for
+# COMPRESSION confirms the compression algorithm asked for in the NAME message, and every byte the server sends
+# after it is compressed, as described in stream_compression.py
+CLIENT_COMMANDS = {
+    b'STILL_ALIVE': parse_still_alive,
+    b'JOIN_RESPONSE': parse_join_response,
+    b'ROOMS_RESPONSE': parse_rooms_response,
+    b'USERS_RESPONSE': parse_users_response,
+    b'LEAVE_RESPONSE': parse_leave_response,
+    b'MESSAGE': parse_room_message,
+    b'MESSAGE_USER': parse_user_message,
+    b'QUIT': parse_quit,
+    b'COMPRESSION': parse_compression,
+    b'ERROR': parse_error
+}
+
+# Parse and validate a message received by a server
+# The message is split once and handed to the parser of its command from the command table
+# Returns the typed message, or String with error message if the message violates a rule
+# Takes bytes as argument
+def parse_server_message(frame):
+    fields = frame.split(b':', 2)
+    parser = SERVER_COMMANDS.get(fields[0])
+    if parser is None:
+        return unknown_command(fields[0])
+    return parser(frame, fields)
+
+# Parse and validate a message received by a client
+# Returns the typed message, or String with error message if the message violates a rule
+# Takes bytes as argument
+def parse_client_message(frame):
+    fields = frame.split(b':', 2)
+    parser = CLIENT_COMMANDS.get(fields[0])
+    if parser is None:
+        return unknown_command(fields[0])
+    return parser(frame, fields)
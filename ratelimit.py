@@ -0,0 +1,172 @@
+import threading
+import time
+import protocol
+
+# ==============================================================================================
+#                                    Rate Limit Settings
+# ==============================================================================================
+
+# Rate limits are applied to every client connection, False to accept messages as fast as clients send them
+ENABLED = True
+# Each limit is a Tuple of (messages per second, burst), where burst is the most messages accepted at once
+# after a client has been idle
+# Every message a connection sends, including messages sent before registering
+CONNECTION_LIMIT = (50, 100)
+# MESSAGE and MESSAGE_USER, the commands that are delivered to other users
+CHAT_LIMIT = (10, 20)
+# JOIN and LEAVE, with a large burst so a client can rejoin its rooms after reconnecting
+ROOM_LIMIT = (5, 100)
+# ROOMS and USERS, whose responses grow with the number of rooms and members
+QUERY_LIMIT = (2, 10)
+# Refused messages a client may send before it is disconnected, refilled at the given rate per second,
+# so a client that only briefly exceeds its limits is never disconnected
+STRIKE_LIMIT = (1, 20)
+# Seconds the limits of a user are kept after they disconnect, so reconnecting does not refill their buckets
+# At least the time the slowest bucket takes to refill from empty, since a user away for longer has full buckets anyway
+USER_LIMITS_TTL = 60
+
+# Error sent when a message is refused for exceeding a rate limit
+RATE_LIMIT_ERROR = 'ERROR:112:Too many messages, message was not delivered'
+# Error sent before the connection of a client that keeps exceeding its rate limits is closed
+ABUSE_ERROR = 'ERROR:112:Too many messages, connection is closing'
+
+# Limits of each command class, indexed by the message types the class contains
+# Commands without a class, such as STILL_ALIVE and QUIT, are only limited by CONNECTION_LIMIT
+# A JOIN, LEAVE, or MESSAGE_USER message listing several rooms or users counts as one message, as their number
+# is bounded by protocol.MAX_LIST_LENGTH
+COMMAND_CLASSES = {
+    'chat': ((protocol.ChatMessage, protocol.PrivateMessage), CHAT_LIMIT),
+    'room': ((protocol.Join, protocol.Leave), ROOM_LIMIT),
+    'query': ((protocol.Rooms, protocol.Users), QUERY_LIMIT)
+}
+
+# Position of the bucket of each limited message type in a rate limiter's buckets,
+# shared by every connection so each limiter only keeps a Tuple of its buckets
+BUCKET_INDEXES = {message_type: index
+                  for index, (message_types, limit) in enumerate(COMMAND_CLASSES.values())
+                  for message_type in message_types}
+
+# ==============================================================================================
+#                                       Token Buckets
+# ==============================================================================================
+
+# Allows a number of events per second with bursts up to a limit
+# Tokens are added when the bucket is checked rather than by a timer, so each check is a few arithmetic operations
+class TokenBucket:
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    # Takes Tuple of (number of events per second, Integer burst) and Float of the current monotonic time as arguments
+    def __init__(self, limit, now):
+        self.rate, self.burst = limit
+        self.tokens = self.burst
+        self.updated = now
+
+    # Returns True and removes a token if one is available
+    # Takes Float of the current monotonic time as argument
+    def take(self, now):
+        tokens = self.tokens + (now - self.updated) * self.rate
+        if tokens > self.burst:
+            tokens = self.burst
+        self.updated = now
+        if tokens < 1:
+            self.tokens = tokens
+            return False
+        self.tokens = tokens - 1
+        return True
+
+# Command class and strike buckets of one user, kept while the user is disconnected
+# so a client cannot refill its buckets by reconnecting
+class UserLimits:
+    __slots__ = ('user_name', 'buckets', 'strikes', 'expires')
+
+    # Takes String or None, and Float of the current monotonic time as arguments
+    def __init__(self, user_name, now):
+        self.user_name = user_name
+        # Bucket of each command class, found from a message type by BUCKET_INDEXES
+        self.buckets = tuple(TokenBucket(limit, now) for message_types, limit in COMMAND_CLASSES.values())
+        # Only created once a message is refused
+        self.strikes = None
+        # Monotonic time the limits are forgotten, once the user has disconnected
+        self.expires = None
+
+# Limits of users who have disconnected, by user name
+# A user's limits are taken out when they register and put back when they disconnect, so only the limits
+# of users who have disconnected in the last USER_LIMITS_TTL seconds are kept
+user_limits = {}
+# Guards user_limits, since the threaded server registers and disconnects users from many threads
+user_limits_lock = threading.Lock()
+# Monotonic time expired limits are next removed from user_limits
+next_expiry = 0
+
+# Returns the kept limits of a user, or new limits if the user has none
+# Takes String and Float of the current monotonic time as arguments
+def take_user_limits(user_name, now):
+    with user_limits_lock:
+        limits = user_limits.pop(user_name, None)
+    if limits is None or limits.expires <= now:
+        return UserLimits(user_name, now)
+    limits.expires = None
+    return limits
+
+# Keep the limits of a user who has disconnected until USER_LIMITS_TTL seconds have passed
+# Expired limits are removed at most once every USER_LIMITS_TTL seconds, so each disconnection is constant time
+# Takes User Limits object as argument
+def keep_user_limits(limits):
+    global next_expiry
+    now = time.monotonic()
+    limits.expires = now + USER_LIMITS_TTL
+    with user_limits_lock:
+        user_limits[limits.user_name] = limits
+        if now >= next_expiry:
+            for user_name in [user_name for user_name, kept in user_limits.items() if kept.expires <= now]:
+                del user_limits[user_name]
+            next_expiry = now + USER_LIMITS_TTL
+
+# Forget the limits of every user who has disconnected
+def clear():
+    with user_limits_lock:
+        user_limits.clear()
+
+# Rate limits of one client connection
+# The connection bucket belongs to the connection, while the command class and strike buckets belong to the user
+# the connection registered, and outlive the connection
+class RateLimiter:
+    __slots__ = ('connection', 'buckets', 'user')
+
+    # Buckets share one creation time, since every idle connection keeps a limiter
+    # A limiter without a user name, which limits NAME attempts, keeps its user limits to itself
+    # Takes String or None as argument
+    def __init__(self, user_name=None):
+        now = time.monotonic()
+        self.connection = TokenBucket(CONNECTION_LIMIT, now)
+        self.user = UserLimits(None, now) if user_name is None else take_user_limits(user_name, now)
+        # The user's command class buckets, kept here as well so each check follows one fewer reference
+        self.buckets = self.user.buckets
+
+    # Returns True if a message of the given type is within the connection's limits
+    # Takes the type of the message parsed by receive_message() as argument
+    def allow(self, message_type):
+        now = time.monotonic()
+        if not self.connection.take(now):
+            return False
+        index = BUCKET_INDEXES.get(message_type)
+        return index is None or self.buckets[index].take(now)
+
+    # Count a refused message against the user
+    # Returns False if the user has been refused too often and the connection should be closed
+    def strike(self):
+        now = time.monotonic()
+        user = self.user
+        if user.strikes is None:
+            user.strikes = TokenBucket(STRIKE_LIMIT, now)
+        return user.strikes.take(now)
+
+    # Keep the user's limits for their next connection, once this connection has closed
+    def release(self):
+        if self.user.user_name is not None:
+            keep_user_limits(self.user)
+
+# Returns a new Rate Limiter object, or None if rate limits are disabled
+# Takes String of the user name the connection registered, or None before it has registered, as argument
+def new_limiter(user_name=None):
+    return RateLimiter(user_name) if ENABLED else None
@@ -0,0 +1,249 @@
+import socket
+import threading
+from collections import deque
+import framing
+import metrics
+import stream_compression
+
+# ==============================================================================================
+#                                    Send Queue Settings
+# ==============================================================================================
+
+# Policies for a connection whose send queue is full because the client is not reading fast enough
+# 'drop_oldest': discard the oldest queued messages to make room for the new message
+# 'disconnect': close the connection to the slow client
+# 'block': make the sending thread wait until the queue has room, as the server did before send queues existed
+POLICIES = ('drop_oldest', 'disconnect', 'block')
+# Policy used for connections that are not given a policy when their queue is created
+SLOW_CONSUMER_POLICY = 'disconnect'
+# Largest number of bytes that may wait in a connection's send queue before the slow consumer policy applies
+MAX_QUEUED_BYTES = 1024 * 1024
+
+# ==============================================================================================
+#                                       Send Queues
+# ==============================================================================================
+
+# Bounded queue of encoded messages waiting to be written to one connection
+# Subclasses decide how and when the queued messages are written
+# Provides send() and close() so a queue can be stored as the socket of a Connection object
+class OutboundQueue:
+    __slots__ = ('frames', 'queued_bytes', 'policy', 'max_bytes', 'closed', 'compressor', 'raw_frames',
+                 'peak_bytes', 'sent_frames', 'sent_batches', 'dropped_frames')
+
+    # Takes String and Integer as arguments
+    def __init__(self, policy=None, max_bytes=None):
+        policy = policy or SLOW_CONSUMER_POLICY
+        if policy not in POLICIES:
+            raise ValueError('Unknown slow consumer policy: {}'.format(policy))
+        self.frames = deque()
+        self.queued_bytes = 0
+        self.policy = policy
+        self.max_bytes = max_bytes or MAX_QUEUED_BYTES
+        self.closed = False
+        # zlib compressor once the client has asked for compressed messages, otherwise None,
+        # and the number of queued messages at the front of the queue that are still sent uncompressed
+        self.compressor = None
+        self.raw_frames = 0
+        # Counters describing how the queue has been used
+        self.peak_bytes = 0
+        self.sent_frames = 0
+        self.sent_batches = 0
+        self.dropped_frames = 0
+
+    # Number of messages waiting to be written
+    def depth(self):
+        return len(self.frames)
+
+    # Returns Dictionary of queue depth counters
+    def stats(self):
+        return {
+            'depth': len(self.frames),
+            'queued_bytes': self.queued_bytes,
+            'peak_bytes': self.peak_bytes,
+            'sent_frames': self.sent_frames,
+            'sent_batches': self.sent_batches,
+            'dropped_frames': self.dropped_frames
+        }
+
+    # Add encoded message to the end of the queue
+    # Takes encoded message and its size in bytes as arguments
+    def append_frame(self, data, size):
+        self.frames.append(data)
+        self.queued_bytes += size
+        if self.queued_bytes > self.peak_bytes:
+            self.peak_bytes = self.queued_bytes
+
+    # Discard the oldest queued messages until a message of the given size fits in the queue
+    # Takes Integer as argument
+    def drop_oldest(self, size):
+        while self.frames and self.queued_bytes + size > self.max_bytes:
+            self.queued_bytes -= framing.frame_size(self.frames.popleft())
+            if self.raw_frames:
+                self.raw_frames -= 1
+            self.record_dropped(1)
+
+    # Count messages discarded by the slow consumer policy
+    # Takes Integer as argument
+    def record_dropped(self, count):
+        self.dropped_frames += count
+        metrics.dropped_messages.inc(count)
+
+    # Compress every message queued from now on, after the messages already queued and the given message,
+    # which are sent uncompressed
+    # Takes bytes of the message telling the client that compression has started, or None, as argument
+    def begin_compression(self, frame=None):
+        if frame is not None:
+            self.append_frame(frame, len(frame))
+        self.raw_frames = len(self.frames)
+        self.compressor = stream_compression.new_compressor()
+
+    # Remove every queued message so it can be written in one call
+    # Returns Tuple of (List of encoded messages, Integer number of messages at the front of the batch
+    # that are not compressed, and zlib compressor object or None if the connection is not compressed)
+    def take_batch(self):
+        batch = list(self.frames)
+        metrics.sent_messages.inc(len(batch))
+        metrics.sent_bytes.inc(self.queued_bytes)
+        metrics.send_batch_messages.observe(len(batch))
+        self.frames.clear()
+        self.queued_bytes = 0
+        self.sent_frames += len(batch)
+        self.sent_batches += 1
+        raw_frames = self.raw_frames
+        self.raw_frames = 0
+        return batch, raw_frames, self.compressor
+
+# Returns List of the buffers to write for a batch of messages, compressing the messages that follow the
+# uncompressed messages at the front of the batch when the connection is compressed
+# Compressing is left out of take_batch() so the threaded server does not hold the queue's lock while compressing
+# Takes Tuple returned by OutboundQueue.take_batch() as argument
+def batch_buffers(batch):
+    frames, raw_frames, compressor = batch
+    if compressor is None:
+        return framing.frame_buffers(frames)
+    buffers = framing.frame_buffers(frames[:raw_frames])
+    if raw_frames < len(frames):
+        buffers.append(stream_compression.compress(compressor, framing.frame_buffers(frames[raw_frames:])))
+    return buffers
+
+# Send queue for the threaded server
+# Messages are written by a writer thread owned by the connection, so a thread sending to a slow client
+# only waits if the connection uses the 'block' policy
+class SendQueue(OutboundQueue):
+    __slots__ = ('sock', 'condition', 'thread', 'released')
+
+    # Takes socket object, String, and Integer as arguments
+    def __init__(self, sock, policy=None, max_bytes=None):
+        super().__init__(policy, max_bytes)
+        self.sock = sock
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.write_loop)
+        # True once the socket has been handed to another owner, so the writer thread leaves it open
+        self.released = False
+
+    # Launch thread that writes queued messages to the socket
+    def start(self):
+        self.thread.start()
+        return self
+
+    # Queue encoded message to be written to the socket
+    # Takes bytes or Tuple of bytes-like parts as argument
+    def send(self, data):
+        size = framing.frame_size(data)
+        with self.condition:
+            if self.closed:
+                return 0
+            if self.queued_bytes + size > self.max_bytes:
+                if self.policy == 'drop_oldest':
+                    self.drop_oldest(size)
+                elif self.policy == 'disconnect':
+                    self.record_dropped(len(self.frames) + 1)
+                    self.abort()
+                    return 0
+                else:
+                    # Wait until the writer thread has made room in the queue or the connection closes
+                    while self.frames and self.queued_bytes + size > self.max_bytes and not self.closed:
+                        self.condition.wait()
+                    if self.closed:
+                        return 0
+            self.append_frame(data, size)
+            self.condition.notify_all()
+        return size
+
+    # Compress every message queued from now on, after the messages already queued and the given message
+    # Takes bytes or None as argument
+    def begin_compression(self, frame=None):
+        with self.condition:
+            if self.closed:
+                return
+            super().begin_compression(frame)
+            self.condition.notify_all()
+
+    # Write any queued messages and then close the connection
+    def close(self):
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        # Close socket directly if the writer thread was never started
+        if self.thread.ident is None:
+            self.shutdown_socket()
+
+    # Write any queued messages and stop the writer thread, leaving the socket open for its new owner
+    # Returns False if the messages could not be written within the timeout, in which case the connection is shut down
+    # Takes Float number of seconds or None as argument
+    def release(self, timeout=None):
+        with self.condition:
+            self.closed = True
+            self.released = True
+            self.condition.notify_all()
+        if self.thread.ident is None:
+            return True
+        self.thread.join(timeout)
+        if self.thread.is_alive():
+            with self.condition:
+                self.abort()
+            return False
+        return True
+
+    # Close the connection immediately and discard any queued messages
+    # Must be called while holding the queue's condition
+    def abort(self):
+        self.frames.clear()
+        self.queued_bytes = 0
+        self.closed = True
+        self.condition.notify_all()
+        # Shutting the socket down wakes the threads blocked reading from or writing to it
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    # Shut down and close the socket, waking any thread blocked reading from it
+    def shutdown_socket(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+    # Writer thread waits for queued messages and writes every message queued so far with one gathered write
+    # A compressed connection's stream is ended once the writer stops for a new owner, which starts a new stream
+    def write_loop(self):
+        try:
+            while True:
+                with self.condition:
+                    while not self.frames and not self.closed:
+                        self.condition.wait()
+                    if not self.frames:
+                        break
+                    batch = self.take_batch()
+                    # Wake threads waiting for room in the queue
+                    self.condition.notify_all()
+                framing.send_buffers(self.sock, batch_buffers(batch))
+            if self.released and self.compressor is not None:
+                framing.send_buffers(self.sock, [stream_compression.finish(self.compressor)])
+        except OSError:
+            with self.condition:
+                self.abort()
+        if not self.released:
+            self.shutdown_socket()
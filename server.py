@@ -1,8 +1,22 @@
+import bisect
+import os
+import select
 import socket
+import sys
 import threading
 import time
-import utilities
-from datetime import datetime, timedelta
+import framing
+import handoff
+import history
+import keepalive
+import message_log
+import metrics
+import offline
+import protocol
+import ratelimit
+import send_queue
+import stream_compression
+import tls
 
 # ==============================================================================================
 #                                    Global Server State
@@ -12,132 +26,259 @@ from datetime import datetime, timedelta
 HOST = '0.0.0.0'
 # Port number specified in protocol
 PORT = 2787
+# Number of pending TCP connection requests the listening socket will queue before new ones are refused
+BACKLOG = 1024
+# Most names listed in one ROOMS_RESPONSE or USERS_RESPONSE message, longer listings are split into pages
+LISTING_PAGE_SIZE = 500
+# Seconds a stopping server waits for its handler threads to finish before forgetting its users and chat rooms
+CLOSE_TIMEOUT = 2
 
-# List of TCP connections to all active clients
-# Each connection in the list is a dictionary with the following format:
-# {
-#     'user_name': String,
-#     'socket': Socket Object,
-#     'timestamp': datetime Object,
-#     'alive': Boolean
-# }
-clients = []
-
-# List of chat rooms
-# Each room in the list is a dictionary with the following format:
-# {
-#     'room_name': String,
-#     'members': String[]
-# }
-chat_rooms = []
-
-# Listen for incoming TCP connection requests
-server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-server.bind((HOST, PORT))
-server.listen(1)
-print('IRC Server is listening...')
+PAGE_ERROR = 'ERROR:113:Page number is not valid'
+
+# Connection objects of all active clients, indexed by user name
+clients = {}
+
+# Room objects of every chat room, indexed by room name and kept in the order they were created
+chat_rooms = {}
+
+# Encoded ROOMS_RESPONSE messages listing every chat room in the order they were created, one for each page
+# Built when first requested and discarded when a room is created
+rooms_pages = None
+# Names of every chat room in sorted order, so the rooms starting with a prefix are found by binary search
+sorted_room_names = []
+
+# Guards adding and removing entries in the clients and chat_rooms dictionaries, and the room listings
+# Locks are always acquired in the order: client lock, registry lock, room lock, history lock, log lock
+registry_lock = threading.Lock()
+
+# Recent messages of every chat room, replayed to users when they join a room
+# A room's messages are recorded while holding the room's lock, so a joining user receives each message
+# exactly once: either in the replay or as a member of the room
+room_history = history.HistoryStore()
+
+# Messages sent to users who have disconnected, delivered when they reconnect with the same user name
+offline_messages = offline.OfflineStore()
+
+# Append-only log that chat rooms and messages are written to, so they survive a restart
+# Set by open_message_log() when message_log.LOG_DIRECTORY is set, otherwise None
+persistent_log = None
+
+# True once this server has started handing its connections over to a new server process
+draining = False
+# Pipe written to when a drain starts, which wakes every handler thread waiting for its client
+# Created by IRCServer.start() when the server can hand its connections over, otherwise None
+drain_wakeup = None
+# Connections whose handler threads have stopped reading for a drain, as Tuples of
+# (socket object, Send Queue object, Connection object or None, bytes received but not handled)
+paused_connections = []
+# Sockets of the connections served by the threaded server's handler threads, so a drain can wait for them
+open_connections = set()
+
+# Bus used to share users, room membership, and messages with the other worker processes of a cluster
+# or with the other servers of a federated network
+# Set by cluster.py or federation.py when the server is part of a larger network, otherwise None
+cluster = None
+
+# ==============================================================================================
+#                                Connection and Room Objects
+# ==============================================================================================
+
+# One registered user, connected to this server or to another worker process or server of a larger network
+# A client's lock guards its alive flag and its set of rooms, so joining, leaving,
+# and closing the connection happen one at a time for each user
+# The object and its rate limiter and keepalive timers take about 1 KB, but a whole idle connection, with its
+# socket, send queue, message reader, and the threaded server's two threads, grows the server process by about
+# 43 KB in the threaded server and 7 KB in the async server, as measured by the memory benchmark in benchmark.py
+class Connection:
+    __slots__ = ('user_name', 'socket', 'timestamp', 'alive', 'rooms', 'lock', 'remote', 'limiter')
+
+    # Takes socket object, String, and Boolean as arguments
+    def __init__(self, connection, user_name, remote=False):
+        # Names are interned so the clients dictionary, room members, and offline mailboxes share one String
+        self.user_name = sys.intern(user_name)
+        # Send Queue Object, or the object that forwards messages to another worker process or server
+        self.socket = connection
+        # Monotonic time of the last STILL_ALIVE message
+        self.timestamp = time.monotonic()
+        self.alive = True
+        # Names of the chat rooms the user is a member of, as the keys of a dictionary,
+        # since an empty dictionary is less than a third of the size of an empty set
+        self.rooms = {}
+        self.lock = threading.Lock()
+        # True if the user is connected to another worker process or server
+        self.remote = remote
+        # None if the user is connected to another worker process or server, or limits are disabled
+        self.limiter = None if remote else ratelimit.new_limiter(self.user_name)
+
+# One chat room
+# Members are indexed by user name so membership checks and removals are constant time
+# while the order users joined the room is preserved for USERS_RESPONSE messages
+# Each member maps to their Connection object so broadcasts can reach member sockets without searching for them
+# A room's lock guards its members, so activity in one room never waits for activity in another room
+class Room:
+    __slots__ = ('room_name', 'members', 'lock', 'users_pages')
+
+    # Takes String as argument
+    def __init__(self, room_name):
+        # Names are interned so every member's set of rooms shares the room's String
+        self.room_name = sys.intern(room_name)
+        self.members = {}
+        self.lock = threading.Lock()
+        # Encoded USERS_RESPONSE messages listing the members, kept until a user joins or leaves the room
+        # so repeated USERS requests are not rebuilt from the members, None until requested
+        self.users_pages = None
 
 # ==============================================================================================
 #                               Connection Maintenance Functions
 # ==============================================================================================
 
 # Terminate client TCP connection with individual client
-# Takes client dictionary as argument
+# Takes Connection object as argument
 def close_connection(client):
-    client['alive'] = False
-    # Remove client from list of active clients
-    index = find_client(client['user_name'])
-    clients.pop(index)
+    user_name = client.user_name
+    with client.lock:
+        client.alive = False
+        # Remove client from list of active clients
+        # Connection may already have been removed by another thread, and the user name may now belong to a new client
+        with registry_lock:
+            removed = clients.get(user_name) is client
+            if removed:
+                del clients[user_name]
+
+        if removed:
+            # Remove client from any chat rooms where they are a member
+            for room_name in client.rooms:
+                discard_member(chat_rooms[room_name], client)
+            client.rooms.clear()
+            print('{} has left'.format(user_name))
+            metrics.disconnections.inc()
+            # Keep messages sent to the user until they reconnect
+            offline_messages.user_left(user_name)
+            # Keep the user's rate limits, so reconnecting does not reset them
+            if client.limiter is not None:
+                client.limiter.release()
+
+            # Tell the other worker processes that the user name is free again
+            if cluster is not None and not client.remote:
+                cluster.user_left(user_name)
+
+    client.socket.close()
 
-    # Remove client from any chat rooms where they are a member
-    for room in chat_rooms:
-        if client['user_name'] in room['members']:
-            room['members'].remove(client['user_name'])
+# Sends STILL_ALIVE messages to every client and closes connections that stop sending STILL_ALIVE messages
+keep_alive = keepalive.KeepAliveScheduler(close_connection)
 
-    client['socket'].close()
-    print('{} has left'.format(client['user_name']))
+# Forget every user, chat room, kept message, keepalive timer, and rate limit, so a server started later in the
+# same process starts with none of the state of the servers before it
+# Called once every handler thread has finished, since handler threads remove their clients from the chat rooms
+def reset_server_state():
+    global rooms_pages, draining, drain_wakeup
+    with registry_lock:
+        clients.clear()
+        chat_rooms.clear()
+        sorted_room_names.clear()
+        rooms_pages = None
+    room_history.clear()
+    offline_messages.clear()
+    keep_alive.clear()
+    ratelimit.clear()
+    if drain_wakeup is not None:
+        for fd in drain_wakeup:
+            os.close(fd)
+        drain_wakeup = None
+    draining = False
+    paused_connections.clear()
 
 # Terminate client TCP connection with all clients
 def close_all_connections():
-    for client in clients:
+    with registry_lock:
+        connections = [client for client in clients.values() if not client.remote]
+    for client in connections:
         msg = 'QUIT'
-        send_message(client['socket'], msg)
-        client['socket'].close()
+        send_message(client.socket, msg)
+        client.socket.close()
 
-# Find a specific client socket in the list of client TCP connections using the user name passed as an argument
-# If client is found, returns Integer index of client in list of clients
-# Returns -1 if clients list is empty or if user not found in list
+# Find a specific client in the dictionary of client TCP connections using the user name passed as an argument
+# If client is found, returns Connection object
+# Returns None if user is not connected to the server
 # Takes String as argument
 def find_client(user_name):
-    if not clients:
-        return -1
-    for index, dic in enumerate(clients):
-        if dic['user_name'] == user_name:
-            return index
-    return -1
-
-# Find a specific chat room in the list of chat rooms using the room name passed as an argument
-# If chat room is found, returns Integer index of room in list of chat rooms
-# Returns -1 if chat rooms list is empty or if room not found in list
+    return clients.get(user_name)
+
+# Find a specific chat room in the dictionary of chat rooms using the room name passed as an argument
+# If chat room is found, returns Room object
+# Returns None if room has not been created
 # Takes String as argument
 def find_chat_room(room_name):
-    room_found = False
-    room_index = 0
+    return chat_rooms.get(room_name)
 
-    for room in chat_rooms:
-        if room['room_name'] == room_name:
-            room_found = True
-            break
-        room_index += 1
+# Create a chat room without members, or find it if it has already been created
+# Returns Room object
+# Takes String as argument
+def create_chat_room(room_name):
+    global rooms_pages
+    room = chat_rooms.get(room_name)
+    if room is None:
+        with registry_lock:
+            # Check again in case another thread created the room before the lock was acquired
+            room = chat_rooms.get(room_name)
+            if room is None:
+                room = Room(room_name)
+                chat_rooms[room.room_name] = room
+                bisect.insort(sorted_room_names, room.room_name)
+                rooms_pages = None
+                if persistent_log is not None:
+                    persistent_log.append_room(room_name)
+    return room
 
-    if room_found:
-        return room_index
-    else:
-        return -1
+# Add a client to a chat room, creating the room if it does not exist yet
+# Adding a user who is already a member of the room, or whose connection has closed, has no effect
+# Returns List of up to replay of the room's most recent messages as encoded bytes if the user is a new member
+# Takes String, Connection object, and Integer as arguments
+def add_room_member(room_name, client, replay=0):
+    with client.lock:
+        if not client.alive:
+            return []
 
-# Function sends STILL_ALIVE messages to client passed as argument to ensure this client knows that the connection is still alive
-# Takes client dictionary as argument
-def send_keep_alive(client):
-    try:
-        while True:
-            # Stop sending messages if connection closes
-            if not client['alive']:
-                break
-            msg = 'STILL_ALIVE'
-            send_message(client['socket'], msg)
-            # Wait 5 seconds in between each STILL_ALIVE message
-            time.sleep(5)
+        room = create_chat_room(room_name)
+        with room.lock:
+            new_member = client.user_name not in room.members
+            room.members[client.user_name] = client
+            if new_member:
+                room.users_pages = None
+            recent = room_history.recent(room_name, replay) if new_member else []
+        client.rooms[room.room_name] = None
 
-    # End program if unexpected error occurs
-    except Exception as E:
-        print('Unexpected Error: Connection has closed')
-        close_connection(client)
+        if cluster is not None and not client.remote:
+            cluster.room_joined(room_name, client.user_name)
+    return recent
 
-# Function verifies that STILL_ALIVE messages are being received from the client passed as an argument within the timeout window
-# Takes client dictionary as argument
-def verify_keep_alive(client):
-    try:
-        alive_window = timedelta(seconds = 10)
+# Remove a client from a chat room
+# Removing a user who is not a member of the room has no effect
+# Takes Room object and Connection object as arguments
+def remove_room_member(room, client):
+    with client.lock:
+        discard_member(room, client)
+        client.rooms.pop(room.room_name, None)
 
-        while True:
-            # Wait 10 seconds in between checking timestamp from last STILL_ALIVE message
-            time.sleep(10)
-            # Stop checking messages if connection closes
-            if not client['alive']:
-                break
+        if cluster is not None and not client.remote:
+            cluster.room_left(room.room_name, client.user_name)
 
-            # If STILL_ALIVE message is not received from client within the last 10 seconds,
-            # then the server assumes client is down and ends the program
-            window_start = datetime.now() - alive_window
-            if client['timestamp'] < window_start:
-                print('Unexpected Error: Client is no longer online')
-                close_connection(client)
-                break
+# Remove a client from a room's members without changing the client's set of rooms
+# A new client that has since registered the same user name and joined the room is left in place
+# Takes Room object and Connection object as arguments
+def discard_member(room, client):
+    user_name = client.user_name
+    with room.lock:
+        if room.members.get(user_name) is client:
+            del room.members[user_name]
+            room.users_pages = None
 
-    # End program if unexpected error occurs
-    except Exception as E:
-        print('Unexpected Error: Connection has closed')
-        close_connection(client)
+# Copy the list of members of a chat room
+# Returns Tuple of Connection objects
+# Takes Room object as argument
+def room_members(room):
+    with room.lock:
+        return tuple(room.members.values())
 
 # ==============================================================================================
 #                                    Message Handlers
@@ -146,317 +287,572 @@ def verify_keep_alive(client):
 # Send encoded message to client over TCP connection
 # Takes a socket object and a String as arguments
 def send_message(client_socket, msg):
-    client_socket.send(msg.encode())
+    client_socket.send(framing.encode_frame(msg))
 
-# Receives and parses encoded message from client socket
-# Returns the parsed message as a List of Strings and the command portion of the message as a String
-# Takes socket object as argument
-def receive_message(client_socket):
-    message = client_socket.recv(1024).decode()
-    message = message.split(':')
-    command = message[0]
-    return message, command
+# Send one encoded message to every client in a group of clients
+# The message is encoded once and the same bytes are sent to each recipient
+# Takes an iterable of Connection objects and a String as arguments
+def broadcast_message(recipients, msg):
+    broadcast_frame(recipients, framing.encode_frame(msg))
+
+# Send the same encoded message to every client in a group of clients
+# Takes an iterable of Connection objects and bytes or Tuple of bytes-like parts as arguments
+def broadcast_frame(recipients, frame):
+    for recipient in recipients:
+        recipient.socket.send(frame)
+
+# Build a message that relays a body received from a client
+# Only the header is encoded, and the body is sent from the bytes it was received in
+# Returns Tuple of bytes-like parts
+# Takes String and bytes as arguments
+def relay_frame(header, body):
+    return (header.encode(), body, framing.DELIMITER)
+
+# Combine the errors for the rooms or users named in a list into one error message for each kind of error,
+# which names every room or user the error applies to, separated by commas
+# Returns bytes of the encoded error messages
+# Takes List of Strings with error messages in the form ERROR:code:name:text as argument
+def combine_errors(errors):
+    combined = {}
+    for error in errors:
+        command, code, name, text = error.split(':', 3)
+        combined.setdefault((code, text), []).append(name)
+    return b''.join(framing.encode_frame('ERROR:{}:{}:{}'.format(code, ','.join(names), text))
+                    for (code, text), names in combined.items())
+
+# Add a message sent to a chat room to the room's history and to the message log
+# Called while holding the room's lock, so the history and the log keep the order the room's members received
+# Takes String and bytes or Tuple of bytes-like parts as arguments
+def record_room_message(room_name, frame):
+    if persistent_log is None:
+        room_history.record(room_name, frame)
+    else:
+        # Encode the message once for both the history and the log
+        data = framing.frame_bytes(frame)
+        room_history.record(room_name, data)
+        persistent_log.append_message(room_name, data)
+
+# Send a chat message from a user connected to another worker process or server to the members of a chat room
+# connected to this server, and add it to the room's history
+# Takes Room object and String as arguments
+def deliver_remote_room_message(room, msg):
+    frame = framing.encode_frame(msg)
+    with room.lock:
+        recipients = [member for member in room.members.values() if not member.remote]
+        record_room_message(room.room_name, frame)
+    broadcast_frame(recipients, frame)
+
+# Send a chat message to every member of a chat room
+# When the server runs as a cluster, members connected to other worker processes are reached
+# with a single message to the cluster bus instead of one message for each member
+# Takes String, an iterable of Connection objects, and bytes or Tuple of bytes-like parts as arguments
+def broadcast_room_message(room_name, recipients, frame):
+    metrics.broadcast_recipients.observe(len(recipients))
+    if cluster is None:
+        broadcast_frame(recipients, frame)
+    else:
+        broadcast_frame([recipient for recipient in recipients if not recipient.remote], frame)
+        cluster.room_message(room_name, framing.frame_bytes(frame)[:-len(framing.DELIMITER)].decode())
+
+# Encode one page of a ROOMS_RESPONSE or USERS_RESPONSE listing
+# Room and user names cannot contain colons, so the number of the next page follows the names after a colon
+# Returns bytes
+# Takes String, List of Strings, and Integer or None as arguments
+def encode_listing(header, names, next_page=None):
+    # An empty listing contains a single space, as the protocol does not allow empty fields
+    text = ' '.join(names) if names else ' '
+    if next_page is not None:
+        text = '{}:{}'.format(text, next_page)
+    return framing.encode_frame(header + text)
+
+# Encode a listing of names as one message for each page of LISTING_PAGE_SIZE names
+# Returns List of bytes, which holds one empty listing if there are no names
+# Takes String and List of Strings as arguments
+def listing_pages(header, names):
+    pages = []
+    for start in range(0, len(names), LISTING_PAGE_SIZE):
+        end = start + LISTING_PAGE_SIZE
+        next_page = end // LISTING_PAGE_SIZE + 1 if end < len(names) else None
+        pages.append(encode_listing(header, names[start:end], next_page))
+    return pages or [encode_listing(header, ())]
+
+# Find the page of a listing requested by a ROOMS or USERS message, where pages are numbered from 1
+# Returns Integer index of the page, or None if the page number is not valid
+# Takes String as argument
+def page_index(page):
+    if not page:
+        return 0
+    if not page.isascii() or not page.isdigit() or int(page) < 1:
+        return None
+    return int(page) - 1
+
+# Parses an encoded message received from a client
+# Returns the typed message, or String with error message if the message violates a rule
+# Takes bytes as argument
+def parse_message(frame):
+    metrics.received_bytes.inc(len(frame) + 1)
+    return protocol.parse_server_message(frame)
 
-# Function creates new chat room or adds user to existing chat room based on the room name received from the client
+# Function creates new chat rooms or adds user to existing chat rooms based on the room names received from the client
 # Called in response to receiving JOIN message from a client
-# Takes client dictionary and List of Strings as argument
+# Takes Connection object and Join message as arguments
 def join_msg_handler(client, message):
-    room_name = message[-1]
-    # Validate that room name is correctly formatted
-    param_check = utilities.validate_param_semantics(room_name)
-    if param_check != True:
-        send_message(client['socket'], param_check)
-        return
-
-    # If room is already in list of chat rooms, add user to the existing room
-    create_room = True
-    for room in chat_rooms:
-        if room['room_name'] == room_name:
-            # Verify user is not already in room, so duplicate user_names aren't added to members list
-            if client['user_name'] not in room['members']:
-                room['members'].append(client['user_name'])
-            create_room = False
-            break
+    room_names = message.room_names
+    # A room named more than once is only joined once
+    if len(room_names) > 1:
+        room_names = tuple(dict.fromkeys(room_names))
 
-    # If room is not already in list of rooms, create new room
-    if create_room:
-        new_room = {
-            'room_name': room_name,
-            'members': [client['user_name']]
-        }
-        chat_rooms.append(new_room)
+    # If room is already in list of chat rooms, add user to the existing room,
+    # otherwise create a new room with the user as its first member
+    recent = []
+    for room_name in room_names:
+        recent += add_room_member(room_name, client, history.REPLAY_LENGTH)
 
-    # Send confirmation message to client
-    msg = 'JOIN_RESPONSE:{}'.format(room_name)
-    send_message(client['socket'], msg)
+    # Send one confirmation message listing every room to client, followed by the recent messages of each room
+    # in the same write
+    msg = 'JOIN_RESPONSE:{}'.format(','.join(room_names))
+    if recent:
+        client.socket.send(b''.join([framing.encode_frame(msg)] + recent))
+    else:
+        send_message(client.socket, msg)
 
 # Function sends list of chat rooms to requesting user
 # Called in response to receiving ROOMS message from a client
-# Takes client dictionary as argument
-def rooms_msg_handler(client):
-    # Sends empty ROOMS_RESPONSE message to client if no chat rooms have been created
-    if not chat_rooms:
-        msg = 'ROOMS_RESPONSE: '
-        send_message(client['socket'], msg)
-    else:
-        rooms = []
-        for room in chat_rooms:
-            rooms.append(room['room_name'])
-        rooms = ' '.join(rooms)
-        msg = 'ROOMS_RESPONSE:{}'.format(rooms)
-        send_message(client['socket'], msg)
+# Listings longer than LISTING_PAGE_SIZE are sent one page at a time, and only rooms whose names start with the
+# message's prefix are listed when it has one
+# Takes Connection object and Rooms message as arguments
+def rooms_msg_handler(client, message):
+    global rooms_pages
+    index = page_index(message.page)
+    if index is None:
+        send_message(client.socket, PAGE_ERROR)
+        return
+
+    header = 'ROOMS_RESPONSE:'
+    if message.prefix:
+        client.socket.send(prefix_rooms_page(header, message.prefix, index))
+        return
+
+    # Listing of every room is encoded once and reused until another room is created
+    pages = rooms_pages
+    if pages is None:
+        with registry_lock:
+            if rooms_pages is None:
+                rooms_pages = listing_pages(header, list(chat_rooms))
+            pages = rooms_pages
+    # Sends empty ROOMS_RESPONSE message to client if there are no chat rooms on the requested page
+    client.socket.send(pages[index] if index < len(pages) else encode_listing(header, ()))
+
+# Encode one page of the rooms whose names start with a prefix, in sorted order
+# The matching names are next to each other in the sorted names, so only the requested page is read
+# Returns bytes
+# Takes String, String, and Integer as arguments
+def prefix_rooms_page(header, prefix, index):
+    with registry_lock:
+        start = bisect.bisect_left(sorted_room_names, prefix) + index * LISTING_PAGE_SIZE
+        # One extra name is read to find out whether another page follows
+        names = sorted_room_names[start:start + LISTING_PAGE_SIZE + 1]
+    names = [name for name in names if name.startswith(prefix)]
+    if len(names) > LISTING_PAGE_SIZE:
+        return encode_listing(header, names[:LISTING_PAGE_SIZE], index + 2)
+    return encode_listing(header, names)
 
 # Function sends member list of a chat room to requesting user
 # Called in response to receiving USERS message from a client
-# Takes client dictionary and List of Strings as argument
+# Listings longer than LISTING_PAGE_SIZE are sent one page at a time
+# Takes Connection object and Users message as arguments
 def users_msg_handler(client, message):
-    room_name = message[-1]
-    # Validate that room name is correctly formatted
-    param_check = utilities.validate_param_semantics(room_name)
-    if param_check != True:
-        send_message(client['socket'], param_check)
+    room_name = message.room_name
+    index = page_index(message.page)
+    if index is None:
+        send_message(client.socket, PAGE_ERROR)
         return
 
-    # Sends error message to client if no chat rooms have been created
-    if not chat_rooms:
+    room = find_chat_room(room_name)
+    # Sends error message to client if requested room has not been created
+    if room is None:
         msg = 'ERROR:107:{}:This chat room does not exist'.format(room_name)
-        send_message(client['socket'], msg)
-    else:
-        room_index = find_chat_room(room_name)
+        send_message(client.socket, msg)
+        return
 
-        if room_index > -1:
-            # Sends empty USERS_RESPONSE message to client if requested chat room doesn't have any members
-            if not chat_rooms[room_index]['members']:
-                msg = 'USERS_RESPONSE:{}: '.format(room_name)
-                send_message(client['socket'], msg)
-            else:
-                members = []
-                for member in chat_rooms[room_index]['members']:
-                    members.append(member)
-                members = ' '.join(members)
-                msg = 'USERS_RESPONSE:{}:{}'.format(room_name, members)
-                send_message(client['socket'], msg)
-        # Sends error message to client if requested room has not been created
-        else:
-            msg = 'ERROR:107:{}:This chat room does not exist'.format(room_name)
-            send_message(client['socket'], msg)
+    header = 'USERS_RESPONSE:{}:'.format(room_name)
+    # Listing of the room's members is encoded once and reused until a user joins or leaves the room
+    with room.lock:
+        pages = room.users_pages
+        if pages is None:
+            pages = room.users_pages = listing_pages(header, list(room.members))
+    # Sends empty USERS_RESPONSE message to client if the room has no members on the requested page
+    client.socket.send(pages[index] if index < len(pages) else encode_listing(header, ()))
 
-# Function removes requesting user from chat room
+# Function removes requesting user from chat rooms
 # Called in response to receiving LEAVE message from a client
-# Takes client dictionary and List of Strings as argument
+# Takes Connection object and Leave message as arguments
 def leave_msg_handler(client, message):
-    room_name = message[-1]
-    # Validate that room name is correctly formatted
-    param_check = utilities.validate_param_semantics(room_name)
-    if param_check != True:
-        send_message(client['socket'], param_check)
-        return
+    room_names = message.room_names
+    if len(room_names) > 1:
+        room_names = tuple(dict.fromkeys(room_names))
 
-    # Send confirmation message to client even if chat rooms list is empty
-    if not chat_rooms:
-        msg = 'LEAVE_RESPONSE:{}'.format(room_name)
-        send_message(client['socket'], msg)
-    else:
-        room_index = find_chat_room(room_name)
-        if room_index > -1:
-            if client['user_name'] in chat_rooms[room_index]['members']:
-                chat_rooms[room_index]['members'].remove(client['user_name'])
-        # Send confirmation message to client even if user wasn't a member of room prior to LEAVE request
-        # or if room doesn't exist in list of chat rooms
-        msg = 'LEAVE_RESPONSE:{}'.format(room_name)
-        send_message(client['socket'], msg)
+    # Rooms are only searched for if any chat rooms have been created
+    if chat_rooms:
+        for room_name in room_names:
+            room = find_chat_room(room_name)
+            if room is not None:
+                remove_room_member(room, client)
+    # Send one confirmation message listing every room to client, even if user wasn't a member of a room
+    # prior to LEAVE request or if a room doesn't exist in list of chat rooms
+    msg = 'LEAVE_RESPONSE:{}'.format(','.join(room_names))
+    send_message(client.socket, msg)
 
 # Function broadcasts message body received from a user to all members of a chat room
 # Called in response to receiving MESSAGE message from a client
-# Takes client dictionary and List of Strings as argument
+# Takes Connection object and ChatMessage message as arguments
 def chat_msg_handler(client, message):
-    room_name = message[1]
-    # Validate that room name is correctly formatted
-    param_check = utilities.validate_param_semantics(room_name)
-    if param_check != True:
-        send_message(client['socket'], param_check)
-        return
-
-    # Properly format a message body that contains colons
-    if len(message) > 3:
-        message_body = ':'.join(message[2:])
-    else:
-        message_body = message[2]
-    # Validate that message body is correctly formatted
-    payload_check = utilities.validate_payload_semantics(message_body)
-    if payload_check != True:
-        send_message(client['socket'], payload_check)
-        return
+    room_name = message.room_name
 
     # Sends error message to client if no chat rooms have been created
     if not chat_rooms:
         msg = 'ERROR:107:{}:This chat room does not exist'.format(room_name)
-        send_message(client['socket'], msg)
+        send_message(client.socket, msg)
     else:
-        room_index = find_chat_room(room_name)
-
-        if room_index > -1:
-            if client['user_name'] in chat_rooms[room_index]['members']:
-                # Finds the socket that corresponds to the user name of each member in the chat room
-                # and broadcasts message body to all members
-                for member in chat_rooms[room_index]['members']:
-                    for connection in clients:
-                        if connection['user_name'] == member:
-                            msg = 'MESSAGE:{}:{}:{}'.format(room_name, client['user_name'], message_body)
-                            send_message(connection['socket'], msg)
-                            break
+        room = find_chat_room(room_name)
+
+        if room is not None:
+            frame = relay_frame('MESSAGE:{}:{}:'.format(room_name, client.user_name), message.body)
+            with room.lock:
+                is_member = client.user_name in room.members
+                # Copy the member list so the message is sent without holding the room's lock
+                recipients = tuple(room.members.values())
+                if is_member:
+                    record_room_message(room_name, frame)
+
+            if is_member:
+                # Broadcasts message body to all members of the chat room
+                broadcast_room_message(room_name, recipients, frame)
             # Sends error message to client if they are not a member of the requested chat room
             else:
                 msg = 'ERROR:108:{}:User is not a member of this chat room'.format(room_name)
-                send_message(client['socket'], msg)
+                send_message(client.socket, msg)
         # Sends error message to client if requested chat room has not been created
         else:
             msg = 'ERROR:107:{}:This chat room does not exist'.format(room_name)
-            send_message(client['socket'], msg)
+            send_message(client.socket, msg)
 
-# Function forwards messages body to a user directly from another user
+# Function forwards messages body to users directly from another user
 # Called in response to receiving MESSAGE_USER message from a client
-# Takes client dictionary and List of Strings as argument
+# Each recipient receives a MESSAGE_USER message naming only themselves, while the sender receives one
+# confirmation naming every user the message was delivered to or kept for, and one error message for each kind
+# of error naming the users the message could not be sent to
+# Takes Connection object and PrivateMessage message as arguments
 def private_msg_handler(client, message):
-    target_user = message[1]
-    # Validate that target username is correctly formatted
-    param_check = utilities.validate_param_semantics(target_user)
-    if param_check != True:
-        send_message(client['socket'], param_check)
-        return
+    user_names = message.user_names
+    # A user named more than once only receives the message once
+    if len(user_names) > 1:
+        user_names = tuple(dict.fromkeys(user_names))
+    sender = client.user_name
+    body = message.body
+
+    confirmed = []
+    stored = []
+    errors = []
+    for target_user in user_names:
+        frame = relay_frame('MESSAGE_USER:{}:{}:'.format(target_user, sender), body)
+        recipient = find_client(target_user)
+        if recipient is not None:
+            # Sends message to recipient user name requested by client sender
+            # If user sent a message to themselves, then the confirmation serves as their copy
+            # and a duplicate MESSAGE_USER message is not needed
+            if target_user != sender:
+                recipient.socket.send(frame)
+        else:
+            # Keeps the message if the recipient has disconnected, so the confirmation tells the sender it will be
+            # delivered when the recipient reconnects
+            # Sends error message to client if requested recipient user name has never been connected to the server,
+            # or if too many messages are already waiting for the recipient
+            store_check = offline_messages.store(target_user, frame)
+            if store_check != True:
+                errors.append(store_check)
+                continue
+            stored.append(target_user)
+        if persistent_log is not None:
+            persistent_log.append_private(frame)
+        confirmed.append(target_user)
+
+    # Sends the MESSAGE_USER message to the sending user as confirmation, which is the message the recipient
+    # received when there is only one recipient
+    if confirmed:
+        if len(user_names) > 1:
+            frame = relay_frame('MESSAGE_USER:{}:{}:'.format(','.join(confirmed), sender), body)
+        client.socket.send(frame)
+    if errors:
+        client.socket.send(combine_errors(errors))
+
+    # Deliver the message now if a recipient reconnected while it was being stored
+    for target_user in stored:
+        recipient = find_client(target_user)
+        if recipient is not None:
+            deliver_offline_messages(recipient)
+
+# Function records that a client's connection is still alive
+# Called in response to receiving STILL_ALIVE message from a client
+# Takes Connection object and StillAlive message as arguments
+def still_alive_msg_handler(client, message):
+    client.timestamp = time.monotonic()
+
+# Function confirms that a client is leaving and closes its connection
+# Called in response to receiving QUIT message from a client
+# Returns False so no more messages are read from the connection
+# Takes Connection object and Quit message as arguments
+def quit_msg_handler(client, message):
+    msg = 'QUIT'
+    send_message(client.socket, msg)
+    close_connection(client)
+    return False
+
+# Function displays error messages received from a client
+# Called in response to receiving ERROR message from a client
+# Takes Connection object and Error message as arguments
+def error_msg_handler(client, message):
+    print('{} Error: {}'.format(message.code, message.text))
+
+# Verify that the NAME message sent by a new client can be used to register the client with the server
+# Returns True if the user name is valid and not already in use
+# Returns String with error message if the message cannot be used to register the client
+# Takes the message parsed by parse_message() as argument
+def validate_name_message(message):
+    # Validate that the message is correctly formatted
+    if isinstance(message, str):
+        metrics.invalid_messages.inc()
+        return message
+    # Validate that correct NAME command was sent
+    elif type(message) is not protocol.Name:
+        return 'ERROR:106:Client not registered with server'
+    # Validate that user name can be named in a list of users
+    elif ',' in message.user_name:
+        return 'ERROR:115:Username contains commas'
+    # Validate that user name is unique
+    elif find_client(message.user_name) is not None:
+        return 'ERROR:105:Username already in use'
+    return True
 
-    # Properly format a message body that contains colons
-    if len(message) > 3:
-        message_body = ':'.join(message[2:])
+# Add a Connection object to the list of connected clients
+# Returns False if another client has already registered the same user name
+# Takes Connection object as argument
+def add_client(client):
+    with registry_lock:
+        if client.user_name in clients:
+            return False
+        clients[client.user_name] = client
+    return True
+
+# Create the Connection object for a newly registered user and add it to the list of connected clients
+# Messages to a user who asked for compression in their NAME message are compressed from the COMPRESSION message
+# on, which is sent before any message sent to the user once they are registered
+# Returns Connection object
+# Returns None if another client registered the same user name after it was validated
+# Takes send queue object, String, and String with the compression algorithm the user asked for as arguments
+def register_client(connection, chat_name, compression=''):
+    client = Connection(connection, chat_name)
+    # Add new socket to list of connected clients
+    if not add_client(client):
+        return None
+    if stream_compression.accepted(compression):
+        connection.begin_compression(stream_compression.COMPRESSION_FRAME)
+    print('New User: {}'.format(client.user_name))
+    metrics.registrations.inc()
+
+    # Send STILL_ALIVE messages to client and monitor if connection with client is being maintained
+    keep_alive.add(client)
+    deliver_offline_messages(client)
+    return client
+
+# Send a reconnected user the messages that were kept while they were disconnected
+# Messages for a user connected to this server are sent with one write, while messages for a user connected
+# to another worker process or server are forwarded one at a time
+# Takes Connection object as argument
+def deliver_offline_messages(client):
+    frames = offline_messages.take(client.user_name)
+    if not frames:
+        return
+    if client.remote:
+        for frame in frames:
+            client.socket.send(frame)
     else:
-        message_body = message[2]
-        # Validate that message body is correctly formatted
-        payload_check = utilities.validate_payload_semantics(message_body)
-        if payload_check != True:
-            send_message(client['socket'], payload_check)
-            return
+        client.socket.send(b''.join(frames))
 
-    client_index = find_client(target_user)
-    if client_index > -1:
-        # Sends message to recipient user name requested by client sender
-        msg = 'MESSAGE_USER:{}:{}:{}'.format(target_user, client['user_name'], message_body)
-        send_message(clients[client_index]['socket'], msg)
-        # Send confirmation MESSAGE_USER message to sending user
-        # If user sent a message to themselves, then the initial MESSAGE_USER response will serve as confirmation
-        # and a duplicate MESSAGE_USER confirmation is not needed
-        if client['user_name'] != clients[client_index]['user_name']:
-            msg = 'MESSAGE_USER:{}:{}:{}'.format(target_user, client['user_name'], message_body)
-            send_message(client['socket'], msg)
-    # Sends error message to client if requested recipient user name is not connected to the server
+# Message handler for each type of message a registered client may send
+MESSAGE_HANDLERS = {
+    protocol.StillAlive: still_alive_msg_handler,
+    protocol.Join: join_msg_handler,
+    protocol.Rooms: rooms_msg_handler,
+    protocol.Users: users_msg_handler,
+    protocol.Leave: leave_msg_handler,
+    protocol.ChatMessage: chat_msg_handler,
+    protocol.PrivateMessage: private_msg_handler,
+    protocol.Quit: quit_msg_handler,
+    protocol.Error: error_msg_handler
+}
+
+# Function calls the message handler that corresponds to the type of a message received from a client
+# Returns False once the client has quit and no more messages should be read from the connection
+# Returns True otherwise
+# Takes Connection object and the message parsed by parse_message() as arguments
+def dispatch_message(client, message):
+    message_type = type(message)
+    limiter = client.limiter
+    if limiter is not None and not limiter.allow(message_type):
+        if refuse_message(client.socket, limiter):
+            return True
+        close_connection(client)
+        return False
+
+    handler = MESSAGE_HANDLERS.get(message_type)
+    if handler is not None:
+        start = time.perf_counter_ns()
+        result = handler(client, message)
+        metrics.handler_latency[message_type].observe(time.perf_counter_ns() - start)
+        return result is not False
+
+    metrics.invalid_messages.inc()
+    # Alerts client if message violates a rule of the protocol
+    if isinstance(message, str):
+        send_message(client.socket, message)
+    # Alerts client if a command that is only valid before registering is received
     else:
-        msg = 'ERROR:109:{}:This user does not exist'.format(target_user)
-        send_message(client['socket'], msg)
+        msg = 'ERROR:100:Command is not included in the list of approved commands'
+        send_message(client.socket, msg)
+    return True
+
+# Tell a client that a message was refused for exceeding its rate limits
+# Returns False if the client has been refused too often and its connection should be closed
+# Takes socket object and Rate Limiter object as arguments
+def refuse_message(connection, limiter):
+    metrics.rate_limited.inc()
+    if limiter.strike():
+        send_message(connection, ratelimit.RATE_LIMIT_ERROR)
+        return True
+    send_message(connection, ratelimit.ABUSE_ERROR)
+    metrics.rate_limit_disconnects.inc()
+    print('Connection closed for exceeding rate limits')
+    return False
+
+# Finish the TLS handshake of an encrypted connection before any message is read from or written to it
+# The handshake is finished before the connection's writer thread starts, so only one thread ever drives it
+# Returns False if the handshake failed and the connection has been closed
+# Takes ssl.SSLSocket object as argument
+def finish_handshake(connection):
+    try:
+        connection.settimeout(tls.HANDSHAKE_TIMEOUT)
+        connection.do_handshake()
+        connection.settimeout(None)
+    except OSError as E:
+        print('Unexpected Error: TLS handshake failed')
+        print(E)
+        connection.close()
+        return False
+    record_handshake(connection)
+    return True
+
+# Count a finished TLS handshake, and whether the client resumed the session of an earlier connection
+# Takes ssl.SSLSocket or ssl.SSLObject as argument
+def record_handshake(ssl_object):
+    metrics.tls_handshakes.inc()
+    if ssl_object.session_reused:
+        metrics.tls_resumed_handshakes.inc()
+
+# Function runs on a thread for each client TCP connection until the connection closes or is handed over
+# A connection handed over by the server this process took over from is passed with a Tuple of
+# (Send Queue object, Connection object or None, bytes unread) from adopt_connections(),
+# and continues where the old server stopped
+# A new connection to a server that serves clients over TLS is passed with the server's ssl.SSLContext,
+# and is wrapped on its own thread, so a slow client does not hold up the others
+# Takes socket object, Tuple, and ssl.SSLContext as arguments
+def message_handler(connection, handed_over=None, context=None):
+    if context is not None:
+        # The handshake is written in several small pieces, which would otherwise wait for the client's delayed ACK
+        connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            connection = context.wrap_socket(connection, server_side = True, do_handshake_on_connect = False)
+        except OSError as E:
+            print('Unexpected Error: Connection has closed')
+            print(E)
+            connection.close()
+            return
+    open_connections.add(connection)
+    try:
+        serve_connection(connection, handed_over)
+    finally:
+        open_connections.discard(connection)
 
 # Function listens for messages from a client
 # and calls the message handler that corresponds to the command portion of the message
-def message_handler(connection):
+# Takes socket object and Tuple as arguments
+def serve_connection(connection, handed_over):
+    encrypted = tls.encrypted(connection)
+    if encrypted and not finish_handshake(connection):
+        return
+    # Messages to the client are queued and written by the send queue's writer thread,
+    # so handlers sending to a slow client do not wait for it
+    if handed_over is None:
+        outbound = send_queue.SendQueue(connection).start()
+        client = None
+    else:
+        outbound, client, unread = handed_over
+    # Waits for either the client or the start of a drain, when the server can hand its connections over
+    poller = None
+    if drain_wakeup is not None:
+        poller = select.poll()
+        poller.register(connection, select.POLLIN)
+        poller.register(drain_wakeup[0], select.POLLIN)
+
     try:
+        # Buffers bytes received from the client until complete messages have arrived
+        reader = framing.FrameReader(connection)
+        # Limits NAME attempts, since the client's own limits only start once it has registered
+        limiter = ratelimit.new_limiter()
+
+        if handed_over is not None:
+            reader.feed(unread)
+
         # Server must receive user name from client as to finish initializing connection
-        name_message, command = receive_message(connection)
-        chat_name = name_message[-1]
-
-        # Error check client-selected user name before adding client to list of connected clients
-        setting_user_name = True
-        while setting_user_name:
-            command_check = utilities.validate_command_semantics(command)
-            param_check = utilities.validate_param_semantics(chat_name)
-            # Validate that command portion of message is correctly formatted
-            if command_check != True:
-                send_message(connection, command_check)
-                name_message, command = receive_message(connection)
-                chat_name = name_message[-1]
-            # Validate that user name is correctly formatted
-            elif param_check != True:
-                send_message(connection, param_check)
-                name_message, command = receive_message(connection)
-                chat_name = name_message[-1]
-            # Validate that correct NAME command was sent
-            elif command != 'NAME':
-                msg = 'ERROR:106:Client not registered with server'
-                send_message(connection, msg)
-                name_message, command = receive_message(connection)
-                chat_name = name_message[-1]
-            # Validate that user name is unique
-            elif find_client(chat_name) != -1:
-                msg = 'ERROR:105:Username already in use'
-                send_message(connection, msg)
-                name_message, command = receive_message(connection)
-                chat_name = name_message[-1]
-            else:
-                setting_user_name = False
+        while client is None:
+            frame = next_frame(reader, poller)
+            if frame is None:
+                paused_connections.append((connection, outbound, None, reader.unread_bytes()))
+                return
+            name_message = parse_message(frame)
+            if limiter is not None and not limiter.allow(type(name_message)):
+                if refuse_message(outbound, limiter):
+                    continue
+                outbound.close()
+                return
+
+            # Error check client-selected user name before adding client to list of connected clients
+            name_check = validate_name_message(name_message)
+            if name_check == True:
+                compression = tls.allowed_compression(name_message.compression, encrypted)
+                client = register_client(outbound, name_message.user_name, compression)
+                if client is None:
+                    name_check = 'ERROR:105:Username already in use'
+            if client is None:
+                send_message(outbound, name_check)
 
     # End program if unexpected error occurs
     except Exception as E:
         print('Unexpected Error: Connection has closed')
         print(E)
-        connection.close()
+        outbound.close()
         return
 
-    # Client dictionary
-    client = {
-        'user_name': chat_name,
-        'socket': connection,
-        'timestamp': datetime.now(),
-        'alive': True
-    }
-    # Add new socket to list of connected clients
-    clients.append(client)
-    print('New User: {}'.format(client['user_name']))
-
-    # Launch thread to send STILL_ALIVE messages to client
-    thread = threading.Thread(target=send_keep_alive, args=(client,))
-    thread.start()
-
-    # Launch thread to monitor if connection with client is being maintained
-    sending_thread = threading.Thread(target=verify_keep_alive, args=(client,))
-    sending_thread.start()
-
     # After connection has finished initializing, listen for messages from the client
     while True:
         try:
-            message, command = receive_message(client['socket'])
-
-            # Validate that command is correctly formatted
-            command_check = utilities.validate_command_semantics(command)
-            if command_check != True:
-                send_message(client['socket'], command_check)
-                continue
-
-            # Identify corresponding action for command portion of client message
-            match command:
-                case 'STILL_ALIVE':
-                    client['timestamp'] = datetime.now()
-                case 'JOIN':
-                    join_msg_handler(client, message)
-                case 'ROOMS':
-                    rooms_msg_handler(client)
-                case 'USERS':
-                    users_msg_handler(client, message)
-                case 'LEAVE':
-                    leave_msg_handler(client, message)
-                case 'MESSAGE':
-                    chat_msg_handler(client, message)
-                case 'MESSAGE_USER':
-                    private_msg_handler(client, message)
-                case 'QUIT':
-                    msg = 'QUIT'
-                    send_message(client['socket'], msg)
-                    close_connection(client)
-                    break
-                # Displays error messages received from client
-                case 'ERROR':
-                    error_code = message[1]
-                    error_msg = message[-1]
-                    print('{} Error: {}'.format(error_code, error_msg))
-                # Alerts client if unrecognized command is received
-                case _:
-                    msg = 'ERROR:100:Command is not included in the list of approved commands'
-                    send_message(client['socket'], msg)
+            frame = next_frame(reader, poller)
+            # Messages received while draining are handled by the new server process
+            if frame is None:
+                paused_connections.append((connection, outbound, client, reader.unread_bytes()))
+                break
+            if not dispatch_message(client, parse_message(frame)):
+                break
 
         # End program if unexpected error occurs
         except Exception as E:
@@ -465,23 +861,477 @@ def message_handler(connection):
             close_connection(client)
             break
 
+# Returns the next message received from a client as bytes, or None once the server has started draining,
+# so the rest of the client's messages are read by the new server process
+# Takes FrameReader object, and select.poll object or None if the server cannot hand connections over, as arguments
+def next_frame(reader, poller):
+    if poller is None:
+        return reader.read_frame()
+    while not reader.frames:
+        # Bytes a TLS connection has already received and decrypted are not seen by poll()
+        if not (tls.encrypted(reader.sock) and reader.sock.pending()):
+            poller.poll()
+        if draining:
+            return None
+        reader.receive()
+    return reader.frames.popleft()
+
 # ==============================================================================================
-#                                       Server Program
+#                                       Restart Handoff
 # ==============================================================================================
 
-try:
-    while True:
-        # Listen for TCP connection requests from clients
-        connection, address = server.accept()
-        print('Connected with {}'.format(str(address)))
-
-        # Launch a thread for each client TCP connection
-        thread = threading.Thread(target=message_handler, args=(connection,))
-        thread.start()
-
-# End program if unexpected error occurs
-except Exception as E:
-    print('Unexpected Error: All connections have closed')
-    print(E)
+# Create the pipe that wakes every handler thread when a drain starts, replacing the pipe of an earlier drain
+def open_drain_wakeup():
+    global draining, drain_wakeup
+    if drain_wakeup is not None and not draining:
+        return
+    if drain_wakeup is not None:
+        for fd in drain_wakeup:
+            os.close(fd)
+    drain_wakeup = os.pipe()
+    draining = False
+    paused_connections.clear()
+
+# Send the chat rooms, and their recent messages when there is no message log for the new server to recover,
+# to the new server process taking over from this one
+# Takes socket object as argument
+def send_chat_state(link):
+    with registry_lock:
+        room_names = list(chat_rooms)
+    for room_name in room_names:
+        handoff.send_room(link, room_name)
+        if persistent_log is None:
+            for frame in room_history.recent(room_name, history.HISTORY_LENGTH):
+                handoff.send_history(link, room_name, frame)
+
+# Remove a client that is being handed over from the server state without telling anyone it has left,
+# since the user stays connected through the new server process
+# Returns List of the names of the chat rooms the user is a member of
+# Takes Connection object as argument
+def release_client(client):
+    with client.lock:
+        client.alive = False
+        room_names = list(client.rooms)
+        with registry_lock:
+            if clients.get(client.user_name) is client:
+                del clients[client.user_name]
+        for room_name in room_names:
+            discard_member(chat_rooms[room_name], client)
+        client.rooms.clear()
+    return room_names
+
+# Hand a paused connection of the threaded server over to the new server process
+# Messages already queued for the client are written first, and this process's copy of the socket is closed
+# without ending the connection, which the new server now holds
+# An encrypted connection's TLS session is held by this process and cannot be handed over, so the connection
+# is closed and the client reconnects to the new server
+# Returns True if the connection was handed over
+# Takes socket object connected to the new server, socket object, Send Queue object, Connection object or None,
+# bytes, and Float number of seconds left to write the queued messages as arguments
+def hand_over_connection(link, connection, outbound, client, unread, timeout):
+    # Messages that could not be written before the drain timed out would be cut off, so the connection is closed
+    if tls.encrypted(connection) or not outbound.release(timeout):
+        if client is not None:
+            close_connection(client)
+        connection.close()
+        return False
+    user_name = ''
+    room_names = []
+    if client is not None:
+        user_name = client.user_name
+        room_names = release_client(client)
+    compression = stream_compression.ALGORITHM if outbound.compressor is not None else ''
+    handoff.send_client(link, connection, user_name, room_names, unread, compression)
+    connection.close()
+    return True
+
+# Hand every connection of the threaded server over to the new server process that connected to the handoff socket
+# Reading stops on every connection at once, and each connection is handed over once the messages queued for it
+# have been written, so no message is handled by both servers or lost between them
+# Connections whose handler threads do not stop within DRAIN_TIMEOUT are closed
+# Takes socket object connected to the new server, listening socket object, and metrics endpoint as arguments
+def drain_connections(link, listener, endpoint):
+    global draining
+    print('Handing connections over to a new server process...')
+    started = time.perf_counter()
+    draining = True
+    os.write(drain_wakeup[1], b'\0')
+    deadline = time.monotonic() + handoff.DRAIN_TIMEOUT
+    while open_connections and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    # Every handler thread has stopped, so the chat rooms no longer change
+    paused = list(paused_connections)
+    paused_connections.clear()
+    while time.monotonic() < deadline and any(outbound.depth() for _, outbound, _, _ in paused):
+        time.sleep(0.01)
+    send_chat_state(link)
+    handed_over = 0
+    for connection, outbound, client, unread in paused:
+        # A queue that is already empty is still given a moment for its writer thread to stop
+        timeout = max(deadline - time.monotonic(), 0.1)
+        handed_over += hand_over_connection(link, connection, outbound, client, unread, timeout)
+    # Handler threads that never stopped are left with the only connections still registered
+    stuck = len(open_connections)
+    close_open_connections()
+
+    finish_handoff(link, listener, endpoint)
+    print('Handed {} connections over in {:.3f} seconds, closed {} connections'.format(
+        handed_over, time.perf_counter() - started, len(paused) - handed_over + stuck))
+
+# Close every connection of the threaded server
+# Registered clients are sent QUIT as close_all_connections() does, and connections that never registered have
+# no send queue to close, so their sockets are shut down directly, which wakes their handler threads
+def close_open_connections():
+    with registry_lock:
+        registered = {client.socket.sock for client in clients.values() if not client.remote}
     close_all_connections()
-    server.close()
+    for connection in list(open_connections):
+        if connection not in registered:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+# Write the message log so the new server process can recover it, free the metrics port for the new server,
+# and send the listening socket, which ends the handoff
+# Takes socket object connected to the new server, listening socket object, and metrics endpoint as arguments
+def finish_handoff(link, listener, endpoint):
+    close_message_log()
+    if endpoint is not None:
+        endpoint.shutdown()
+        endpoint.server_close()
+    handoff.send_listener(link, listener)
+    link.close()
+
+# Take over the chat rooms, connections, and listening socket of the server listening on the handoff socket
+# Returns Tuple of (listening socket object, List of handed over connections as returned by handoff.receive_state()),
+# or None if the handoff failed and this server should start without the old server's connections
+# Takes socket object connected to the old server as argument
+def take_over(link):
+    print('Taking over from the running server...')
+    started = time.perf_counter()
+    try:
+        listener, room_names, messages, connections = handoff.receive_state(link)
+    except (OSError, ValueError) as E:
+        print('Unexpected Error: Server could not be taken over')
+        print(E)
+        return None
+    for room_name in room_names:
+        create_chat_room(room_name)
+    for room_name, frame in messages:
+        room_history.record(room_name, frame)
+    print('Took over {} chat rooms and {} connections in {:.3f} seconds'.format(
+        len(room_names), len(connections), time.perf_counter() - started))
+    return listener, connections
+
+# Register every user handed over by the server this process took over from, and return them to their chat rooms,
+# before any of their messages are read, so a message sent during the handoff reaches every member of its room
+# Returns List of Tuples of (socket object, Send Queue object, Connection object or None, bytes unread)
+# Takes List of handed over connections as returned by handoff.receive_state() as argument
+def adopt_connections(connections):
+    adopted = []
+    for connection, user_name, room_names, unread, compression in connections:
+        connection.setblocking(True)
+        outbound = send_queue.SendQueue(connection).start()
+        client = None
+        if user_name:
+            client = adopt_client(outbound, user_name, room_names, compression)
+            if client is None:
+                send_message(outbound, 'ERROR:105:Username already in use')
+        adopted.append((connection, outbound, client, unread))
+    return adopted
+
+# Register a user handed over by the server this process took over from, and return them to their chat rooms
+# No JOIN_RESPONSE or recent messages are sent, since to the user the connection never changed servers
+# A compressed connection starts a new compressed stream, which also holds the error sent if the user cannot be adopted
+# Returns Connection object, or None if a new client registered the same user name first
+# Takes send queue object, String, List of Strings, and String as arguments
+def adopt_client(connection, user_name, room_names, compression=''):
+    if compression:
+        connection.begin_compression()
+    client = Connection(connection, user_name)
+    if not add_client(client):
+        return None
+    keep_alive.add(client)
+    for room_name in room_names:
+        add_room_member(room_name, client)
+    return client
+
+# ==============================================================================================
+#                                        Message Log
+# ==============================================================================================
+
+# Rebuild the chat rooms and their recent messages from a message log, then log every new room and message to it
+# Returns MessageLog object
+# Takes String as argument
+def open_message_log(directory):
+    global persistent_log
+    started = time.perf_counter()
+    log = message_log.MessageLog(directory)
+    room_names, messages = log.recover()
+    for room_name in room_names:
+        create_chat_room(room_name)
+    for room_name, frame in messages:
+        room_history.record(room_name, frame)
+    print('Recovered {} chat rooms and {} messages from {} in {:.3f} seconds'.format(
+        len(room_names), len(messages), directory, time.perf_counter() - started))
+
+    persistent_log = log.start()
+    return log
+
+# Write every message waiting to be logged before the server stops
+def close_message_log():
+    global persistent_log
+    if persistent_log is not None:
+        persistent_log.close()
+        persistent_log = None
+
+# ==============================================================================================
+#                                       Metrics Gauges
+# ==============================================================================================
+
+# Returns List of the send queues of users connected to this server, not to another worker or server
+def local_send_queues():
+    with registry_lock:
+        return [client.socket for client in clients.values() if not client.remote]
+
+# Returns Integer of users connected to this server
+def connected_user_count():
+    return len(local_send_queues())
+
+# Returns Integer of bytes waiting in every send queue
+def queued_byte_count():
+    return sum(queue.queued_bytes for queue in local_send_queues())
+
+# Returns Integer of bytes waiting in the fullest send queue
+def largest_queue_bytes():
+    return max((queue.queued_bytes for queue in local_send_queues()), default=0)
+
+metrics.add_gauge('irc_connected_users', 'Users connected to this server', connected_user_count)
+metrics.add_gauge('irc_chat_rooms', 'Chat rooms that have been created', lambda: len(chat_rooms))
+metrics.add_gauge('irc_send_queue_bytes', 'Bytes waiting in every send queue', queued_byte_count)
+metrics.add_gauge('irc_send_queue_max_bytes', 'Bytes waiting in the fullest send queue', largest_queue_bytes)
+metrics.add_gauge('irc_history_bytes', 'Memory used by the recent messages kept for chat rooms',
+                  lambda: room_history.total_bytes)
+metrics.add_gauge('irc_history_rooms', 'Chat rooms with recent messages kept', room_history.room_count)
+metrics.add_gauge('irc_offline_bytes', 'Memory used by messages kept for disconnected users',
+                  lambda: offline_messages.total_bytes)
+metrics.add_gauge('irc_offline_spilled_bytes', 'Bytes of messages for disconnected users spilled to disk',
+                  lambda: offline_messages.spilled_bytes)
+metrics.add_gauge('irc_offline_mailboxes', 'Disconnected users whose messages are kept',
+                  offline_messages.mailbox_count)
+
+# ==============================================================================================
+#                                       Server Program
+# ==============================================================================================
+
+# Thread running the keepalive scheduler, started by the first server of the process
+keep_alive_thread = None
+
+# Open a TCP socket listening for connection requests from clients
+# Returns socket object
+# Takes String, Integer, and Integer as arguments
+def listen(host, port, backlog):
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    # Allow the server to restart while connections from its previous run are still closing
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    try:
+        listener.bind((host, port))
+        listener.listen(backlog)
+    except OSError:
+        listener.close()
+        raise
+    return listener
+
+# Threaded IRC server that can be started by another program, such as a test or a benchmark
+# Creating a server binds no socket and starts no thread, so nothing happens until start() is called
+# Users and chat rooms are kept in this module's state, which is shared by every server started in one process,
+# so a process runs one server at a time, and the state is reset when the server closes
+class IRCServer:
+    __slots__ = ('host', 'port', 'backlog', 'metrics_port', 'log_directory', 'handoff_path', 'cert_file', 'key_file',
+                 'context', 'listener', 'handoff_listener', 'endpoint', 'wakeup')
+
+    # Port 0 listens on a free port chosen by the operating system, which address() returns once started
+    # Metrics and the message log are left out when passed None, and metrics are only served when given a port,
+    # so servers started by the same program do not compete for the metrics port
+    # The server only takes over from, and hands over to, another server on the handoff socket at the given path,
+    # so servers started by the same program do not take each other's clients
+    # Clients are served over TLS with the given certificate and key files, or over plain TCP when passed None
+    # Takes String, Integer, Integer, Integer or None, String or None, String or None, String or None,
+    # and String or None as arguments
+    def __init__(self, host=None, port=None, backlog=None, metrics_port=None,
+                 log_directory=message_log.LOG_DIRECTORY, handoff_path=None,
+                 cert_file=tls.CERT_FILE, key_file=tls.KEY_FILE):
+        self.host = HOST if host is None else host
+        self.port = PORT if port is None else port
+        self.backlog = BACKLOG if backlog is None else backlog
+        self.metrics_port = metrics_port
+        self.log_directory = log_directory
+        self.handoff_path = handoff_path
+        self.cert_file = cert_file
+        self.key_file = key_file
+        # ssl.SSLContext accepted connections are wrapped with once started, or None for plain TCP
+        self.context = None
+        self.listener = None
+        self.handoff_listener = None
+        self.endpoint = None
+        # Pair of connected sockets, written to by stop() to wake serve_forever()
+        self.wakeup = None
+
+    # Listen for clients, taking over the listening socket and connections of a server that is already running
+    # on the handoff socket if there is one
+    # Returns the server, so it can be created and started in one expression
+    def start(self):
+        global keep_alive_thread
+        if self.cert_file is not None:
+            self.context = tls.server_context(self.cert_file, self.key_file)
+        takeover = None
+        if self.handoff_path is not None:
+            link = handoff.request_takeover(self.handoff_path)
+            if link is not None:
+                takeover = take_over(link)
+            open_drain_wakeup()
+
+        if takeover is None:
+            self.listener = listen(self.host, self.port, self.backlog)
+            connections = []
+        else:
+            self.listener, connections = takeover
+            # Sockets of an asyncio server are non-blocking
+            self.listener.setblocking(True)
+        print('IRC Server is listening...')
+
+        if self.log_directory is not None:
+            open_message_log(self.log_directory)
+
+        # Launch a single thread to send and verify STILL_ALIVE messages for every client
+        if keep_alive_thread is None:
+            keep_alive_thread = keep_alive.start()
+        for connection, outbound, client, unread in adopt_connections(connections):
+            thread = threading.Thread(target=message_handler, args=(connection, (outbound, client, unread)))
+            thread.start()
+
+        if self.metrics_port is not None:
+            self.endpoint = metrics.start_endpoint(port = self.metrics_port)
+        # Listen for a new server process that takes over from this one
+        if self.handoff_path is not None:
+            self.handoff_listener = handoff.open_handoff(self.handoff_path)
+        self.wakeup = socket.socketpair()
+        return self
+
+    # Returns Tuple of (String, Integer) address the server is listening on
+    def address(self):
+        return self.listener.getsockname()
+
+    # Accept clients until stop() is called or a new server process takes over from this one
+    # Launches a thread for each client TCP connection
+    def serve_forever(self):
+        listeners = [self.listener, self.wakeup[0]]
+        if self.handoff_listener is not None:
+            listeners.append(self.handoff_listener)
+
+        try:
+            while True:
+                ready, _, _ = select.select(listeners, [], [])
+                if self.wakeup[0] in ready:
+                    break
+                if self.handoff_listener in ready and self.take_over_requested():
+                    break
+                if self.listener not in ready:
+                    continue
+
+                # Listen for TCP connection requests from clients
+                connection, address = self.listener.accept()
+                print('Connected with {}'.format(str(address)))
+                metrics.connections.inc()
+                thread = threading.Thread(target=message_handler, args=(connection, None, self.context))
+                thread.start()
+
+        # End program if unexpected error occurs
+        except Exception as E:
+            print('Unexpected Error: All connections have closed')
+            print(E)
+        self.close()
+
+    # Accept a connection to the handoff socket, and hand every connection over if it asks to take over
+    # Returns True once connections have been handed over, False if the connection did not ask to take over
+    def take_over_requested(self):
+        link, address = self.handoff_listener.accept()
+        if not handoff.trusted_peer(link) or link.recv(len(handoff.TAKEOVER)) != handoff.TAKEOVER:
+            link.close()
+            return False
+        self.handoff_listener.close()
+        self.handoff_listener = None
+        drain_connections(link, self.listener, self.endpoint)
+        self.endpoint = None
+        return True
+
+    # Wake serve_forever() so the server closes every connection and stops
+    # May be called from any thread
+    def stop(self):
+        self.wakeup[1].send(b'\0')
+
+    # Close every connection, release the sockets and ports held by the server, and forget its users and chat rooms
+    def close(self):
+        close_open_connections()
+        deadline = time.monotonic() + CLOSE_TIMEOUT
+        while open_connections and time.monotonic() < deadline:
+            time.sleep(0.01)
+        reset_server_state()
+        close_message_log()
+        if self.endpoint is not None:
+            self.endpoint.shutdown()
+            self.endpoint.server_close()
+            self.endpoint = None
+        if self.handoff_listener is not None:
+            self.handoff_listener.close()
+            self.handoff_listener = None
+        self.listener.close()
+        for sock in self.wakeup:
+            sock.close()
+
+# Returns ArgumentParser with the options shared by every server program
+# argparse is imported here rather than with this module, since it takes as long to import as the rest of the server
+# and programs that embed the server never need it
+# Takes String as argument
+def argument_parser(description):
+    import argparse
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--host', default=HOST, help='address to listen on for clients')
+    parser.add_argument('--port', type=int, default=PORT, help='port clients connect to')
+    parser.add_argument('--backlog', type=int, default=BACKLOG,
+                        help='connection requests queued before they are accepted')
+    parser.add_argument('--metrics-port', type=int, default=metrics.METRICS_PORT,
+                        help='local port serving metrics in the Prometheus text format')
+    parser.add_argument('--certfile', default=tls.CERT_FILE,
+                        help='PEM certificate chain to serve clients over TLS with, plain TCP if not given')
+    parser.add_argument('--keyfile', default=tls.KEY_FILE,
+                        help='PEM private key of the certificate, if it is not in the certificate file')
+    return parser
+
+# Run the threaded server with the options given on the command line
+# Takes List of Strings, or None to read the command line, as argument
+def main(argv=None):
+    parser = argument_parser('Run the threaded IRC server')
+    parser.add_argument('--handoff-path',
+                        help='Unix socket a new server process takes over from, or an empty string for none, '
+                             'defaults to a path for the user and port')
+    args = parser.parse_args(argv)
+    irc_server = IRCServer(args.host, args.port, args.backlog, args.metrics_port,
+                           handoff_path = handoff.command_line_path(args.handoff_path, args.port),
+                           cert_file = args.certfile, key_file = args.keyfile)
+    try:
+        irc_server.start()
+    except OSError as E:
+        print('Unexpected Error: Server could not start')
+        print(E)
+        return 1
+    try:
+        irc_server.serve_forever()
+    except KeyboardInterrupt:
+        irc_server.close()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,124 @@
+import zlib
+import framing
+import metrics
+
+# ==============================================================================================
+#                                   Compression Settings
+# ==============================================================================================
+
+# Compression a client may ask for by adding it to its NAME message, such as NAME:alice:zlib,
+# None to send every connection's messages uncompressed
+ALGORITHM = 'zlib'
+# zlib compression level from 1 (fastest) to 9 (smallest)
+LEVEL = 6
+# Size of the window of earlier bytes a compressed message may refer to, as a power of two from 9 to 15,
+# and how much memory zlib uses to find repeated bytes, from 1 to 9
+# Every compressed connection keeps its own compressor, which takes (1 << (WINDOW_BITS + 2)) + (1 << (MEM_LEVEL + 9))
+# bytes, so both are kept small enough for many thousands of connections
+WINDOW_BITS = 12
+MEM_LEVEL = 5
+
+# Message the server sends to a client it has started compressing messages for
+# Every byte the server sends after this message is part of a zlib stream, and once a stream ends,
+# such as when the connection is handed over to a new server process, the next byte starts a new stream
+COMPRESSION_MESSAGE = 'COMPRESSION:{}'.format(ALGORITHM)
+COMPRESSION_FRAME = framing.encode_frame(COMPRESSION_MESSAGE)
+
+# ==============================================================================================
+#                                   Compression Functions
+# ==============================================================================================
+
+# Returns True if the server compresses the messages it sends with the algorithm a client asked for
+# Takes String, which is empty if the client did not ask for compression, as argument
+def accepted(algorithm):
+    return ALGORITHM is not None and algorithm == ALGORITHM
+
+# Returns zlib compressor object for one connection
+def new_compressor():
+    return zlib.compressobj(LEVEL, zlib.DEFLATED, WINDOW_BITS, MEM_LEVEL)
+
+# Compress the buffers of a batch of messages written to a connection at once
+# The compressor is flushed so the client can read every message in the batch as soon as it arrives,
+# while it keeps the bytes of earlier batches, so the room and user names repeated in every message are compressed
+# against the messages sent before them
+# Returns bytes
+# Takes zlib compressor object and List of bytes-like objects as arguments
+def compress(compressor, buffers):
+    parts = [compressor.compress(buffer) for buffer in buffers]
+    parts.append(compressor.flush(zlib.Z_SYNC_FLUSH))
+    data = b''.join(parts)
+    metrics.compression_input_bytes.inc(sum(map(len, buffers)))
+    metrics.compression_output_bytes.inc(len(data))
+    return data
+
+# End a connection's zlib stream, so the connection can be handed over to a server that starts a new stream
+# Returns bytes that end the stream
+# Takes zlib compressor object as argument
+def finish(compressor):
+    return compressor.flush(zlib.Z_FINISH)
+
+# ==============================================================================================
+#                                   Decompressing Reader
+# ==============================================================================================
+
+# Collects bytes a client receives from the server and splits them into complete messages,
+# decompressing every byte that follows a COMPRESSION message
+# The bytes after a COMPRESSION message are never split on the delimiter, since compressed bytes may contain it
+class DecompressingReader(framing.FrameReader):
+    __slots__ = ('decompressor',)
+
+    # Takes socket object as argument
+    def __init__(self, sock=None):
+        super().__init__(sock)
+        # zlib decompressor object once the server has started compressing, otherwise None
+        self.decompressor = None
+
+    # Queue every message completed by bytes that were written into the buffer returned by get_buffer()
+    # Before compression starts, messages are only split up to the end of a COMPRESSION message,
+    # and the bytes after it are decompressed before they are split
+    # Returns the number of messages that are ready to be read
+    # Takes Integer as argument
+    def received(self, nbytes):
+        if self.decompressor is None:
+            end = self.end + nbytes
+            # A COMPRESSION message is only found at the start of a message, not inside another message
+            index = self.buffer.find(COMPRESSION_FRAME, self.start, end)
+            while index > self.start and self.buffer[index - 1] != framing.DELIMITER[0]:
+                index = self.buffer.find(COMPRESSION_FRAME, index + 1, end)
+            if index != -1:
+                compressed_start = index + len(COMPRESSION_FRAME)
+                compressed = bytes(self.view[compressed_start:end])
+                super().received(compressed_start - self.end)
+                self.decompressor = zlib.decompressobj()
+                return self.feed(self.decompress(compressed))
+        return super().received(nbytes)
+
+    # Returns bytes decompressed from bytes received from the server
+    # A stream that ends is followed by a new stream
+    # Takes bytes as argument
+    def decompress(self, data):
+        parts = []
+        while data:
+            parts.append(self.decompressor.decompress(data))
+            if not self.decompressor.eof:
+                break
+            data = self.decompressor.unused_data
+            self.decompressor = zlib.decompressobj()
+        return b''.join(parts)
+
+    # Returns the next complete message as bytes, reading from the socket until one is available
+    # Raises ConnectionError if the connection is closed before a complete message is received
+    # Raises zlib.error if the compressed bytes are not valid
+    def read_frame(self):
+        while not self.frames:
+            if self.decompressor is None:
+                nbytes = self.sock.recv_into(self.get_buffer())
+                if not nbytes:
+                    raise ConnectionError('Connection closed by peer')
+                self.received(nbytes)
+            else:
+                data = self.sock.recv(framing.RECV_SIZE)
+                if not data:
+                    raise ConnectionError('Connection closed by peer')
+                self.feed(self.decompress(data))
+        return self.frames.popleft()
@@ -0,0 +1,94 @@
+import os
+import sys
+
+# ==============================================================================================
+#                                       TLS Settings
+# ==============================================================================================
+
+# Certificate chain and private key the server presents to clients, as PEM files,
+# None to serve clients over plain TCP
+CERT_FILE = None
+KEY_FILE = None
+# Certificate authorities a client trusts as a PEM file, such as the server's own self-signed certificate,
+# None to trust the certificate authorities of the operating system
+CA_FILE = None
+# Seconds a connection has to finish the TLS handshake before it is closed
+HANDSHAKE_TIMEOUT = 10
+# Session tickets the server sends after each full handshake, each of which lets the client resume its session once
+# A resumed handshake skips the certificate and its signature, so clients reconnecting at once after a keepalive
+# timeout cost the server far less than new clients
+# Tickets are encrypted with keys held by the server process, so they cannot be used after a restart handoff
+SESSION_TICKETS = 2
+# Compressing messages before they are encrypted lets someone who can send messages to a user and watch the size
+# of the user's encrypted connection learn about the other messages sent to them, so encrypted connections are
+# only compressed if this is True
+COMPRESS_ENCRYPTED = False
+
+# ==============================================================================================
+#                                      TLS Functions
+# ==============================================================================================
+
+# ssl and subprocess are imported only by programs that use TLS, since ssl takes longer to import than the rest
+# of the server
+
+# Returns ssl.SSLContext the server wraps accepted connections with
+# Takes String path of the certificate chain and String path of the private key, or None if the certificate
+# file also holds the key, as arguments
+def server_context(cert_file, key_file=None):
+    import ssl
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    context.load_cert_chain(cert_file, key_file)
+    context.num_tickets = SESSION_TICKETS
+    return context
+
+# Returns ssl.SSLContext a client wraps its connection with, which checks the server's certificate and host name
+# Takes String path of the trusted certificate authorities, or None for the operating system's, as argument
+def client_context(ca_file=None):
+    import ssl
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    if ca_file is None:
+        context.load_default_certs()
+    else:
+        context.load_verify_locations(ca_file)
+    return context
+
+# Returns True if a socket is encrypted with TLS
+# A socket cannot be encrypted if the program has not imported ssl
+# Takes socket object as argument
+def encrypted(sock):
+    ssl = sys.modules.get('ssl')
+    # Another thread may still be importing ssl, in which case no socket has been encrypted with it yet
+    return ssl is not None and isinstance(sock, getattr(ssl, 'SSLSocket', ()))
+
+# Returns the compression algorithm a client asked for, or an empty String if its messages are not compressed
+# Takes String and Boolean that is True if the client's connection is encrypted as arguments
+def allowed_compression(algorithm, is_encrypted):
+    if is_encrypted and not COMPRESS_ENCRYPTED:
+        return ''
+    return algorithm
+
+# Keys a self-signed certificate can be created with, as the openssl options that create them
+KEY_OPTIONS = {
+    'ec': ['-newkey', 'ec', '-pkeyopt', 'ec_paramgen_curve:prime256v1'],
+    'rsa': ['-newkey', 'rsa:2048']
+}
+
+# Create a self-signed certificate and private key for testing TLS on one machine with the openssl program
+# The certificate is valid for localhost and 127.0.0.1, and clients trust it by using it as their CA_FILE
+# Returns Tuple of (String certificate path, String key path)
+# Raises OSError if the openssl program is not installed or fails
+# Takes String directory the files are written to, Integer number of days the certificate is valid,
+# and String key type from KEY_OPTIONS as arguments
+def self_signed_certificate(directory, days=1, key_type='ec'):
+    import subprocess
+    cert_file = os.path.join(directory, 'irc_{}_cert.pem'.format(key_type))
+    key_file = os.path.join(directory, 'irc_{}_key.pem'.format(key_type))
+    command = ['openssl', 'req', '-x509', *KEY_OPTIONS[key_type], '-nodes', '-days', str(days),
+               '-subj', '/CN=localhost', '-addext', 'subjectAltName=DNS:localhost,IP:127.0.0.1',
+               '-keyout', key_file, '-out', cert_file]
+    result = subprocess.run(command, stdout = subprocess.DEVNULL, stderr = subprocess.PIPE)
+    if result.returncode != 0:
+        raise OSError('openssl could not create a certificate: {}'.format(result.stderr.decode().strip()))
+    return cert_file, key_file
@@ -1,3 +1,10 @@
+# Longest parameter allowed in a message, in characters
+MAX_PARAM_LENGTH = 50
+# Longest payload allowed in a message, in characters
+MAX_PAYLOAD_LENGTH = 500
+# Most rooms or users one message may name in a list of names separated by commas
+MAX_LIST_LENGTH = 100
+
 # Verify that commands have the correct semantics
 # Returns True if command is valid
 # Returns String with error message if command violates a rule
@@ -14,15 +21,28 @@ def validate_command_semantics(command):
 def validate_param_semantics(param):
     if ' ' in param:
         return 'ERROR:104:Parameter contains spaces'
-    elif len(param) > 50:
+    elif len(param) > MAX_PARAM_LENGTH:
         return 'ERROR:101:Parameter has exceeded allowed value of 50 characters'
     return True
 
+# Verify that a list of room or user names has the correct semantics
+# Returns True if the list and every name in it are valid
+# Returns String with error message if the list or one of its names violates a rule
+# Takes List of Strings as argument
+def validate_list_semantics(names):
+    if len(names) > MAX_LIST_LENGTH:
+        return 'ERROR:114:Parameter has exceeded allowed value of 100 names'
+    for name in names:
+        param_check = validate_param_semantics(name)
+        if param_check != True:
+            return param_check
+    return True
+
 # Verify that payload has the correct semantics
 # Returns True if payload is valid
 # Returns String with error message if payload violates a rule
 # Takes String as argument
 def validate_payload_semantics(payload):
-    if len(payload) > 500:
+    if len(payload) > MAX_PAYLOAD_LENGTH:
         return 'ERROR:102:Payload has exceeded allowed value of 500 characters'
     return True
\ No newline at end of file